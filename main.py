@@ -6,11 +6,15 @@ from datetime import timedelta
 
 import pytimeparse
 
-from sync import update_yt_ids_in_db, sync_all_playlists, update_pl_cfg_in_db, sub_videos_with_songs, SLACK_CHANNEL_INFO, process_download_tasks
+from sync import update_yt_ids_in_db, sync_all_playlists, update_pl_cfg_in_db, sub_videos_with_songs, SLACK_CHANNEL_INFO, process_download_tasks, \
+    process_library_changes, sync_lock
 from utils import slack
 from utils.common import get_nested_value
+from utils.cycle import CycleContext
 from utils.db import load_settings, create_db_structure
+from utils.http import format_http_stats, reset_http_stats
 from utils.jf import jf_auth
+from utils.jf_events import LibraryEventListener, events_enabled
 from utils.logs import create_logger
 
 logger = create_logger("main")
@@ -47,20 +51,28 @@ def main():
         setup_db_structure()
         logger.info(f"Starting the sync.")
         jf_auth()
-        update_pl_cfg_in_db()
-        update_yt_ids_in_db()
-        sub_videos_with_songs()
-        sync_all_playlists()
-        if process_download_tasks() > 0:
+        with sync_lock:
+            # Settings, the Jellyfin user & co are resolved once and shared by all the stages of the cycle
+            ctx = CycleContext()
+            update_pl_cfg_in_db(ctx)
             update_yt_ids_in_db()
-            sync_all_playlists()
+            sub_videos_with_songs()
+            sync_all_playlists(ctx)
+            if process_download_tasks(ctx) > 0:
+                update_yt_ids_in_db()
+                sync_all_playlists(ctx)
     except:
         logger.exception("Error during the main cycle")
         with io.StringIO() as output:
             traceback.print_exc(file=output)
             tb = output.getvalue()
         slack.send_message(f"Error happened during the main cycle: \n```\n{tb}\n```", SLACK_CHANNEL_INFO)
+    logger.info(f"HTTP calls during the cycle:\n{format_http_stats()}")
+    reset_http_stats()
 
+    if events_enabled():
+        # Items imported until the next cycle are stamped and added into the playlists as Jellyfin reports them
+        LibraryEventListener(process_library_changes).start()
     wait_period()
 
 
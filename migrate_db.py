@@ -0,0 +1,71 @@
+"""
+Copies all the records from one db backend to the other, keeping the record ids:
+
+    python migrate_db.py pocketbase sqlite
+    python migrate_db.py sqlite pocketbase
+
+Both backends are configured the usual way (CONFIG_DB_URL & co, CONFIG_DB_SQLITE_PATH).
+Records which already exist in the destination are updated, so the copy can be repeated.
+"""
+import argparse
+from dataclasses import asdict
+
+from utils.common import chunked
+from utils.db import create_storage, schema_definitions, default_settings, META_COLLECTION
+from utils.logs import create_logger
+from utils.storage import Storage, WriteOp
+
+logger = create_logger("migrate_db")
+
+# Key/value collections get their defaults on setup, their records are matched by key rather than by id
+KEY_VALUE_COLLECTIONS = ('yt_sync_settings',)
+
+
+def copy_collection(src: Storage, dst: Storage, name, chunk_size=500):
+    match_field = 'key' if name in KEY_VALUE_COLLECTIONS else 'id'
+    existing = {r[match_field]: r['id'] for r in dst.list_records(name, fields=tuple({'id', match_field}))}
+    records = src.list_records(name)
+    failed = 0
+    for chunk in chunked(records, chunk_size):
+        ops = []
+        for rec in chunk:
+            body = {k: v for k, v in rec.items() if k not in ('collectionId', 'collectionName')}
+            if rec[match_field] in existing:
+                body.pop('id')
+                ops.append(WriteOp('update', name, existing[rec[match_field]], body))
+            else:
+                if match_field != 'id':
+                    body.pop('id')
+                ops.append(WriteOp('create', name, body=body))
+        for op, (status, body) in zip(ops, dst.write(ops)):
+            if not (status and 200 <= status < 300):
+                failed += 1
+                logger.error(f"Cannot copy a `{name}` record {op.body}, status: {status}, response: {body}")
+    logger.info(f"Copied {len(records) - failed} out of {len(records)} `{name}` records")
+    return failed
+
+
+def migrate(src_backend, dst_backend):
+    src = create_storage(src_backend)
+    dst = create_storage(dst_backend)
+    dst.create_db_structure(asdict(default_settings()))
+    failed = 0
+    for dscr in schema_definitions():
+        if dscr['name'] != META_COLLECTION:
+            failed += copy_collection(src, dst, dscr['name'])
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Copies the db records between the storage backends")
+    parser.add_argument('src', choices=['pocketbase', 'sqlite'])
+    parser.add_argument('dst', choices=['pocketbase', 'sqlite'])
+    args = parser.parse_args()
+    if args.src == args.dst:
+        parser.error("Source and destination must differ")
+    if migrate(args.src, args.dst):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,9 +3,9 @@ import json
 import os
 import random
 import re
+import threading
 import time
 from collections import defaultdict
-from dataclasses import replace
 from os.path import basename
 from typing import List
 
@@ -15,15 +15,22 @@ from yt_dlp import MetadataParserPP
 from ytmusicapi import YTMusic
 
 from utils import slack
-from utils.common import get_nested_value, first, format_scaled_number, group_by
-from utils.db import load_media_mappings, load_settings, load_playlist_configs, save_playlist_config, load_local_media, \
-    add_local_media, load_yt_automated_playbooks, load_yt_media_metadata, YtMediaMetadata, save_yt_media_metadata, load_guser_by_id, create_yt_media_metadata, DownloadTask, create_download_task, \
-    CreateOpResult, load_download_tasks, save_entity
-from utils.jf import load_all_items, find_user_by_name, load_item_by_id, save_item, load_jf_playlist, \
-    add_media_ids_to_playlist, create_playlist, get_jf_base_url, reload_library
+from utils.common import get_nested_value, format_scaled_number, group_by
+from utils.db import load_media_mappings, load_settings, load_playlist_configs, \
+    add_local_media, load_yt_automated_playbooks, YtMediaMetadata, load_guser_by_id, DownloadTask, \
+    CreateOpResult, BulkWriter, create_entities, LocalMediaArchive, UnitOfWork
+from utils.jf import load_all_items, LibraryIndex, stamp_provider_ids, load_item_by_id, \
+    add_media_ids_to_playlist, create_playlist, get_jf_base_url, refresh_library
+from utils.cycle import CycleContext
 from utils.logs import create_logger
+from utils.indexed_store import yt_media_metadata_store
+from utils.jf_playlist_cache import playlist_membership
+from utils.jf_events import LibraryChange
+from utils.jf_snapshot import load_library_items, forget_library_items, LIBRARY_FIELDS
+from utils.playlist_diff import plan_removals, plan_moves
+from utils.replica import load_replicated, iter_replicated
 from utils.slack import add_slack_interactive_message_handler, add_slack_shortcut_handler, send_ephemeral
-from utils.ytm import load_flat_playlist, createYtMusic, refresh_access_token, Category
+from utils.ytm import load_flat_playlist, load_flat_playlists, ytdl_cache_dir, createYtMusic, refresh_access_token, Category
 
 NO_IMAGE_AVAILABLE_URL = 'https://upload.wikimedia.org/wikipedia/commons/thumb/a/ac/No_image_available.svg/300px-No_image_available.svg.png'
 
@@ -32,11 +39,17 @@ SLACK_CHANNEL_INFO = os.getenv('SLACK_CHANNEL_PLAYSYNC_INFO', SLACK_CHANNEL_DEFA
 SLACK_CHANNEL_MISMATCHED_MEDIA = os.getenv('SLACK_CHANNEL_PLAYSYNC_MISMATCH_MEDIA', SLACK_CHANNEL_DEFAULT)
 SLACK_CHANNEL_V2S_LOG = os.getenv('SLACK_CHANNEL_PLAYSYNC_V2S_LOGGING', '#v2s_logging')
 
+# Held by a sync cycle and by the processing of library events, so they do not stamp or add the same items twice
+sync_lock = threading.RLock()
+# YT ids of the playlists as they were synced the last time, by jf playlist id
+last_synced_yt_ids: dict[str, list[str]] = {}
 
-def parse_yt_id(path, regex=None):
+
+def parse_yt_id(path, regex: str | re.Pattern = None):
     if regex is None:
         regex = load_settings().jf_extract_ytid_regex
-    m = re.search(regex, path)
+    pattern = regex if isinstance(regex, re.Pattern) else re.compile(regex)
+    m = pattern.search(path)
     if m:
         return m.group()
 
@@ -46,16 +59,8 @@ def process_media_metadata_mismatch(req, action):
     payload = json.loads(action['value'])
     yt_id = payload['yt_id']
     jf_id = payload['jf_id']
-    uid = payload['uid']
-    jf_item_full = load_item_by_id(jf_id, uid)
-    old_yt_id = get_nested_value(jf_item_full, 'ProviderIds', 'YT')
-    if old_yt_id is None:
-        jf_item_full['ProviderIds']['YT'] = yt_id
-        save_item(jf_item_full)
-    elif old_yt_id == yt_id:
-        pass
-    else:
-        logger.warning(f"Cannot set YT_ID=[{yt_id}] for media {jf_item_full['title']} / {jf_id}, cause it already has YT_ID=[{old_yt_id}] ")
+    if not stamp_provider_ids({jf_id: {'YT': yt_id}})[jf_id]:
+        logger.warning(f"Cannot set YT_ID=[{yt_id}] for media {jf_id}")
 
     pass
 
@@ -70,9 +75,9 @@ def process_video_replacement(req: SocketModeRequest, action):
     sid = data['sid']
     vid = data['vid']
     if sid and vid:
-        if mm := first(load_yt_media_metadata(yt_id=vid)):
-            mm.alt_id = sid
-            save_yt_media_metadata(mm)
+        if mm := yt_media_metadata_store().get(vid):
+            with UnitOfWork().track(mm):
+                mm.alt_id = sid
             logger.info(f"Associated video {mm.yt_id} {mm.title} by {mm.artist} with media {mm.alt_id}")
             try:
                 slack.delete_current_message(req)
@@ -91,7 +96,7 @@ def process_video_scan(req: SocketModeRequest):
 
 def process_init_video_resolve(req: SocketModeRequest, action=None):
     logger = create_logger("yt_auto.v2s")
-    metadata = load_yt_media_metadata(alt_id=None, category='video')
+    metadata = yt_media_metadata_store().find(alt_id=None, category='video')
     uid = req.payload['user']['id']
     try:
         slack.delete_current_message(req)
@@ -113,34 +118,33 @@ add_slack_shortcut_handler("vsd-init-scan", process_video_scan)
 add_slack_shortcut_handler("vsd-resolve-videos", process_init_video_resolve)
 
 
-def update_yt_ids_in_db():
+def update_yt_ids_in_db(items=None) -> dict[str, str]:
+    """
+    Stamps the downloaded medias with their YT ids, returns the stamped jf ids with their YT ids.
+    `items` narrows it down to these library items, the downloads of other files are left for later.
+    """
     logger = create_logger("yt_ids_sync")
-    download_tasks = load_download_tasks('downloaded')
-    jf_items = load_all_items("Audio", "Path,ProviderIds")
-    settings = load_settings()
-    user = find_user_by_name(settings.jf_user_name)
+    download_tasks = load_replicated(DownloadTask, status='downloaded')
+    library = LibraryIndex(items if items is not None else load_library_items("Audio") if download_tasks else ())
+    if items is not None:
+        download_tasks = [dt for dt in download_tasks if basename(dt.path) in library.by_basename]
+        if not download_tasks:
+            return {}
     successful = []
+    stamped_yt_ids = {}
     already_done = []
     failed = []
+    uow = UnitOfWork().track(*download_tasks)
+    to_stamp: dict[str, tuple[DownloadTask, dict]] = {}
     for dt in download_tasks:
         try:
-            filename = basename(dt.path)
-            jf_item = next((i for i in jf_items if basename(i['Path']) == filename), None)
+            jf_item = library.by_basename.get(basename(dt.path))
             if jf_item:
                 jf_id = jf_item['Id']
                 jf_name = jf_item['Name']
                 yt_provider_id = jf_item['ProviderIds'].get('YT')
                 if yt_provider_id is None:
-                    jf_item_full = load_item_by_id(jf_id, user.id)
-                    jf_item_full['ProviderIds']['YT'] = dt.yt_id
-                    if save_item(jf_item_full):
-                        logger.info(f"Media '{jf_name}'({jf_id}) got updated with YT id {dt.yt_id}")
-                        successful.append(jf_item)
-                        dt.status = 'imported'
-                        save_entity(dt, ['status'])
-                    else:
-                        logger.error(f"Failed to update media '{jf_name}'({jf_id}) with YT id {dt.yt_id}")
-                        failed.append(jf_item)
+                    to_stamp[jf_id] = (dt, jf_item)
                 else:
                     logger.info(f"Media '{jf_name}'({jf_id}) already has YT id {yt_provider_id}")
                     already_done.append(jf_item)
@@ -150,35 +154,57 @@ def update_yt_ids_in_db():
         except:
             logger.exception(f"Failed to process download task {dt}")
             failed.append({'Id': None, 'Name': None, 'Path': dt.path})
+    stamped = stamp_provider_ids({jf_id: {'YT': dt.yt_id} for jf_id, (dt, _) in to_stamp.items()})
+    for jf_id, (dt, jf_item) in to_stamp.items():
+        if stamped[jf_id]:
+            logger.info(f"Media '{jf_item['Name']}'({jf_id}) got updated with YT id {dt.yt_id}")
+            successful.append(jf_item)
+            stamped_yt_ids[jf_id] = dt.yt_id
+            dt.status = 'imported'
+        else:
+            logger.error(f"Failed to update media '{jf_item['Name']}'({jf_id}) with YT id {dt.yt_id}")
+            failed.append(jf_item)
+    uow.flush()
 
     log_level_function = logger.info if len(failed) == 0 else logger.warning
     log_level_function(f"""Processed: {len(download_tasks)}.
 Successfully updated items: {len(successful)}.
 Already contained yt_id: {len(already_done)}.
 Failed: {len(failed)}.""")
+    return stamped_yt_ids
 
 
-def sync_all_playlists():
+def sync_all_playlists(ctx: CycleContext = None):
     logger = create_logger("pl_sync")
+    ctx = ctx or CycleContext()
     pl_configs = load_playlist_configs()
-    jf_items = load_all_items("Audio", "Path,ProviderIds")
-    settings = load_settings()
-    user = find_user_by_name(settings.jf_user_name)
+    jf_items = load_library_items("Audio")
+    library = LibraryIndex(jf_items, ctx.yt_id_pattern)
+    user = ctx.user
     pl_additions = {}
     pl_misses = {}
+    download_tasks = BulkWriter()
+    # One request tells which of the cached playlists have changed since the previous cycle
+    membership = playlist_membership(ctx.jf)
+    membership.revalidate(pl.jf_pl_id for pl in pl_configs if pl.sync and pl.jf_pl_id)
+    # A playlist that failed here is loaded again by sync_playlist(), which reports the error
+    yt_playlists = load_flat_playlists(pl.ytm_pl_id for pl in pl_configs if pl.sync)
     for pl_cfg in pl_configs:
         try:
             if pl_cfg.sync:
-                added_into_playlist, not_found = sync_playlist(pl_cfg, user=user, items=jf_items, logger=logger)
+                added_into_playlist, not_found = sync_playlist(pl_cfg, user=user, library=library, logger=logger, download_tasks=download_tasks, ctx=ctx,
+                                                               yt_playlist=yt_playlists.get(pl_cfg.ytm_pl_id))
                 pl_additions[pl_cfg.jf_pl_id] = added_into_playlist
                 pl_misses[pl_cfg.jf_pl_id] = not_found
             else:
                 logger.debug(f"Playlist '{pl_cfg.ytm_pl_name}/{pl_cfg.ytm_pl_id}' has flag SYNC=OFF. Ignoring the playlist.")
         except:
             logger.exception(f"Error happened while syncing YT playlist '{pl_cfg.ytm_pl_name}'[{pl_cfg.ytm_pl_id}] with JF playlist '{pl_cfg.jf_pl_name}'/[{pl_cfg.jf_pl_id}]")
+    # The next cycle runs in a new process
+    membership.save()
+    flush_download_tasks(download_tasks, logger)
 
-    local_media = load_local_media()
-    local_media_ids = {m.jf_id for m in local_media}
+    local_media_ids = {m.jf_id for m in iter_replicated(LocalMediaArchive)}
     new_items = [itm for itm in jf_items if itm['Id'] not in local_media_ids]
     add_local_media(new_items)
     pl_lookup = {pl.jf_pl_id: pl for pl in pl_configs}
@@ -280,18 +306,30 @@ def send_mismatch_report(mismatched_media, user, channel_id):
     slack.send_message("Media mismatch report", channel_id, blocks=report)
 
 
-def sync_playlist(pl_config, user=None, items=None, logger=None):
+def flush_download_tasks(download_tasks: BulkWriter, logger):
+    logger.info(f"Adding {len(download_tasks)} download tasks for missing medias")
+    for task, status in download_tasks.flush():
+        if status not in (CreateOpResult.CREATED, CreateOpResult.DUPLICATE):
+            logger.error(f"Failed to create download task for media [{task.yt_id}], status: {status}")
+
+
+def sync_playlist(pl_config, user=None, items=None, logger=None, download_tasks: BulkWriter = None, library: LibraryIndex = None,
+                  ctx: CycleContext = None, yt_playlist: dict = None):
     logger = logger or create_logger("pl_sync")
-    itms = items or load_all_items("Audio", "Path,ProviderIds")
-    ytm2items = {itm['ProviderIds']['YT']: itm for itm in itms if 'YT' in itm['ProviderIds']}
-    recovered_items = {parse_yt_id(itm['Path']): itm for itm in itms if 'YT' not in itm['ProviderIds']}
-    user = user or find_user_by_name(load_settings().jf_user_name)
-    yt_playlist_songs = load_flat_playlist(pl_config.ytm_pl_id)
-    jf_playlist_songs = load_jf_playlist(pl_config.jf_pl_id, user.id, "ProviderIds")
-    jf_playlist_yt_ids = { e['ProviderIds']['YT'] for e in jf_playlist_songs['Items'] if 'YT' in e['ProviderIds']}
+    ctx = ctx or CycleContext()
+    library = library or LibraryIndex(items or load_library_items("Audio"), ctx.yt_id_pattern)
+    ytm2items = library.by_yt_id
+    recovered_items = library.by_path_yt_id
+    user = user or ctx.user
+    yt_playlist_songs = yt_playlist or load_flat_playlist(pl_config.ytm_pl_id)
+    last_synced_yt_ids[pl_config.jf_pl_id] = [s['id'] for s in yt_playlist_songs['entries']]
+    membership = playlist_membership(ctx.jf)
+    jf_playlist_yt_ids = membership.yt_ids(pl_config.jf_pl_id, user.id)
     already_in_library = []
+    yt_ids_by_jf_id = {}
     recovery_media_mismatch = []
     not_in_lib = []
+    to_recover: dict[str, tuple[dict, dict]] = {}
     for yt_song in yt_playlist_songs['entries']:
         yt_song = defaultdict(lambda : "UNKNOWN", yt_song)
         yt_id = yt_song['id']
@@ -301,18 +339,13 @@ def sync_playlist(pl_config, user=None, items=None, logger=None):
         jf_item = ytm2items.get(yt_id)
         if jf_item:
             already_in_library.append(jf_item['Id'])
+            yt_ids_by_jf_id[jf_item['Id']] = yt_id
             logger.info(f"Queueing media '{jf_item['Name']}'[{yt_song['url']}] into JF playlist '{pl_config.jf_pl_name}'")
         else:
             if yt_id in recovered_items:
                 recovered = recovered_items[yt_id]
                 if recovered['Name'] == yt_song['title'] and yt_song['channel'] in recovered['Artists']:
-                    jf_item_full = load_item_by_id(recovered['Id'], user.id)
-                    jf_item_full['ProviderIds']['YT'] = yt_id
-                    if save_item(jf_item_full):
-                        already_in_library.append(recovered['Id'])
-                        logger.info(f"Recovered YT media {yt_song['title']} / {yt_song['channel']} from local media {recovered['Name']} / {recovered['Artists']}")
-                    else:
-                        logger.warning(f"Cannot save yt_id{yt_id}({yt_song['channel']}/{yt_song['title']}) for local media '{recovered['Name']} / {recovered['Artists']} ({recovered['Id']})'")
+                    to_recover[recovered['Id']] = (yt_song, recovered)
                 else:
                     not_in_lib.append(yt_song)
                     recovery_media_mismatch.append((yt_song, recovered))
@@ -322,16 +355,32 @@ def sync_playlist(pl_config, user=None, items=None, logger=None):
                 not_in_lib.append(yt_song)
                 logger.warning(f"Cannot find media '{yt_song['channel']}/{yt_song['title']}'[{yt_song['url']}] in local library.")
 
-    added_n = add_media_ids_to_playlist(pl_config.jf_pl_id, already_in_library, user_id=user.id)
-    log_level_func = logger.info if added_n == len(already_in_library) else logger.warning
-    msg1 = f"Added {added_n} out of {len(already_in_library)} possible medias into the playlist {pl_config.jf_pl_name}"
+    recovered_ids = stamp_provider_ids({jf_id: {'YT': yt_song['id']} for jf_id, (yt_song, _) in to_recover.items()})
+    for jf_id, (yt_song, recovered) in to_recover.items():
+        if recovered_ids[jf_id]:
+            already_in_library.append(jf_id)
+            yt_ids_by_jf_id[jf_id] = yt_song['id']
+            logger.info(f"Recovered YT media {yt_song['title']} / {yt_song['channel']} from local media {recovered['Name']} / {recovered['Artists']}")
+        else:
+            logger.warning(f"Cannot save yt_id{yt_song['id']}({yt_song['channel']}/{yt_song['title']}) for local media '{recovered['Name']} / {recovered['Artists']} ({jf_id})'")
+
+    added = add_media_ids_to_playlist(pl_config.jf_pl_id, already_in_library, user_id=user.id)
+    added_ids = [jf_id for jf_id, ok in added.items() if ok]
+    membership.record_added(pl_config.jf_pl_id, {jf_id: yt_ids_by_jf_id[jf_id] for jf_id in added_ids})
+    if pl_config.mirror:
+        mirror_playlist(pl_config, last_synced_yt_ids[pl_config.jf_pl_id], user=user, logger=logger, ctx=ctx)
+    log_level_func = logger.info if len(added_ids) == len(already_in_library) else logger.warning
+    msg1 = f"Added {len(added_ids)} out of {len(already_in_library)} possible medias into the playlist {pl_config.jf_pl_name}"
     msg2 = f"{len(not_in_lib)} medias are not in the library"
 
-    logger.info(f"Adding {len(not_in_lib)} download tasks for missing medias")
+    # Download tasks are written in bulk, either here or by the caller that syncs several playlists at once
+    own_writer = download_tasks is None
+    download_tasks = download_tasks if download_tasks is not None else BulkWriter()
     for yt_song in not_in_lib:
-        logger.debug(f"Adding download task for media '{yt_song['channel']}/{yt_song['title']}'[{yt_song['url']}]")
-        if (status := create_download_task(DownloadTask(yt_id=yt_song['id']))) != CreateOpResult.CREATED:
-            logger.error(f"Failed to create download task for media '{yt_song['channel']}/{yt_song['title']}'[{yt_song['url']}], status: {status}")
+        logger.debug(f"Queueing download task for media '{yt_song['channel']}/{yt_song['title']}'[{yt_song['url']}]")
+        download_tasks.add(DownloadTask(yt_id=yt_song['id']))
+    if own_writer:
+        flush_download_tasks(download_tasks, logger)
 
     # Send out a report about medias that were not possible to recover automatically
     for batch in itertools.batched(recovery_media_mismatch[:2], 15):
@@ -341,15 +390,100 @@ def sync_playlist(pl_config, user=None, items=None, logger=None):
     if not_in_lib:
         logger.warning(msg2)
 
-    return already_in_library, not_in_lib
+    return added_ids, not_in_lib
 
 
-def update_pl_cfg_in_db():
+def mirror_playlist(pl_config, yt_ids, user=None, logger=None, ctx: CycleContext = None):
+    """
+    Makes the JF playlist follow the YT playlist `yt_ids`, after the missing songs were appended: removes the entries
+    of the songs that are not in the YT playlist anymore and moves the rest into the YT order with the fewest moves.
+    Entries without a YT id were not added by the sync, they are left in their positions.
+    """
+    logger = logger or create_logger("pl_sync")
+    ctx = ctx or CycleContext()
+    user = user or ctx.user
+    pl_id = pl_config.jf_pl_id
+    membership = playlist_membership(ctx.jf)
+    entries = membership.entries(pl_id, user.id)
+
+    if removals := plan_removals(entries, yt_ids):
+        removed = {entry_id for entry_id, ok in ctx.jf.remove_playlist_entries(pl_id, removals).items() if ok}
+        membership.record_removed(pl_id, removed)
+        entries = [e for e in entries if e.entry_id not in removed]
+        log_level_func = logger.info if len(removed) == len(removals) else logger.warning
+        log_level_func(f"Removed {len(removed)} out of {len(removals)} medias gone from YT from the playlist {pl_config.jf_pl_name}")
+
+    moves = plan_moves(entries, yt_ids)
+    moved = []
+    for entry_id, index in moves:
+        # Each index assumes the moves before it, the rest is left to the next cycle
+        if not ctx.jf.move_playlist_entry(pl_id, entry_id, index):
+            break
+        moved.append((entry_id, index))
+    membership.record_moved(pl_id, moved)
+    if moves:
+        log_level_func = logger.info if len(moved) == len(moves) else logger.warning
+        log_level_func(f"Moved {len(moved)} out of {len(moves)} medias into the YT order in the playlist {pl_config.jf_pl_name}")
+
+
+def add_items_to_synced_playlists(items, ctx: CycleContext = None) -> dict[str, list[str]]:
+    """
+    Adds library items with YT ids into the playlists that had those YT ids when they were synced the last time.
+    Neither the YT playlists nor the whole library are loaded, playlists not synced by this process yet are skipped.
+    Returns the added jf ids by jf playlist id.
+    """
+    logger = create_logger("pl_sync")
+    ctx = ctx or CycleContext()
+    by_yt_id = LibraryIndex(items).by_yt_id
+    membership = playlist_membership(ctx.jf)
+    additions = {}
+    for pl_cfg in load_playlist_configs():
+        yt_ids = last_synced_yt_ids.get(pl_cfg.jf_pl_id)
+        if not pl_cfg.sync or not yt_ids:
+            continue
+        present = membership.yt_ids(pl_cfg.jf_pl_id, ctx.user.id)
+        # In the YT playlist order
+        yt_ids_by_jf_id = {by_yt_id[yt_id]['Id']: yt_id for yt_id in yt_ids if yt_id in by_yt_id and yt_id not in present}
+        if not yt_ids_by_jf_id:
+            continue
+        added = ctx.jf.add_media_ids_to_playlist(pl_cfg.jf_pl_id, list(yt_ids_by_jf_id), ctx.user.id)
+        added_ids = [jf_id for jf_id, ok in added.items() if ok]
+        membership.record_added(pl_cfg.jf_pl_id, {jf_id: yt_ids_by_jf_id[jf_id] for jf_id in added_ids})
+        logger.info(f"Added {len(added_ids)} out of {len(yt_ids_by_jf_id)} new medias into the playlist {pl_cfg.jf_pl_name}")
+        if pl_cfg.mirror:
+            mirror_playlist(pl_cfg, yt_ids, logger=logger, ctx=ctx)
+        additions[pl_cfg.jf_pl_id] = added_ids
+    if additions:
+        membership.save()
+    return additions
+
+
+def process_library_changes(change: LibraryChange):
+    """Handles the items Jellyfin reports as changed: stamps the downloaded ones and adds them into the playlists."""
+    logger = create_logger("library_events")
+    with sync_lock:
+        ctx = CycleContext()
+        if change.removed:
+            forget_library_items(change.removed)
+        changed = ctx.jf.load_items_by_ids(change.added | change.updated, LIBRARY_FIELDS)
+        items = [itm for itm in changed.values() if itm.get('Type') == 'Audio']
+        if not items:
+            return
+        logger.info(f"Processing {len(items)} added or updated library items")
+        for jf_id, yt_id in update_yt_ids_in_db(items).items():
+            changed[jf_id].setdefault('ProviderIds', {})['YT'] = yt_id
+        add_items_to_synced_playlists(items, ctx)
+
+
+def update_pl_cfg_in_db(ctx: CycleContext = None):
     logger = create_logger("pl_upd")
+    ctx = ctx or CycleContext()
     pl_configs = load_playlist_configs()
-    settings = load_settings()
-    user = find_user_by_name(settings.jf_user_name)
+    user = ctx.user
     jf_playlists = None
+    uow = UnitOfWork().track(*pl_configs)
+    # A playlist that failed here is loaded again below, which reports the error
+    yt_playlists = load_flat_playlists((pl.ytm_pl_id for pl in pl_configs if pl.sync), load_entries=False)
 
     def get_jf_playlists():
         nonlocal jf_playlists
@@ -360,9 +494,7 @@ def update_pl_cfg_in_db():
     for pl_cfg in pl_configs:
         try:
             if pl_cfg.sync:
-                old = replace(pl_cfg)
-
-                yt_pl = load_flat_playlist(pl_cfg.ytm_pl_id, load_entries=False)
+                yt_pl = yt_playlists.get(pl_cfg.ytm_pl_id) or load_flat_playlist(pl_cfg.ytm_pl_id, load_entries=False)
                 pl_cfg.ytm_pl_name = yt_pl['title']
 
                 jf_pl = None
@@ -385,12 +517,12 @@ def update_pl_cfg_in_db():
                 else:
                     logger.error(f"Could not find a Playlist({pl_cfg.jf_pl_name})")
 
-                if old != pl_cfg:
-                    save_playlist_config(pl_cfg)
-                    logger.info(f"Updated PlaylistConfig: {old} -> {pl_cfg}")
+                if changes := uow.changes(pl_cfg):
+                    logger.info(f"Updating PlaylistConfig({pl_cfg.id}): {changes}")
         except:
             logger.exception(
                 f"Error happened while syncing YT playlist({pl_cfg.ytm_pl_id}) with JF playlist '{pl_cfg.jf_pl_name}'")
+    uow.flush()
 
 
 def format_vid_replacement_message(video_meta: YtMediaMetadata, song_candidates_meta: list[YtMediaMetadata]):
@@ -508,8 +640,8 @@ def format_resolve_video_load_more(more_vids_n):
 def resolve_video_substitution(vid_sub_candidates: List[str], slack_user_recipient):
     ytm = YTMusic()
     logger = create_logger("yt_auto.v2s")
-    metadata: dict[str, YtMediaMetadata] = {mm.yt_id: mm for mm in load_yt_media_metadata(alt_id=None)}
-    candidates_meta = [meta for v in vid_sub_candidates if (meta := metadata.get(v)) and not meta.ignore]
+    store = yt_media_metadata_store()
+    candidates_meta = [meta for v in vid_sub_candidates if (meta := store.get(v)) and not meta.alt_id and not meta.ignore]
     if diff := len(vid_sub_candidates) - len(candidates_meta) > 0:
         logger.warning(f"{diff} medias are not in db/metadata")
     if candidates_meta:
@@ -532,9 +664,10 @@ def resolve_video_substitution(vid_sub_candidates: List[str], slack_user_recipie
 
 def sub_videos_with_songs():
     logger = create_logger("yt_auto.v2s")
-    pl_cfgs = [pl for pl in load_yt_automated_playbooks() if pl.enabled]
+    pl_cfgs = load_yt_automated_playbooks(enabled=True)
     pl_cfgs_by_user = group_by(pl_cfgs, lambda pl: pl.yt_user)
-    yt_media_metadata = {mm.yt_id: mm for mm in load_yt_media_metadata()}
+    # Once per cycle, to pick up the changes made outside of this process
+    yt_media_metadata = yt_media_metadata_store().refresh()
     if pl_cfgs:
         for usr_id, pl_cfgs in pl_cfgs_by_user.items():
             usr = load_guser_by_id(usr_id)
@@ -556,12 +689,13 @@ def sub_videos_with_songs():
                     pl_ids_to_media = {t['videoId']: t for t in playlist['tracks']}
                     for media in playlist['tracks']:
                         mid = media['videoId']
-                        if mid not in yt_media_metadata:
+                        meta = yt_media_metadata.get(mid)
+                        if meta is None:
                             new_metadata.append(media)
                         category = Category.SONG if media['videoType'] == 'MUSIC_VIDEO_TYPE_ATV' else Category.VIDEO
                         media['category'] = category
                         if category == Category.VIDEO:
-                            if (meta := yt_media_metadata.get(mid)) and meta.alt_id:
+                            if meta and meta.alt_id:
                                 replaceable[mid] = meta.alt_id
                             else:
                                 unresolved_videos.append((media, pl, playlist))
@@ -589,6 +723,7 @@ def sub_videos_with_songs():
 
                 # Select medias that are not in the metadata yet
                 logger.info(f"Found {len(new_metadata)} new medias in user's ({usr.yt_user_id}) playlists")
+                new_mm = []
                 for media in new_metadata:
                     mm = None
                     try:
@@ -605,18 +740,25 @@ def sub_videos_with_songs():
                             thumbnail_url=max(media['thumbnails'], key=lambda thn: thn['height'],
                                               default={'url': 'https://upload.wikimedia.org/wikipedia/commons/thumb/a/ac/No_image_available.svg/300px-No_image_available.svg.png'})['url']
                         )
-                        create_yt_media_metadata(mm)
+                        new_mm.append(mm)
                     except:
                         logger.exception(f"Failed to save {mm}")
+                # Has to be stored before resolve_video_substitution() looks the videos up
+                for mm, status in zip(new_mm, create_entities(new_mm)):
+                    if status == CreateOpResult.ERROR:
+                        logger.error(f"Failed to save {mm}")
                 if unresolved_videos:
                     resolve_video_substitution([v['videoId'] for v, pl_cfg, pl_data in unresolved_videos], usr.slack_user)
 
 
-def process_download_tasks():
+def process_download_tasks(ctx: CycleContext = None):
     logger = create_logger("yt_dwld")
+    ctx = ctx or CycleContext()
     root_dir = os.environ.get('CONFIG_YTD_ROOT_DIR', "/tmp/ytdl")
     output_template = os.path.join(root_dir, os.environ.get('CONFIG_YTD_FILEPATH_TEMPLATE', "ytm_%(id)s_ytm.%(ext)s"))
-    pending_tasks = {t.yt_id: t for t in load_download_tasks() if t.status == 'pending'}
+    pending_tasks = {t.yt_id: t for t in load_replicated(DownloadTask, status='pending')}
+    # Task updates are written in one go after the downloads, but before the library reload picks the files up
+    uow = UnitOfWork().track(*pending_tasks.values())
 
     def progress_hook(song):
         logger.info(str(time.time()) + f" Download progress for {song['filename']}: {song['status']}")
@@ -626,13 +768,13 @@ def process_download_tasks():
             task = pending_tasks[yt_id]
             task.path = file_path
             task.status = 'downloaded'
-            save_entity(task)
 
     ydl_opts = {
         'progress_hooks': [progress_hook],
         'format': 'bestaudio[ext=m4a]',
         'outtmpl': output_template,
         'quiet': True,
+        'cachedir': ytdl_cache_dir(),
         # Embed the song thumbnail as cover art
         'writethumbnail': True,
         'postprocessors': [
@@ -646,15 +788,21 @@ def process_download_tasks():
         ]
     }
     downloaded = 0
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        for task in pending_tasks.values():
-            try:
-                if 0 != (retcode := ydl.download([f"https://www.youtube.com/watch?v={task.yt_id}"])):
-                    raise Exception(f"yt-dlp returned non successful code: {retcode}")
-                downloaded += 1
-                logger.info(str(time.time()) + f" Returned from download call for yt_id {task.yt_id} with status {task.status} and path {task.path}")
-            except:
-                logger.exception(f"Failed to download yt_id {task.yt_id} for task {task.id}")
+    try:
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            for task in pending_tasks.values():
+                try:
+                    if 0 != (retcode := ydl.download([f"https://www.youtube.com/watch?v={task.yt_id}"])):
+                        raise Exception(f"yt-dlp returned non successful code: {retcode}")
+                    downloaded += 1
+                    logger.info(str(time.time()) + f" Returned from download call for yt_id {task.yt_id} with status {task.status} and path {task.path}")
+                except:
+                    logger.exception(f"Failed to download yt_id {task.yt_id} for task {task.id}")
+    finally:
+        uow.flush()
     logger.info(str(time.time()) + " Finished processing download tasks")
-    reload_library()
+    new_paths = [ctx.to_jf_path(t.path) for t in pending_tasks.values() if t.status == 'downloaded']
+    # update_yt_ids_in_db() runs right after, so the new files have to be in the library by then
+    if missing := refresh_library(new_paths, folder=ctx.to_jf_path(root_dir)):
+        logger.warning(f"{len(missing)} downloaded files are not in the library yet: {sorted(missing)}")
     return downloaded
@@ -0,0 +1,161 @@
+import dataclasses
+import gc
+import time
+import tracemalloc
+from dataclasses import field
+from os.path import basename
+
+from test.helpers import truncate
+from utils.db import YtMediaMetadata, compile_decoder, calc_allowed_fields, filter_fields, DownloadTask, set_storage, \
+    create_db_structure, schema_definitions, PocketBaseStorage, create_entities, load_download_tasks, UnitOfWork, \
+    load_yt_media_metadata, Query
+from utils.jf import LibraryIndex
+from utils.storage import SqliteStorage
+
+
+@dataclasses.dataclass
+class DictYtMediaMetadata:
+    """YtMediaMetadata as it was before slots, to compare against."""
+    id: str
+    yt_id: str = field(metadata={'unique_key': True})
+    title: str
+    artist: str
+    category: str
+    album_name: str = ''
+    duration: int = 0
+    views_cnt: int = 0
+    thumbnail_url: str = ''
+    alt_id: str = None
+    ignore: bool = False
+    col_name = 'yt_media_metadata'
+
+
+def synthetic_yt_media_records(n):
+    return [{
+        'collectionId': 'pbc_1234567890',
+        'collectionName': 'yt_media_metadata',
+        'id': f"{i:015}",
+        'created': '2025-01-01 10:00:00.000Z',
+        'updated': '2025-01-01 10:00:00.000Z',
+        'yt_id': f"yt_{i:08}",
+        'title': f"Song title {i}",
+        'artist': f"Artist {i % 1000}",
+        'category': 'video' if i % 3 else 'song',
+        'album_name': f"Album {i % 5000}",
+        'duration': 180 + i % 120,
+        'views_cnt': i * 7,
+        'thumbnail_url': f"https://i.ytimg.com/vi/yt_{i:08}/hqdefault.jpg",
+        'alt_id': '',
+        'ignore': False,
+    } for i in range(n)]
+
+
+def measure(decode_all, recs):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    items = decode_all(recs)
+    elapsed = time.perf_counter() - start
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(items) == len(recs)
+    return elapsed, memory
+
+
+def test_bench_yt_media_metadata_decoding():
+    """Compares the generated decoder and slotted model against the per-row dict filtering into a __dict__ model."""
+    recs = synthetic_yt_media_records(100_000)
+
+    def legacy(recs):
+        allowed_fields = calc_allowed_fields(DictYtMediaMetadata)
+        return [DictYtMediaMetadata(**filter_fields(r, allowed_fields)) for r in recs]
+
+    def compiled(recs):
+        decode = compile_decoder(YtMediaMetadata)
+        return [decode(r) for r in recs]
+
+    legacy_time, legacy_mem = measure(legacy, recs)
+    compiled_time, compiled_mem = measure(compiled, recs)
+    print(f"\nDecoding {len(recs)} YtMediaMetadata records:"
+          f"\n  dict model + filter_fields: {legacy_time:.3f}s, {legacy_mem / 2 ** 20:.1f} MiB"
+          f"\n  slots model + decoder:      {compiled_time:.3f}s, {compiled_mem / 2 ** 20:.1f} MiB")
+    assert compiled_mem < legacy_mem
+
+
+def run_storage_stages(n) -> dict[str, float]:
+    """The db side of the sync stages: queueing downloads, picking pending ones, marking them, resolving metadata."""
+    timings = {}
+
+    def stage(name, fn):
+        start = time.perf_counter()
+        result = fn()
+        timings[name] = time.perf_counter() - start
+        return result
+
+    stage('create download tasks', lambda: create_entities([DownloadTask(yt_id=f"bench_{i}") for i in range(n)]))
+    stage('create media metadata', lambda: create_entities(
+        [YtMediaMetadata(**filter_fields(r, calc_allowed_fields(YtMediaMetadata)) | {'id': None})
+         for r in synthetic_yt_media_records(n)]))
+    pending = stage('load pending tasks', lambda: load_download_tasks('pending'))
+
+    def mark_downloaded():
+        with UnitOfWork().track(*pending):
+            for t in pending:
+                t.status = 'downloaded'
+
+    stage('mark tasks downloaded', mark_downloaded)
+    stage('load unresolved videos', lambda: load_yt_media_metadata(alt_id=None, category='video', ignore=False))
+    stage('lookup by key x100', lambda: [Query(YtMediaMetadata).where(yt_id=f"yt_{i:08}").first() for i in range(100)])
+    return timings
+
+
+def test_bench_storage_backends(docker_pocketbase, tmp_path):
+    """Compares the db work of the sync stages between PocketBase and the embedded sqlite storage."""
+    n = 2000
+    truncate(DownloadTask)
+    truncate(YtMediaMetadata)
+    backends = {'pocketbase': PocketBaseStorage(),
+                'sqlite': SqliteStorage(str(tmp_path / 'bench.sqlite3'), schema_definitions())}
+    timings = {}
+    try:
+        for name, storage in backends.items():
+            set_storage(storage)
+            create_db_structure()
+            timings[name] = run_storage_stages(n)
+    finally:
+        set_storage(None)
+        truncate(DownloadTask)
+        truncate(YtMediaMetadata)
+    print(f"\nDb work of the sync stages with {n} records:")
+    for stage in timings['pocketbase']:
+        print(f"  {stage:<24} pocketbase {timings['pocketbase'][stage]:7.3f}s   sqlite {timings['sqlite'][stage]:7.3f}s")
+
+
+def synthetic_library_items(n):
+    return [{
+        'Id': f"{i:032x}",
+        'Name': f"Song title {i}",
+        'Path': f"/data/music/Artist {i % 1000}/Album {i % 5000}/Song title {i} [yt_{i:08}].m4a",
+        'ProviderIds': {'YT': f"yt_{i:08}"} if i % 4 else {},
+    } for i in range(n)]
+
+
+def test_bench_library_index_reconciliation():
+    """Matches downloaded files to library items with a linear scan per file and with a LibraryIndex."""
+    items = synthetic_library_items(100_000)
+    downloaded = [basename(items[i]['Path']) for i in range(0, len(items), 1000)]
+
+    start = time.perf_counter()
+    scanned = [next((i for i in items if basename(i['Path']) == filename), None) for filename in downloaded]
+    scan_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    library = LibraryIndex(items, r'(?<=\[)yt_\d+(?=\])')
+    indexed = [library.by_basename.get(filename) for filename in downloaded]
+    index_time = time.perf_counter() - start
+
+    print(f"\nMatching {len(downloaded)} downloaded files against {len(items)} library items:"
+          f"\n  linear scan per file: {scan_time:.3f}s"
+          f"\n  LibraryIndex:         {index_time:.3f}s (including the build)")
+    assert indexed == scanned
+    assert len(library.by_path_yt_id) == 25_000
@@ -12,10 +12,12 @@ from docker.types import Mount
 
 import main
 from test.config import Config
-from test.helpers import populate_db, get_test_user_session, requests_retry_session, setup_jf_library, truncate
-from utils import db
-from utils.db import get_db_session, DownloadTask
-from utils.jf import get_current_user
+from test.helpers import populate_db, get_test_user_session, requests_retry_session, setup_jf_library, truncate, FakeJellyfinClient, \
+    FakeJellyfinServer
+from utils import db, jf_playlist_cache, jf_snapshot
+from utils.db import get_db_session, DownloadTask, schema_definitions, set_storage, create_db_structure
+from utils.jf import get_current_user, use_client
+from utils.storage import SqliteStorage
 
 
 @contextmanager
@@ -145,4 +147,33 @@ def no_downloads():
 
 @pytest.fixture
 def ffmpeg():
-    main.install_ffmpeg()
\ No newline at end of file
+    main.install_ffmpeg()
+
+
+@pytest.fixture
+def sqlite_storage(tmp_path):
+    s = SqliteStorage(str(tmp_path / 'db.sqlite3'), schema_definitions())
+    set_storage(s)
+    create_db_structure()
+    try:
+        yield s
+    finally:
+        set_storage(None)
+
+
+@pytest.fixture
+def fake_jf(tmp_path, monkeypatch):
+    """An empty FakeJellyfinClient as the current client, the files it is cached into are kept in tmp_path."""
+    monkeypatch.setattr(vars(jf_playlist_cache)['__config'], 'dir', str(tmp_path / 'jf_playlists'))
+    monkeypatch.setattr(vars(jf_snapshot)['__config'], 'dir', str(tmp_path / 'jf_snapshot'))
+    client = FakeJellyfinClient()
+    with use_client(client):
+        yield client
+
+
+@pytest.fixture
+def fake_jf_server(monkeypatch):
+    """A FakeJellyfinServer behind every session created within the test."""
+    server = FakeJellyfinServer()
+    monkeypatch.setattr('utils.http.create_adapter', lambda *args: server)
+    return server
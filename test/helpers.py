@@ -1,20 +1,26 @@
+import copy
 import io
 import json
 import os
+import re
 import tarfile
+import threading
 import time
+from collections import defaultdict
 from dataclasses import asdict
+from datetime import datetime, timezone, timedelta
+from urllib.parse import urlparse, parse_qs
 
 import requests
 from docker.models.containers import Container
 from pyyoutube import Client
-from requests.adapters import HTTPAdapter
+from requests.adapters import HTTPAdapter, BaseAdapter
 from urllib3 import Retry
 
 from test.config import Config
 from utils.common import root_dir
-from utils.db import GUser, get_db_session, YtAutomatedPlaylist, load_yt_automated_playbooks, Settings, load_settings
-from utils.jf import get_user_session, load_all_playlists, remove_item, load_all_items, reload_library
+from utils.db import GUser, get_db_session, YtAutomatedPlaylist, load_yt_automated_playbooks, Settings, invalidate_cache
+from utils.jf import get_user_session, load_all_playlists, remove_item, load_all_items, reload_library, JellyfinClient, User
 
 
 def populate_db():
@@ -33,6 +39,7 @@ def populate_db():
 def insert(obj):
     url = f"{Config.PocketBase.url}/api/collections/{obj.col_name}/records"
     resp = get_db_session().post(url, json=asdict(obj))
+    invalidate_cache(obj.col_name)
     resp.raise_for_status()
     return resp.json()['id']
 
@@ -40,11 +47,13 @@ def insert(obj):
 def delete(obj):
     url = f"{Config.PocketBase.url}/api/collections/{obj.col_name}/records/{obj.id}"
     resp = get_db_session().delete(url)
+    invalidate_cache(obj.col_name)
     resp.raise_for_status()
 
 
 def truncate(clazz):
     resp = get_db_session().delete(f"{Config.PocketBase.url}/api/collections/{clazz.col_name}/truncate")
+    invalidate_cache(clazz.col_name)
     resp.raise_for_status()
 
 
@@ -206,10 +215,198 @@ def save_settings(settings: Settings):
         val = getattr(settings, key)
         resp = get_db_session().patch(f"{url}/{entry_id}", json={"val": val})
         resp.raise_for_status()
-    load_settings.cache_clear()
+    invalidate_cache('yt_sync_settings')
 
 def get_yt_id(jf_item):
     try:
         return jf_item['ProviderIds']['YT']
     except:
-        return None
\ No newline at end of file
+        return None
+
+
+class FakeJellyfinClient(JellyfinClient):
+    """
+    In-memory Jellyfin server for the tests that do not need the container: library items by id, playlists as lists
+    of entries. `calls` records the operations, e.g. to assert what was (not) fetched again.
+    DateLastSaved comes from `clock`, which every save advances by a millisecond.
+    `files` are the audio files on the disk, a library refresh queues them for the scan and each load_all_items() call
+    (a poll) scans one of them into the library. `accepts_path_reports` = False makes it reject /Library/Media/Updated.
+    """
+
+    def __init__(self, items=(), url='http://fake-jellyfin:8096'):
+        super().__init__(url)
+        self.items = {itm['Id']: itm for itm in items}
+        self.playlists: dict[str, list[dict]] = {}
+        self.calls = []
+        self.clock = datetime(2026, 1, 1, tzinfo=timezone.utc)
+        self.files: list[str] = []
+        self.accepts_path_reports = True
+        self.__scan_queue: list[str] = []
+        self.__entry_n = 0
+
+    def now(self):
+        self.clock += timedelta(milliseconds=1)
+        return self.clock.isoformat()
+
+    def save_library_item(self, item):
+        self.items[item['Id']] = item | {'DateLastSaved': self.now()}
+
+    def create_playlist(self, ytm_pl_name, user_id, type=None):
+        pl_id = f"pl_{len(self.playlists)}"
+        self.playlists[pl_id] = []
+        self.items[pl_id] = {'Id': pl_id, 'Name': ytm_pl_name, 'Type': 'Playlist', 'DateLastSaved': self.now()}
+        return pl_id
+
+    def __playlist_changed(self, pl_id):
+        self.items[pl_id]['DateLastSaved'] = self.now()
+
+    def add_library_folder(self, path):
+        folder_id = f"folder_{len(self.items)}"
+        self.items[folder_id] = {'Id': folder_id, 'Type': 'CollectionFolder', 'Path': path, 'DateLastSaved': self.now()}
+        return folder_id
+
+    def __queue_scan(self, prefix):
+        self.__scan_queue += [f for f in self.files if f.startswith(prefix) and f not in self.__scan_queue]
+
+    def report_media_updated(self, paths, update_type="Created"):
+        self.calls.append(('report_media_updated', list(paths)))
+        if self.accepts_path_reports:
+            self.__scan_queue += [p for p in paths if p in self.files]
+        return self.accepts_path_reports
+
+    def refresh_virtual_folder(self, vf_id):
+        self.calls.append(('refresh_virtual_folder', vf_id))
+        self.__queue_scan(self.items[vf_id]['Path'].rstrip('/') + '/')
+        return True
+
+    def reload_library(self):
+        self.calls.append(('reload_library',))
+        self.__queue_scan('')
+
+    def load_all_items(self, types="", fields="", page_size=None, max_workers=None, **filters):
+        self.calls.append(('load_all_items', types, filters))
+        if self.__scan_queue:
+            path = self.__scan_queue.pop(0)
+            name = os.path.splitext(os.path.basename(path))[0]
+            self.save_library_item({'Id': f"jf_{name}", 'Type': 'Audio', 'Path': path, 'ProviderIds': {}})
+        types = set(types.split(',')) if types else None
+        ids = set(filters['Ids'].split(',')) if 'Ids' in filters else None
+        since = datetime.fromisoformat(filters['MinDateLastSaved']) if 'MinDateLastSaved' in filters else None
+        found = []
+        for itm in self.items.values():
+            if types and itm.get('Type') not in types or ids is not None and itm['Id'] not in ids:
+                continue
+            if since and datetime.fromisoformat(itm['DateLastSaved']) < since:
+                continue
+            if itm.get('Type') == 'Playlist':
+                itm = itm | {'ChildCount': len(self.playlists[itm['Id']])}
+            found.append(dict(itm))
+        return found
+
+    def iter_all_items(self, types="", fields="", page_size=None, **filters):
+        return iter(self.load_all_items(types, fields, **filters))
+
+    def load_playlist_page(self, pl_id, user_id, start, limit, fields=""):
+        self.calls.append(('load_playlist_page', pl_id, start, limit))
+        entries = self.playlists[pl_id]
+        return {'Items': [dict(e) for e in entries[start:start + limit]], 'TotalRecordCount': len(entries)}
+
+    def iter_playlist_items(self, pl_id, user_id, fields="", page_size=None):
+        return iter(self.load_playlist_page(pl_id, user_id, 0, len(self.playlists[pl_id]), fields)['Items'])
+
+    def stamp_provider_ids(self, stamps: dict[str, dict[str, str]], max_workers=None) -> dict[str, bool]:
+        self.calls.append(('stamp_provider_ids', stamps))
+        for item_id, provider_ids in stamps.items():
+            self.save_library_item(self.items[item_id] | {'ProviderIds': self.items[item_id].get('ProviderIds', {}) | provider_ids})
+        return dict.fromkeys(stamps, True)
+
+    def add_media_ids_to_playlist(self, pl_id, media_ids, user_id, max_workers=1) -> dict[str, bool]:
+        self.calls.append(('add_media_ids_to_playlist', pl_id, list(media_ids)))
+        for item_id in media_ids:
+            self.__entry_n += 1
+            self.playlists[pl_id].append({'Id': item_id, 'PlaylistItemId': f"entry_{self.__entry_n}",
+                                          'ProviderIds': dict(self.items[item_id].get('ProviderIds', {}))})
+        self.__playlist_changed(pl_id)
+        return dict.fromkeys(media_ids, True)
+
+    def remove_playlist_entries(self, pl_id, entry_ids) -> dict[str, bool]:
+        entry_ids = set(entry_ids)
+        self.playlists[pl_id] = [e for e in self.playlists[pl_id] if e['PlaylistItemId'] not in entry_ids]
+        self.__playlist_changed(pl_id)
+        return dict.fromkeys(entry_ids, True)
+
+    def find_user_by_name(self, name):
+        return User('fake_user_id', name, {})
+
+
+class FakeJellyfinServer(BaseAdapter):
+    """
+    requests transport answering a few Jellyfin endpoints from memory, so the JellyfinClient code runs as it is.
+    Tokens are the logged in `users` and the `api_key`. Saves and playlist additions of the `fail_ids` answer 500,
+    so do the /Items pages starting at `failing_pages`. `requests` records (method, path, params) of every call.
+    """
+
+    def __init__(self, items=(), api_key='api_key'):
+        super().__init__()
+        self.items = {itm['Id']: itm for itm in items}
+        self.playlists: dict[str, list[str]] = defaultdict(list)
+        self.users: dict[str, str] = {}
+        self.tokens: dict[str, str | None] = {api_key: None}
+        self.fail_ids = set()
+        self.failing_pages = set()
+        self.requests = []
+        self.logins = 0
+        self.__lock = threading.Lock()
+
+    def send(self, request, **kwargs):
+        url = urlparse(request.url)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        body = json.loads(request.body) if request.body else None
+        with self.__lock:
+            self.requests.append((request.method, url.path, params))
+            status, data = self.__handle(request.method, url.path, params, body, request.headers.get('X-Emby-Token'))
+        resp = requests.Response()
+        resp.status_code = status
+        resp._content = json.dumps(data).encode() if data is not None else b''
+        resp.request = request
+        resp.url = request.url
+        return resp
+
+    def close(self):
+        pass
+
+    def __handle(self, method, path, params, body, token):
+        if path == '/Users/AuthenticateByName':
+            if body['Username'] not in self.users or self.users[body['Username']] != body['Pw']:
+                return 401, None
+            self.logins += 1
+            token = f"token_{self.logins}"
+            self.tokens[token] = body['Username']
+            return 200, {'AccessToken': token}
+        if token not in self.tokens:
+            return 401, None
+        if path == '/Users/Me':
+            return 200, {'Id': f"id_{self.tokens[token]}", 'Name': self.tokens[token]}
+        if method == 'GET' and path == '/Items/':
+            start, limit = int(params['StartIndex']), int(params['Limit'])
+            if start in self.failing_pages:
+                return 500, None
+            items = list(self.items.values())
+            if 'Ids' in params:
+                items = [self.items[i] for i in params['Ids'].split(',') if i in self.items]
+            page = {'Items': copy.deepcopy(items[start:start + limit])}
+            if params.get('EnableTotalRecordCount') == 'true':
+                page['TotalRecordCount'] = len(items)
+            return 200, page
+        if method == 'POST' and (m := re.fullmatch(r'/Items/(\w+)', path)):
+            if m[1] in self.fail_ids:
+                return 500, None
+            self.items[m[1]] = body
+            return 204, None
+        if method == 'POST' and (m := re.fullmatch(r'/playlists/(\w+)/Items', path)):
+            ids = params['ids'].split(',')
+            if self.fail_ids.intersection(ids):
+                return 500, None
+            self.playlists[m[1]] += ids
+            return 204, None
+        return 404, None
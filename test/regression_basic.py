@@ -1,13 +1,16 @@
 import os
+import time
 
 import requests
+import yt_dlp
 
 from main import install_ffmpeg
 from test.config import Config
 from test.helpers import get_test_user_session, save_settings
 from utils.db import get_db_session, load_settings
 from utils.jf import create_playlist, load_all_playlists, reload_library
-from utils.ytm import load_flat_playlist
+from utils.playlist_diff import PlaylistEntry, plan_removals, plan_moves
+from utils.ytm import load_flat_playlist, load_flat_playlists, ExtractorPool
 
 
 def test_pb_container(docker_pocketbase):
@@ -48,6 +51,39 @@ def test_yt_read_playlist_flat():
     assert pl is not None, "Failed to load YT playlist"
     assert pl['title'] == 'test_1', f"Unexpected playlist title: {pl['title']}"
 
+
+def test_yt_read_playlists_flat():
+    """Can read several YT playlists at once, a failing one is left out."""
+    pls = load_flat_playlists([Config.Playlists.yt_src_id, 'PL_does_not_exist'], load_entries=False)
+    assert list(pls) == [Config.Playlists.yt_src_id], f"Unexpected playlists: {list(pls)}"
+    assert pls[Config.Playlists.yt_src_id]['title'] == 'test_1'
+
+def test_yt_read_playlists_flat_offline(monkeypatch, caplog):
+    """At most the pool size of yt-dlp instances serve the loads, a failing playlist is logged, close() closes them."""
+    pool = ExtractorPool({'extract_flat': True}, 2)
+    monkeypatch.setattr('utils.ytm.flat_playlist_extractors', lambda: pool)
+    used = set()
+    closed = []
+
+    def extract_info(ydl, url, download=True, process=True):
+        used.add(id(ydl))
+        time.sleep(0.01)
+        pl_id = url.rsplit('=', 1)[1]
+        if pl_id == 'PL_bad':
+            raise yt_dlp.utils.DownloadError("The playlist does not exist")
+        return {'id': pl_id, 'title': pl_id}
+
+    monkeypatch.setattr(yt_dlp.YoutubeDL, 'extract_info', extract_info)
+    monkeypatch.setattr(yt_dlp.YoutubeDL, 'close', lambda ydl: closed.append(id(ydl)))
+    ids = [f"PL_{i}" for i in range(6)]
+    pls = load_flat_playlists(ids + ['PL_bad'], load_entries=False, max_workers=4)
+    assert list(pls) == ids and pls['PL_3']['title'] == 'PL_3'
+    assert 0 < len(used) <= 2
+    assert "1 of 7 YT playlists could not be loaded: ['PL_bad']" in caplog.text
+    pool.close()
+    assert sorted(closed) == sorted(used)
+
+
 def test_update_settings():
     """Can update settings in the database."""
     settings = load_settings()
@@ -65,4 +101,20 @@ def test_ffmpeg():
     install_ffmpeg()
     status = os.system("ffmpeg --help")
     print(f"ffmpeg status: {status}")
-    assert status == 0
\ No newline at end of file
+    assert status == 0
+
+
+def test_playlist_diff():
+    """Mirroring plan removes what is gone from YT and reorders with the fewest moves."""
+    yt_ids = ['a', 'b', 'c', 'd', 'e']
+    entries = [PlaylistEntry(f"e{i}", f"j{i}", yt_id) for i, yt_id in enumerate(['b', 'x', 'a', None, 'c', 'b', 'e', 'd'])]
+    assert plan_removals(entries, yt_ids) == ['e1', 'e5']
+
+    entries = [e for e in entries if e.entry_id not in ('e1', 'e5')]
+    moves = plan_moves(entries, yt_ids)
+    assert len(moves) == 2
+    for entry_id, index in moves:
+        entry = next(e for e in entries if e.entry_id == entry_id)
+        entries.remove(entry)
+        entries.insert(index, entry)
+    assert [e.yt_id for e in entries] == ['a', 'b', None, 'c', 'd', 'e']
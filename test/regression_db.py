@@ -0,0 +1,202 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from test.helpers import truncate
+from utils.db import DownloadTask, create_entities, CreateOpResult, load_download_tasks, create_download_task, BulkWriter, Query, UnitOfWork, \
+    create_db_structure, load_meta_value, SCHEMA_FINGERPRINT_KEY, schema_fingerprint, schema_definitions, get_db_session, \
+    YtMediaMetadata, load_yt_media_metadata, load_settings, default_settings, iter_download_tasks, quote_filter_value, \
+    pb_filter_expr
+from utils.indexed_store import yt_media_metadata_store
+from utils.replica import Replica
+from utils.storage import WriteOp, format_db_datetime
+
+
+def test_bulk_create_download_tasks(docker_pocketbase):
+    """Bulk creation reports created and duplicate records and assigns ids."""
+    truncate(DownloadTask)
+    assert create_download_task(DownloadTask(yt_id='existing_id')) == CreateOpResult.CREATED
+    tasks = [DownloadTask(yt_id=f'bulk_{i}') for i in range(120)] + [DownloadTask(yt_id='existing_id'), DownloadTask(yt_id='bulk_0')]
+    results = create_entities(tasks)
+    assert results[:120] == [CreateOpResult.CREATED] * 120, "All new tasks should be created"
+    assert results[120:] == [CreateOpResult.DUPLICATE] * 2, "Tasks with existing yt_id should be reported as duplicates"
+    assert all(t.id for t in tasks[:120]), "Created tasks should get their db ids"
+    assert len(load_download_tasks()) == 121
+
+
+def test_bulk_writer_upsert(docker_pocketbase):
+    """Upsert updates records that already exist."""
+    truncate(DownloadTask)
+    create_download_task(DownloadTask(yt_id='upsert_id'))
+    writer = BulkWriter(upsert=True)
+    writer.add(DownloadTask(yt_id='upsert_id', status='downloaded'))
+    writer.add(DownloadTask(yt_id='new_id'))
+    assert [r for _, r in writer.flush()] == [CreateOpResult.UPDATED, CreateOpResult.CREATED]
+    assert {t.yt_id: t.status for t in load_download_tasks()} == {'upsert_id': 'downloaded', 'new_id': 'pending'}
+
+
+def test_query_filter_projection_sort(docker_pocketbase):
+    """Queries are filtered, projected, sorted and limited on the server and escape their values."""
+    truncate(DownloadTask)
+    create_entities([DownloadTask(yt_id=f"q_{i:03}", status='pending' if i % 2 else 'downloaded') for i in range(700)]
+                    + [DownloadTask(yt_id="it's_quoted")])
+    pending = load_download_tasks('pending')
+    assert len(pending) == 350 and all(t.status == 'pending' for t in pending)
+    last = Query(DownloadTask).where(status='downloaded', yt_id__like='q_').only('yt_id').order_by('-yt_id').limit(2).all()
+    assert [t.yt_id for t in last] == ['q_698', 'q_696']
+    assert Query(DownloadTask).where(yt_id="it's_quoted").first().yt_id == "it's_quoted"
+
+
+def test_query_iter_streams_all_pages(docker_pocketbase):
+    """The streaming query yields the same models as the list one, across several pages."""
+    truncate(DownloadTask)
+    create_entities([DownloadTask(yt_id=f"it_{i:04}") for i in range(1234)])
+    query = Query(DownloadTask).order_by('yt_id')
+    assert [t.yt_id for t in query.iter()] == [t.yt_id for t in query.all()]
+    assert len(list(iter_download_tasks('pending'))) == 1234
+    assert [t.yt_id for t in query.limit(3).iter()] == ['it_0000', 'it_0001', 'it_0002']
+
+
+def test_unit_of_work_saves_changed_fields(docker_pocketbase):
+    """Only entities with changed fields are written when the unit of work is flushed."""
+    truncate(DownloadTask)
+    create_entities([DownloadTask(yt_id=f'uow_{i}') for i in range(5)])
+    tasks = load_download_tasks()
+    with UnitOfWork().track(*tasks) as uow:
+        tasks[0].status = 'downloaded'
+        tasks[0].path = '/tmp/uow_0.m4a'
+        assert uow.changes(tasks[0]) == {'status': 'downloaded', 'path': '/tmp/uow_0.m4a'}
+        assert uow.changes(tasks[1]) == {}
+    downloaded = load_download_tasks('downloaded')
+    assert [(t.yt_id, t.path) for t in downloaded] == [('uow_0', '/tmp/uow_0.m4a')]
+    assert uow.flush() == 0, "Nothing is left to save after the flush"
+
+
+def test_create_db_structure_is_skipped_when_schema_is_unchanged(docker_pocketbase):
+    """A second structure setup only reads the stored schema fingerprint."""
+    create_db_structure()
+    assert load_meta_value(SCHEMA_FINGERPRINT_KEY) == schema_fingerprint(schema_definitions())
+    calls = []
+    session = get_db_session()
+    original_request = session.request
+    session.request = lambda method, url, *args, **kwargs: calls.append((method, url)) or original_request(method, url, *args, **kwargs)
+    try:
+        create_db_structure()
+    finally:
+        session.request = original_request
+    assert len(calls) == 1 and calls[0][0] == 'GET', f"Only the fingerprint should be read, got {calls}"
+
+
+def test_sqlite_storage_bulk_create_and_query(sqlite_storage):
+    """The sqlite backend reports duplicates by the unique key indexes and supports the same queries."""
+    tasks = [DownloadTask(yt_id=f"q_{i:03}", status='pending' if i % 2 else 'downloaded') for i in range(700)]
+    results = create_entities(tasks + [DownloadTask(yt_id="it's_quoted"), DownloadTask(yt_id='q_000')])
+    assert results == [CreateOpResult.CREATED] * 701 + [CreateOpResult.DUPLICATE]
+    assert create_download_task(DownloadTask(yt_id='q_001')) == CreateOpResult.DUPLICATE
+    assert len(load_download_tasks('pending')) == 351
+    last = Query(DownloadTask).where(status='downloaded', yt_id__like='q_').only('yt_id').order_by('-yt_id').limit(2).all()
+    assert [t.yt_id for t in last] == ['q_698', 'q_696']
+    assert Query(DownloadTask).where(yt_id="it's_quoted").first().yt_id == "it's_quoted"
+
+
+def test_sqlite_storage_updates(sqlite_storage):
+    """Changed fields are saved and missing values match None, the way PocketBase stores them."""
+    mm = YtMediaMetadata(id=None, yt_id='vid', title='Title', artist='Artist', category='video')
+    create_entities([mm])
+    assert [m.yt_id for m in load_yt_media_metadata(alt_id=None, ignore=False)] == ['vid']
+    with UnitOfWork().track(mm):
+        mm.alt_id = 'song'
+    assert load_yt_media_metadata(alt_id=None) == []
+    assert load_yt_media_metadata(yt_id='vid')[0].alt_id == 'song'
+    assert load_settings().wait_time == default_settings().wait_time
+
+
+def test_unit_of_work_raises_on_failed_save(sqlite_storage):
+    """A failed save is raised, the saved entities are not saved again."""
+    tasks = [DownloadTask(yt_id='uow_1'), DownloadTask(yt_id='uow_2')]
+    create_entities(tasks)
+    uow = UnitOfWork().track(*tasks)
+    tasks[0].status = 'downloaded'
+    tasks[1].yt_id = 'uow_1'
+    with pytest.raises(RuntimeError, match=r"Cannot save 1 out of 2"):
+        uow.flush()
+    assert uow.changes(tasks[0]) == {}
+    assert {t.yt_id: t.status for t in load_download_tasks()} == {'uow_1': 'downloaded', 'uow_2': 'pending'}
+
+
+def test_yt_media_metadata_store_follows_saves(sqlite_storage):
+    """The indexed metadata store answers lookups from memory and follows the entities created or saved later."""
+    create_entities([YtMediaMetadata(id=None, yt_id=f"v{i}", title='Title', artist='Artist', category='video' if i % 2 else 'song')
+                     for i in range(10)])
+    store = yt_media_metadata_store().refresh()
+    assert sorted(m.yt_id for m in store.find(alt_id=None, category='video')) == ['v1', 'v3', 'v5', 'v7', 'v9']
+    mm = store.get('v5')
+    with UnitOfWork().track(mm):
+        mm.alt_id = 's5'
+    create_entities([YtMediaMetadata(id=None, yt_id='v11', title='Title', artist='Artist', category='video')])
+    assert sorted(m.yt_id for m in store.find(alt_id=None, category='video')) == ['v1', 'v11', 'v3', 'v7', 'v9']
+    assert [m.yt_id for m in store.find(alt_id='s5')] == ['v5']
+
+
+def test_replica_follows_the_db(sqlite_storage, tmp_path, monkeypatch):
+    """
+    A restarted replica fetches the records updated since its cursor minus the overlap, deleted records go away when
+    reconciled and the replica of another db is thrown away.
+    """
+    monkeypatch.setattr(sqlite_storage, 'remote', True)
+
+    def set_status(task, status, updated):
+        sqlite_storage.connection().execute('UPDATE "download_task" SET status = ?, updated = ? WHERE id = ?',
+                                            [status, format_db_datetime(updated), task.id])
+
+    tasks = [DownloadTask(yt_id=f"r_{i}") for i in range(3)]
+    create_entities(tasks)
+    path = str(tmp_path / 'replica.json')
+    replica = Replica(DownloadTask, path, reconcile_interval=3600)
+    assert len(replica.all()) == 3
+    cursor = datetime.fromisoformat(replica.cursor)
+
+    # Committed out of `updated` order, within the overlap
+    set_status(tasks[0], 'downloaded', cursor - timedelta(seconds=3))
+    # Older than the overlap, the previous refresh must have seen it already, so it is not asked for
+    set_status(tasks[1], 'downloaded', cursor - timedelta(seconds=10))
+    create_entities([DownloadTask(yt_id='r_new')])
+    sqlite_storage.write([WriteOp('delete', DownloadTask.col_name, tasks[2].id)])
+
+    restarted = Replica(DownloadTask, path, reconcile_interval=3600)
+    assert {t.yt_id: t.status for t in restarted.all()} == {'r_0': 'downloaded', 'r_1': 'pending', 'r_2': 'pending',
+                                                            'r_new': 'pending'}
+    restarted.reconcile()
+    assert {t.yt_id for t in restarted.all()} == {'r_0', 'r_1', 'r_new'}
+
+    monkeypatch.setattr('utils.replica.get_db_url', lambda: 'http://another-db')
+    rebuilt = Replica(DownloadTask, path, reconcile_interval=3600)
+    assert {t.yt_id: t.status for t in rebuilt.all()} == {'r_0': 'downloaded', 'r_1': 'downloaded', 'r_new': 'pending'}
+
+
+def test_replica_refresh_without_changes_is_cheap(sqlite_storage, tmp_path, monkeypatch):
+    """Nothing changed: the replica is neither loaded in full nor written again, an empty collection included."""
+    monkeypatch.setattr(sqlite_storage, 'remote', True)
+    create_entities([DownloadTask(yt_id=f"r_{i}") for i in range(3)])
+    path = tmp_path / 'replica.json'
+    replica = Replica(DownloadTask, str(path), reconcile_interval=3600)
+    empty = Replica(YtMediaMetadata, str(tmp_path / 'empty.json'), reconcile_interval=3600)
+    assert len(replica.all()) == 3 and empty.all() == []
+    assert empty.cursor is not None
+    path.unlink()
+
+    def iter_records(*args, **kwargs):
+        raise AssertionError("The replica was loaded in full")
+
+    monkeypatch.setattr(Query, 'iter_records', iter_records)
+    assert len(replica.all()) == 3 and empty.all() == []
+    assert not path.exists()
+
+
+def test_quote_filter_value():
+    """Quotes are escaped, other backslashes stay literal for PocketBase, a trailing one cannot be expressed."""
+    assert quote_filter_value("it's") == r"'it\'s'"
+    assert quote_filter_value(r"C:\music\it's") == r"'C:\music\it\'s'"
+    assert pb_filter_expr([('yt_id', 'in', ['a', None])]) == "((yt_id = 'a' || yt_id = null))"
+    with pytest.raises(ValueError):
+        quote_filter_value('C:\\music\\')
@@ -0,0 +1,318 @@
+import asyncio
+import dataclasses
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import httpx
+import pytest
+import requests
+
+import sync
+from sync import update_yt_ids_in_db, process_library_changes
+from test.helpers import FakeJellyfinClient
+from utils.cycle import CycleContext, compile_regex
+from utils.db import DownloadTask, PlaylistConfigResp, create_entities, load_download_tasks, default_settings
+from utils.jf import JellyfinClient, User, get_current_user, use_client
+from utils.jf_async import AsyncJellyfinClient
+from utils.jf_events import LibraryChange
+from utils.jf_playlist_cache import PlaylistMembershipCache
+from utils.jf_snapshot import LibrarySnapshot, WATERMARK_OVERLAP
+
+
+def audio(n, yt_id=None):
+    return {'Id': f"jf_{n}", 'Name': f"Song {n}", 'Type': 'Audio', 'Path': f"/music/song_{n}.m4a",
+            'ProviderIds': {'YT': yt_id} if yt_id else {}}
+
+
+def test_playlist_membership_is_restored_by_the_next_run(tmp_path):
+    """The next process reads the playlists from the disk, only the ones changed meanwhile are fetched again."""
+    jf = FakeJellyfinClient([audio(i, f"yt_{i}") for i in range(5)])
+    pl_1 = jf.create_playlist('one', 'user')
+    pl_2 = jf.create_playlist('two', 'user')
+    jf.add_media_ids_to_playlist(pl_1, ['jf_0', 'jf_1'], 'user')
+    jf.add_media_ids_to_playlist(pl_2, ['jf_2'], 'user')
+    path = str(tmp_path / 'playlists.json')
+
+    cache = PlaylistMembershipCache(jf, path)
+    cache.revalidate([pl_1, pl_2])
+    assert cache.yt_ids(pl_1, 'user') == {'yt_0', 'yt_1'}
+    assert cache.yt_ids(pl_2, 'user') == {'yt_2'}
+    jf.add_media_ids_to_playlist(pl_1, ['jf_3'], 'user')
+    cache.record_added(pl_1, {'jf_3': 'yt_3'})
+    cache.save()
+
+    # Someone swaps a song of the first playlist until the next run, its ChildCount stays the same
+    jf.remove_playlist_entries(pl_1, [jf.playlists[pl_1][0]['PlaylistItemId']])
+    jf.add_media_ids_to_playlist(pl_1, ['jf_4'], 'user')
+    jf.calls.clear()
+
+    restarted = PlaylistMembershipCache(jf, path)
+    restarted.revalidate([pl_1, pl_2])
+    assert restarted.yt_ids(pl_1, 'user') == {'yt_1', 'yt_3', 'yt_4'}
+    assert restarted.yt_ids(pl_2, 'user') == {'yt_2'}
+    assert [c[1] for c in jf.calls if c[0] == 'load_playlist_page'] == [pl_1]
+    assert len([c for c in jf.calls if c[0] == 'load_all_items']) == 1, "The reload reuses the validators of revalidate()"
+
+
+def test_library_change_merge():
+    """A later message wins: an item added, removed and re-added is added, one updated and then removed is removed."""
+    change = LibraryChange(added={'a'}, updated={'u'})
+    change = change.merge(LibraryChange(removed={'a', 'u'}))
+    assert change == LibraryChange(removed={'a', 'u'})
+    change = change.merge(LibraryChange(added={'a'}))
+    assert change == LibraryChange(added={'a'}, removed={'u'})
+    assert not LibraryChange().merge(LibraryChange())
+
+
+def test_update_yt_ids_in_db_stamps_only_the_given_items(sqlite_storage, fake_jf):
+    """The downloads of other files are left for the next cycle."""
+    create_entities([DownloadTask(yt_id=f"yt_{i}", path=f"/downloads/song_{i}.m4a", status='downloaded') for i in (1, 2)])
+    fake_jf.items = {itm['Id']: itm for itm in (audio(1), audio(2))}
+
+    assert update_yt_ids_in_db([audio(3)]) == {}
+    assert update_yt_ids_in_db([audio(1)]) == {'jf_1': 'yt_1'}
+    assert [c[1] for c in fake_jf.calls if c[0] == 'stamp_provider_ids'] == [{'jf_1': {'YT': 'yt_1'}}]
+    assert {t.yt_id: t.status for t in load_download_tasks()} == {'yt_1': 'imported', 'yt_2': 'downloaded'}
+
+
+def test_library_changes_are_added_into_the_synced_playlists(sqlite_storage, fake_jf, monkeypatch):
+    """An imported download gets its YT id and lands in the playlists that had the YT id at their last sync."""
+    fake_jf.items = {itm['Id']: itm for itm in (audio(1, 'yt_1'), audio(2), audio(3, 'yt_3'))}
+    synced = fake_jf.create_playlist('synced', 'user')
+    not_synced_yet = fake_jf.create_playlist('not synced yet', 'user')
+    fake_jf.add_media_ids_to_playlist(synced, ['jf_1'], 'user')
+    create_entities([PlaylistConfigResp(id=None, jf_pl_id=pl_id, jf_pl_name=pl_id, ytm_pl_id=f"yt_{pl_id}",
+                                        ytm_pl_name=pl_id, jf_user_name='user', sync=True)
+                     for pl_id in (synced, not_synced_yet)])
+    create_entities([DownloadTask(yt_id='yt_2', path='/downloads/song_2.m4a', status='downloaded')])
+    monkeypatch.setattr(sync, 'last_synced_yt_ids', {synced: ['yt_2', 'yt_1', 'yt_3']})
+
+    process_library_changes(LibraryChange(added={'jf_2', 'jf_3'}))
+
+    assert fake_jf.items['jf_2']['ProviderIds'] == {'YT': 'yt_2'}
+    assert load_download_tasks()[0].status == 'imported'
+    assert [e['Id'] for e in fake_jf.playlists[synced]] == ['jf_1', 'jf_2', 'jf_3']
+    assert fake_jf.playlists[not_synced_yet] == []
+
+
+def test_library_snapshot_fetches_only_the_changes(tmp_path):
+    """Items saved since the watermark (minus the overlap) are fetched, deleted ones go away when reconciled."""
+    jf = FakeJellyfinClient()
+    for i in (1, 2):
+        jf.save_library_item(audio(i))
+    path = str(tmp_path / 'snapshot.json')
+    snapshot = LibrarySnapshot(jf, 'Audio', path, reconcile_interval=3600)
+    assert {itm['Id'] for itm in snapshot.all()} == {'jf_1', 'jf_2'}
+    watermark = jf.clock
+
+    jf.save_library_item(audio(3))
+    # Saved while the previous refresh was running, DateLastSaved is older than the watermark
+    jf.items['jf_4'] = audio(4) | {'DateLastSaved': (watermark - timedelta(seconds=30)).isoformat()}
+    # Older than the overlap, the previous refresh must have seen it already, so it is not asked for
+    jf.items['jf_5'] = audio(5) | {'DateLastSaved': (watermark - timedelta(minutes=2)).isoformat()}
+    del jf.items['jf_1']
+    jf.calls.clear()
+
+    restarted = LibrarySnapshot(jf, 'Audio', path, reconcile_interval=3600)
+    assert {itm['Id'] for itm in restarted.all()} == {'jf_1', 'jf_2', 'jf_3', 'jf_4'}
+    [(_, _, filters)] = jf.calls
+    assert filters == {'MinDateLastSaved': (watermark - WATERMARK_OVERLAP).strftime('%Y-%m-%dT%H:%M:%S.%fZ')}
+
+    restarted.reconcile()
+    assert {itm['Id'] for itm in restarted.all()} == {'jf_2', 'jf_3', 'jf_4'}
+
+
+def test_library_snapshot_refresh_without_changes_is_cheap(tmp_path):
+    """Nothing saved since the last refresh: no full load and no write, callers get copies of the items."""
+    path = tmp_path / 'snapshot.json'
+    empty = LibrarySnapshot(FakeJellyfinClient(), 'Audio', str(tmp_path / 'empty.json'), reconcile_interval=3600)
+    assert empty.all() == [] and empty.watermark is not None
+    jf = FakeJellyfinClient()
+    jf.save_library_item(audio(1, 'yt_1'))
+    snapshot = LibrarySnapshot(jf, 'Audio', str(path), reconcile_interval=3600)
+    snapshot.all()[0]['ProviderIds']['YT'] = 'changed'
+    path.unlink()
+    jf.calls.clear()
+
+    assert [itm['ProviderIds'] for itm in snapshot.all()] == [{'YT': 'yt_1'}]
+    assert 'MinDateLastSaved' in jf.calls[0][2]
+    assert not path.exists()
+
+
+def test_clients_stay_logged_in_side_by_side(fake_jf_server):
+    """use_client() switches the client per context, a 401 logs the user in again on the session in use."""
+    fake_jf_server.users = {'alice': 'pw_a', 'bob': 'pw_b'}
+    alice = JellyfinClient('http://jf-a:8096')
+    bob = JellyfinClient('http://jf-b:8096')
+    session = alice.login('alice', 'pw_a')
+    bob.login('bob', 'pw_b')
+    barrier = threading.Barrier(2)
+
+    def current_user_name(client):
+        with use_client(client):
+            barrier.wait()
+            return get_current_user().name
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        assert list(executor.map(current_user_name, [alice, bob])) == ['alice', 'bob']
+    with use_client(alice):
+        with use_client(bob):
+            assert get_current_user().name == 'bob'
+        assert get_current_user().name == 'alice'
+
+    # The token of alice expires while several threads use her session
+    fake_jf_server.tokens = {t: u for t, u in fake_jf_server.tokens.items() if u != 'alice'}
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        assert set(executor.map(lambda _: alice.get_current_user().name, range(8))) == {'alice'}
+    assert alice.session is session
+    assert bob.get_current_user().name == 'bob'
+
+
+def test_async_client_pages_bounds_concurrency_and_logs_in_again(fake_jf_server):
+    """Pages after the first one are fetched concurrently, at most max_concurrency requests are in flight."""
+    fake_jf_server.users = {'alice': 'pw_a'}
+    jf = JellyfinClient('http://jf-a:8096')
+    jf.login('alice', 'pw_a')
+    items = [audio(i) for i in range(5)]
+    in_flight = []
+    max_in_flight = []
+    starts = []
+
+    async def handle(request: httpx.Request):
+        if fake_jf_server.tokens.get(request.headers.get('X-Emby-Token')) != 'alice':
+            return httpx.Response(401)
+        in_flight.append(1)
+        await asyncio.sleep(0.01)
+        max_in_flight.append(len(in_flight))
+        in_flight.pop()
+        start, limit = int(request.url.params['StartIndex']), int(request.url.params['Limit'])
+        starts.append(start)
+        return httpx.Response(200, json={'Items': items[start:start + limit], 'TotalRecordCount': len(items)})
+
+    async def run():
+        async with AsyncJellyfinClient(jf, max_concurrency=2, transport=httpx.MockTransport(handle)) as client:
+            loaded = await client.load_all_items('Audio', page_size=2)
+            assert [itm['Id'] for itm in loaded] == [f"jf_{i}" for i in range(5)]
+            assert sorted(starts) == [0, 2, 4]
+            await asyncio.gather(*(client.load_items_page({}, 0, 1) for _ in range(6)))
+            # Her token expires, the pages are read with the token of the next login
+            fake_jf_server.tokens.clear()
+            assert len(await client.load_all_items('Audio', page_size=10)) == 5
+
+    asyncio.run(run())
+    assert max(max_in_flight) == 2
+    assert fake_jf_server.logins == 2
+
+
+def test_library_refresh_modes(monkeypatch):
+    """Each mode scans what it covers, a rejected targeted mode falls back to a broader one, the wait is bounded."""
+    monkeypatch.setattr('utils.jf.__jf_library_refresh_poll__', 0)
+    monkeypatch.setattr('utils.jf.__jf_library_full_refresh_interval__', 0)
+
+    def refresh(mode, paths, folder='/music', accepts_path_reports=True):
+        jf = FakeJellyfinClient()
+        jf.clock = datetime.now(timezone.utc)
+        jf.files = ['/music/a.m4a', '/music/b.m4a', '/other/c.m4a']
+        music = jf.add_library_folder('/music')
+        jf.accepts_path_reports = accepts_path_reports
+        missing = jf.refresh_library(paths, folder=folder, mode=mode, timeout=0.05)
+        scanned = {itm['Path'] for itm in jf.items.values() if itm['Type'] == 'Audio'}
+        return missing, scanned, [c for c in jf.calls if c[0] != 'load_all_items'], music
+
+    missing, scanned, calls, _ = refresh('paths', ['/music/a.m4a'])
+    assert (missing, scanned, calls) == (set(), {'/music/a.m4a'}, [('report_media_updated', ['/music/a.m4a'])])
+
+    missing, scanned, calls, music = refresh('paths', ['/music/a.m4a'], accepts_path_reports=False)
+    assert (missing, scanned) == (set(), {'/music/a.m4a'})
+    assert calls[1:] == [('refresh_virtual_folder', music)]
+
+    missing, scanned, calls, _ = refresh('folder', ['/music/a.m4a'], folder='/not/in/library')
+    assert (missing, scanned, calls) == (set(), {'/music/a.m4a'}, [('reload_library',)])
+
+    missing, scanned, calls, _ = refresh('full', ['/music/a.m4a', '/music/never_downloaded.m4a'])
+    assert missing == {'/music/never_downloaded.m4a'} and calls == [('reload_library',)]
+
+
+def test_library_refresh_runs_full_periodically(monkeypatch):
+    """The first refresh and then one per interval is full, so files added outside of the sync get into the library."""
+    monkeypatch.setattr('utils.jf.__jf_library_refresh_poll__', 0)
+    monkeypatch.setattr('utils.jf.__jf_library_full_refresh_interval__', 3600)
+    jf = FakeJellyfinClient()
+    jf.clock = datetime.now(timezone.utc)
+    jf.files = ['/music/a.m4a', '/music/b.m4a']
+    for _ in range(2):
+        jf.refresh_library(['/music/a.m4a'], folder='/music', mode='paths', timeout=0.05)
+    assert [c[0] for c in jf.calls if c[0] != 'load_all_items'] == ['reload_library', 'report_media_updated']
+
+
+def test_paging_edges(fake_jf_server):
+    """Whole pages, a short last page and no items at all load completely, a failed page fails the whole load."""
+    jf = JellyfinClient('http://jf-a:8096', api_key='api_key')
+    for count in (0, 3, 4):
+        fake_jf_server.items = {f"jf_{i}": audio(i) for i in range(count)}
+        expected = [f"jf_{i}" for i in range(count)]
+        fake_jf_server.requests.clear()
+        assert [itm['Id'] for itm in jf.load_all_items('Audio', page_size=2, max_workers=2)] == expected
+        # The total tells which pages there are, none is asked for in vain
+        assert sorted(int(r[2]['StartIndex']) for r in fake_jf_server.requests) == list(range(0, max(count, 1), 2))
+        assert [itm['Id'] for itm in jf.iter_all_items('Audio', page_size=2)] == expected
+
+    fake_jf_server.failing_pages = {2}
+    with pytest.raises(requests.HTTPError):
+        jf.load_all_items('Audio', page_size=2)
+    with pytest.raises(requests.HTTPError):
+        list(jf.iter_all_items('Audio', page_size=2))
+
+
+def test_stamp_provider_ids_reports_each_item(fake_jf_server, caplog):
+    """A rejected save fails only its own item, and it is logged."""
+    fake_jf_server.items = {itm['Id']: itm for itm in (audio(0), audio(1), audio(2, 'yt_other'), audio(3, 'yt_3'))}
+    fake_jf_server.fail_ids = {'jf_1'}
+    jf = JellyfinClient('http://jf-a:8096', api_key='api_key')
+
+    stamps = {f"jf_{i}": {'YT': f"yt_{i}"} for i in range(5)}
+    assert jf.stamp_provider_ids(stamps, max_workers=3) == {'jf_0': True, 'jf_1': False, 'jf_2': False, 'jf_3': True,
+                                                            'jf_4': False}
+    assert fake_jf_server.items['jf_0']['ProviderIds'] == {'YT': 'yt_0'}
+    assert sorted(p for m, p, _ in fake_jf_server.requests if m == 'POST') == ['/Items/jf_0', '/Items/jf_1']
+    assert "Jellyfin did not save provider ids {'YT': 'yt_1'} for 'Song 1' (jf_1)" in caplog.text
+
+
+def test_add_media_ids_to_playlist_isolates_the_failing_id(fake_jf_server, monkeypatch):
+    """Chunks fit the url length limit, a failing chunk is split until only the failing id is left out."""
+    jf = JellyfinClient('http://jf-a:8096', api_key='api_key')
+    base_url_length = len("http://jf-a:8096/playlists/pl/Items?userId=user&ids=")
+    # Room for 4 ids of 4 chars, each with an encoded comma
+    monkeypatch.setattr('utils.jf.__jf_max_url_length__', base_url_length + 4 * 7)
+    fake_jf_server.fail_ids = {'jf_5'}
+    ids = [f"jf_{i}" for i in range(8)]
+
+    results = jf.add_media_ids_to_playlist('pl', ids + ['jf_1'], 'user')
+
+    assert results == {media_id: media_id != 'jf_5' for media_id in ids}
+    assert fake_jf_server.playlists['pl'] == ['jf_0', 'jf_1', 'jf_2', 'jf_3', 'jf_4', 'jf_6', 'jf_7']
+    assert [p['ids'] for _, _, p in fake_jf_server.requests] == [
+        'jf_0,jf_1,jf_2,jf_3', 'jf_4,jf_5,jf_6,jf_7', 'jf_4,jf_5', 'jf_4', 'jf_5', 'jf_6,jf_7']
+
+
+def test_cycle_context_resolves_each_constant_once(monkeypatch):
+    """Paths are converted with the settings of the cycle, the patterns are compiled and the user found once."""
+    compiled = []
+    monkeypatch.setattr('utils.cycle.compile_regex', lambda regex: compiled.append(regex) or compile_regex(regex))
+    jf = FakeJellyfinClient()
+    found = []
+    monkeypatch.setattr(jf, 'find_user_by_name', lambda name: found.append(name) or User('id', name, {}))
+    settings = dataclasses.replace(default_settings(), pf2jf_path_conv_search=r'^/downloads/',
+                                   pf2jf_path_conv_replace='/music/', jf_extract_ytid_regex=r'\[(\w+)\]',
+                                   jf_user_name='alice')
+    ctx = CycleContext(settings, jf)
+
+    assert ctx.to_jf_path('/downloads/a.m4a') == '/music/a.m4a'
+    assert ctx.to_jf_path('/elsewhere/downloads/b.m4a') == '/elsewhere/downloads/b.m4a'
+    assert ctx.yt_id_pattern.search('Song [abc]')[1] == 'abc'
+    assert ctx.yt_id_pattern is ctx.yt_id_pattern and ctx.user is ctx.user
+    assert compiled == [r'^/downloads/', r'\[(\w+)\]'] and found == ['alice']
+    # Without a conversion the paths are the same for both
+    unconverted = dataclasses.replace(settings, pf2jf_path_conv_search=None)
+    assert CycleContext(unconverted, jf).to_jf_path('/downloads/a.m4a') == '/downloads/a.m4a'
@@ -0,0 +1,38 @@
+import re
+from functools import cached_property
+
+from utils.db import Settings, load_settings
+from utils.jf import User, JellyfinClient, current_client
+
+
+def compile_regex(regex):
+    return re.compile(regex) if regex else None
+
+
+class CycleContext:
+    """
+    Constants of one sync cycle, shared by all of its stages: the settings as they were at the start of the cycle
+    and what is derived from them. Each one is resolved at its first use, at most once per cycle.
+    """
+
+    def __init__(self, settings: Settings = None, jf: JellyfinClient = None):
+        self.settings = settings or load_settings()
+        self.jf = jf or current_client()
+
+    @cached_property
+    def user(self) -> User:
+        return self.jf.find_user_by_name(self.settings.jf_user_name)
+
+    @cached_property
+    def yt_id_pattern(self) -> re.Pattern | None:
+        return compile_regex(self.settings.jf_extract_ytid_regex)
+
+    @cached_property
+    def jf_path_pattern(self) -> re.Pattern | None:
+        return compile_regex(self.settings.pf2jf_path_conv_search)
+
+    def to_jf_path(self, path):
+        """Converts a path of this process into the path Jellyfin sees, e.g. when they run in different containers."""
+        if self.jf_path_pattern:
+            return self.jf_path_pattern.sub(self.settings.pf2jf_path_conv_replace or '', path)
+        return path
@@ -1,18 +1,25 @@
 import dataclasses
+import hashlib
+import json
 import os
 import time
-from collections import defaultdict
+from collections import defaultdict, Counter
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import asdict
 from dataclasses import field
 from datetime import datetime
 from enum import Enum, auto
 from functools import lru_cache, cache
-from typing import List, Tuple, TypeVar
+from typing import List, Tuple, TypeVar, Generic, Callable, Iterator
 
+import pytimeparse
 import requests
 
-from utils.common import get_nested_value
+from utils.common import get_nested_value, chunked, group_by
+from utils.http import InstrumentedSession
 from utils.logs import create_logger
+from utils.realtime import RealtimeCache
+from utils.storage import Storage, SqliteStorage, WriteOp
 
 
 @dataclasses.dataclass
@@ -21,12 +28,22 @@ class __DBConfig:
     auth_collection = os.getenv('CONFIG_DB_auth_collection', '_superusers')
     auth_user = os.getenv('CONFIG_DB_AUTH_USER')
     auth_pwd = os.getenv('CONFIG_DB_AUTH_PWD')
+    # PocketBase caps perPage at 1000
+    page_size = int(os.getenv('CONFIG_DB_PAGE_SIZE', '500'))
+    page_workers = int(os.getenv('CONFIG_DB_PAGE_WORKERS', '4'))
+    # Must not exceed the `batch.maxRequests` PocketBase setting, create_db_structure() keeps them in sync
+    batch_size = int(os.getenv('CONFIG_DB_BATCH_SIZE', '50'))
+    cache_ttl = pytimeparse.parse(os.getenv('CONFIG_DB_CACHE_TTL', '5m'))
+    realtime = os.getenv('CONFIG_DB_REALTIME', '1') == '1'
+    # 'pocketbase' or 'sqlite'
+    backend = os.getenv('CONFIG_DB_BACKEND', 'pocketbase')
+    sqlite_path = os.getenv('CONFIG_DB_SQLITE_PATH', 'yt2jf_playsync.sqlite3')
 
 
 __config = __DBConfig()
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class PlaylistConfigResp:
     id: str
     jf_pl_id: str
@@ -35,28 +52,32 @@ class PlaylistConfigResp:
     ytm_pl_name: str
     jf_user_name: str
     sync: bool
+    # Also remove what is gone from the YT playlist and keep the YT order, see sync.mirror_playlist()
+    mirror: bool = False
     col_name = 'playlist_config'
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class MediaMappingResp:
     id: str
     yt_id: str
     yt_playlist_id: str
     local_path: str
     jf_id: str
+    col_name = 'yt_media_mapping'
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class LocalMediaArchive:
     id: str
     created: datetime = field(metadata={'ignore': True})
     jf_id: str = field(metadata={'unique_key': True})
     local_path: str
     exists: bool
+    col_name = 'local_media_archive'
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class YtMediaMetadata:
     id: str
     yt_id: str = field(metadata={'unique_key': True})
@@ -72,7 +93,7 @@ class YtMediaMetadata:
     col_name = 'yt_media_metadata'
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class DownloadTask:
     id: str = None
     yt_id: str = field(metadata={'unique_key': True}, default=None)
@@ -81,7 +102,7 @@ class DownloadTask:
     col_name = 'download_task'
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class YtAutomatedPlaylist:
     yt_pl_id: str
     yt_user: str
@@ -94,7 +115,7 @@ class YtAutomatedPlaylist:
     col_name = 'yt_automated_playlist'
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class GUser:
     id: str
     yt_user_id: str = field(metadata={'unique_key': True})
@@ -118,15 +139,18 @@ class CreateOpResult(Enum):
     CREATED = auto()
     DUPLICATE = auto()
     ERROR = auto()
+    UPDATED = auto()
 
 
+@cache
 def calc_allowed_fields(clazz) -> Tuple:
     return tuple(field.name for field in dataclasses.fields(clazz))
 
 
-PlaylistResp_allowed_fields = calc_allowed_fields(PlaylistConfigResp)
-MediaMappingResp_allowed_fields = calc_allowed_fields(MediaMappingResp)
-LocalMediaArchive_allowed_fields = calc_allowed_fields(LocalMediaArchive)
+@cache
+def calc_unique_key_fields(clazz) -> Tuple:
+    return tuple(field.name for field in dataclasses.fields(clazz) if field.metadata.get('unique_key'))
+
 
 logger = create_logger("db")
 
@@ -146,11 +170,17 @@ def db_auth():
 
 @cache
 def get_db_session():
-    session = requests.session()
+    session = InstrumentedSession('pocketbase', reauth=refresh_db_auth)
     session.headers.update({'Authorization': db_auth()})
     return session
 
 
+def refresh_db_auth(session):
+    # The token expires after a while, while db_auth() keeps returning the cached one
+    db_auth.cache_clear()
+    session.headers.update({'Authorization': db_auth()})
+
+
 def std_fields():
     return [
         {
@@ -186,36 +216,29 @@ def set_setting_if_absent(key, val):
         resp.raise_for_status()
 
 
-def create_db_structure():
-    def create_collection(name, fields, list_rule=None, view_rule=None, create_rule=None, update_rule=None,
+def collection_definition(name, fields, list_rule=None, view_rule=None, create_rule=None, update_rule=None,
                           delete_rule=None):
-        unique_keys = defaultdict(list)
-        for f in fields:
-            key = f.get('unique_key')
-            if key:
-                unique_keys[key].append(f['name'])
-        indexes = [f"CREATE UNIQUE INDEX `{name}_{k}` ON `{name}` ({','.join(f'`{f}`' for f in fields)})"
-                   for k, fields in
-                   unique_keys.items()]
-        dscr = {
-            'name': name,
-            'fields': std_fields() + fields,
-            'indexes': indexes,
-            'listRule': list_rule,
-            'viewRule': view_rule,
-            'createRule': create_rule,
-            'updateRule': update_rule,
-            'deleteRule': delete_rule,
-        }
-        resp = get_db_session().post(f"{__config.url}/api/collections", json=dscr)
-        if resp:
-            return resp.json()
-        elif resp.status_code == 400 and get_nested_value(resp.json(), 'data', 'name',
-                                                          'code') == 'validation_collection_name_exists':
-            logger.debug(f"Collection `{name}` already exists")
-        else:
-            resp.raise_for_status()
-
+    unique_keys = defaultdict(list)
+    for f in fields:
+        key = f.pop('unique_key', None)
+        if key:
+            unique_keys[key].append(f['name'])
+    indexes = [f"CREATE UNIQUE INDEX `{name}_{k}` ON `{name}` ({','.join(f'`{f}`' for f in fields)})"
+               for k, fields in
+               unique_keys.items()]
+    return {
+        'name': name,
+        'fields': std_fields() + fields,
+        'indexes': indexes,
+        'listRule': list_rule,
+        'viewRule': view_rule,
+        'createRule': create_rule,
+        'updateRule': update_rule,
+        'deleteRule': delete_rule,
+    }
+
+
+def schema_definitions() -> list[dict]:
     def detect_type(field):
         if field.type == str:
             return 'text'
@@ -223,7 +246,7 @@ def create_db_structure():
             return 'bool'
         elif field.type == int:
             return 'number'
-        raise ValueError("Cannot detect a db field type from field: " + field)
+        raise ValueError(f"Cannot detect a db field type from field: {field}")
 
     def parse_dataclass(dc):
         return [
@@ -242,17 +265,23 @@ def create_db_structure():
             v = field.name
         return v
 
-    create_collection('playlist_config', parse_dataclass(PlaylistConfigResp))
-    create_collection('yt_media_mapping', parse_dataclass(MediaMappingResp), create_rule='')
-    settings_fields = [{'name': 'key', 'type': 'text', 'unique_key': 'settings_idx_uniq_key'},
-                       {'name': 'val', 'type': 'text'}]
-    create_collection('yt_sync_settings', settings_fields)
-    create_collection('local_media_archive', parse_dataclass(LocalMediaArchive))
+    key_val_fields = [{'name': 'key', 'type': 'text', 'unique_key': 'settings_idx_uniq_key'},
+                      {'name': 'val', 'type': 'text'}]
+    definitions = [
+        collection_definition('playlist_config', parse_dataclass(PlaylistConfigResp)),
+        collection_definition('yt_media_mapping', parse_dataclass(MediaMappingResp), create_rule=''),
+        collection_definition('yt_sync_settings', [dict(f) for f in key_val_fields]),
+        collection_definition(META_COLLECTION, [dict(f) for f in key_val_fields]),
+        collection_definition('local_media_archive', parse_dataclass(LocalMediaArchive)),
+    ]
     models = [YtMediaMetadata, YtAutomatedPlaylist, GUser, DownloadTask]
     for model in models:
-        create_collection(model.col_name, parse_dataclass(model))
+        definitions.append(collection_definition(model.col_name, parse_dataclass(model)))
+    return definitions
 
-    def_settings = Settings(
+
+def default_settings():
+    return Settings(
         pf2jf_path_conv_search=os.getenv('DEFAULT_PF2JF_PATH_CONV_SEARCH'),
         pf2jf_path_conv_replace=os.getenv('DEFAULT_PF2JF_PATH_CONV_REPLACE'),
         jf_extract_ytid_regex=os.getenv('DEFAULT_PF2JF_YTID_REGEX'),
@@ -260,62 +289,216 @@ def create_db_structure():
         wait_time=os.getenv('DEFAULT_WAIT_TIME', '24h'),
         last_local_media_update_ts=0,
     )
-    for key, val in asdict(def_settings).items():
-        set_setting_if_absent(key, val)
+
+
+# Key/value records describing the db itself, e.g. the fingerprint of the schema it was migrated to
+META_COLLECTION = 'yt_sync_meta'
+SCHEMA_FINGERPRINT_KEY = 'schema_fingerprint'
+
+
+def schema_fingerprint(definitions) -> str:
+    # Default values come from the env and are applied only when absent, so only the setting keys count
+    data = {'collections': definitions,
+            'settings': sorted(calc_allowed_fields(Settings)),
+            'batch_size': __config.batch_size}
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+def load_meta_value(key):
+    resp = get_db_session().get(records_url(META_COLLECTION),
+                                params={'filter': f"key = {quote_filter_value(key)}", 'skipTotal': 1})
+    if resp.status_code == 404:
+        # The collection is not created yet
+        return None
+    resp.raise_for_status()
+    return next((itm['val'] for itm in resp.json()['items']), None)
+
+
+def save_meta_value(key, val):
+    resp = get_db_session().get(records_url(META_COLLECTION),
+                                params={'filter': f"key = {quote_filter_value(key)}", 'skipTotal': 1})
+    resp.raise_for_status()
+    if items := resp.json()['items']:
+        resp = get_db_session().patch(f"{records_url(META_COLLECTION)}/{items[0]['id']}", json={'val': val})
+    else:
+        resp = get_db_session().post(records_url(META_COLLECTION), json={'key': key, 'val': val})
+    resp.raise_for_status()
+
+
+def migrate_collection(dscr):
+    name = dscr['name']
+    resp = get_db_session().get(f"{__config.url}/api/collections/{name}")
+    if resp.status_code == 404:
+        get_db_session().post(f"{__config.url}/api/collections", json=dscr).raise_for_status()
+        logger.info(f"Created collection `{name}`")
+        return
+    resp.raise_for_status()
+    existing = resp.json()
+    existing_field_names = {f['name'] for f in existing['fields']}
+    new_fields = [f for f in dscr['fields'] if f['name'] not in existing_field_names]
+    normalized_indexes = {" ".join(idx.split()).lower() for idx in existing['indexes']}
+    new_indexes = [idx for idx in dscr['indexes'] if " ".join(idx.split()).lower() not in normalized_indexes]
+    if new_fields or new_indexes:
+        # PocketBase replaces the field and index lists, the existing ones have to be sent back as they are
+        patch = {'fields': existing['fields'] + new_fields, 'indexes': existing['indexes'] + new_indexes}
+        get_db_session().patch(f"{__config.url}/api/collections/{name}", json=patch).raise_for_status()
+        logger.info(f"Migrated collection `{name}`: added fields {[f['name'] for f in new_fields]}, "
+                    f"indexes {new_indexes}")
+    else:
+        logger.debug(f"Collection `{name}` is up to date")
+
+
+def create_db_structure():
+    storage().create_db_structure(asdict(default_settings()))
+
+
+def create_pocketbase_structure(settings: dict):
+    definitions = schema_definitions()
+    fingerprint = schema_fingerprint(definitions)
+    if load_meta_value(SCHEMA_FINGERPRINT_KEY) == fingerprint:
+        logger.debug(f"Db schema is up to date ({fingerprint[:12]})")
+        return
+    logger.info(f"Db schema changed, migrating to {fingerprint[:12]}")
+    for dscr in definitions:
+        migrate_collection(dscr)
+
+    resp = get_db_session().patch(f"{__config.url}/api/settings",
+                                  json={'batch': {'enabled': True, 'maxRequests': __config.batch_size}})
+    if not resp:
+        logger.warning(f"Cannot enable the batch api, status: {resp.status_code}")
+
+    settings_url = "/api/collections/yt_sync_settings/records"
+    existing_keys = {r['key'] for r in load_all_paged_records(f"{__config.url}{settings_url}", fields='key')}
+    for status, body in run_batch([{'method': 'POST', 'url': settings_url, 'body': {'key': key, 'val': val}}
+                                   for key, val in settings.items() if key not in existing_keys]):
+        if not (status and 200 <= status < 300):
+            raise RuntimeError(f"Cannot add a default setting, status: {status}, response: {body}")
+    invalidate_cache()
+    save_meta_value(SCHEMA_FINGERPRINT_KEY, fingerprint)
+
 
 def save_entity(entity, fields=None):
-    url = f"{__config.url}/api/collections/{entity.col_name}/records/{entity.id}"
-    data = asdict(entity)
+    data = entity_fields(entity)
     if fields:
         data = {k: v for k, v in data.items() if k in fields}
-    response = get_db_session().patch(url, json=data)
-    response.raise_for_status()
+    [(status, body)] = storage().write([WriteOp('update', entity.col_name, entity.id, data)])
+    invalidate_cache(entity.col_name)
+    if not (status and 200 <= status < 300):
+        raise RuntimeError(f"Cannot save {type(entity).__name__}({entity.id}), status: {status}, response: {body}")
+    notify_saved([entity])
 
-def load_playlist_configs():
-    url = f"{__config.url}/api/collections/playlist_config/records"
-    response = get_db_session().get(url)
-    if response:
-        return [PlaylistConfigResp(**{k: v for k, v in pl.items() if k in PlaylistResp_allowed_fields}) for pl in
-                response.json()['items']]
 
+__saved_listeners: list[Callable[[list], None]] = []
 
-def save_playlist_config(pl_config: PlaylistConfigResp):
-    url = f"{__config.url}/api/collections/playlist_config/records/{pl_config.id}"
-    response = get_db_session().patch(url, json=asdict(pl_config))
-    response.raise_for_status()
 
+def add_saved_listener(listener: Callable[[list], None]):
+    """`listener` gets the entities after they are created or saved through this module."""
+    __saved_listeners.append(listener)
 
-def load_all_paged_records(url, filter=None):
-    def load_page(page_n=1):
-        params = {"page": page_n, "perPage": 100, "filter": filter}
-        response = get_db_session().get(url, params=params)
-        if response:
-            json = response.json()
-            return json['items'], json['page'], json['totalPages'], json['totalItems']
 
-    first_page, page_n, total_pages, total_items = load_page()
-    all_items = []
-    all_items += first_page
-    while page_n < total_pages:
-        page_items, page_n, total_pages, total_items = load_page(page_n + 1)
-        all_items += page_items
-    return all_items
+def notify_saved(entities: list):
+    if entities:
+        for listener in __saved_listeners:
+            listener(entities)
+
+
+def load_playlist_configs(**filters) -> list[PlaylistConfigResp]:
+    return load_cached(PlaylistConfigResp, **filters)
+
+
+def save_playlist_config(pl_config: PlaylistConfigResp, fields=None):
+    save_entity(pl_config, fields)
+
+
+def load_all_paged_records(url, filter=None, per_page=None, max_workers=None, fields=None, sort=None, max_items=None):
+    per_page = per_page or __config.page_size
+    max_workers = max_workers or __config.page_workers
+    if max_items is not None:
+        per_page = min(per_page, max_items)
+
+    def load_page(page_n, skip_total=True):
+        params = {"page": page_n, "perPage": per_page, "filter": filter, "fields": fields, "sort": sort}
+        if skip_total:
+            # totalItems/totalPages come back as -1, but PocketBase skips the COUNT query
+            params['skipTotal'] = 1
+        response = get_db_session().get(url, params=params)
+        response.raise_for_status()
+        return response.json()
+
+    if max_items is not None and max_items <= per_page:
+        return load_page(1)['items'][:max_items]
+
+    first_page = load_page(1, skip_total=False)
+    all_items = list(first_page['items'])
+    total_pages = first_page['totalPages']
+    if max_items is not None:
+        total_pages = min(total_pages, -(-max_items // per_page))
+    if total_pages > 1:
+        # The first page told us how many pages there are, so the rest can be fetched at once.
+        # executor.map() yields results in submission order, which keeps the records sorted.
+        with ThreadPoolExecutor(max_workers=min(max_workers, total_pages - 1)) as executor:
+            for page in executor.map(load_page, range(2, total_pages + 1)):
+                all_items += page['items']
+    return all_items if max_items is None else all_items[:max_items]
+
+
+def iter_paged_records(url, filter=None, per_page=None, fields=None, sort=None, max_items=None) -> Iterator[dict]:
+    """
+    Streaming variant of load_all_paged_records(). Yields the records of a page while the next one is being fetched,
+    so about two pages are held in memory no matter how big the collection is.
+    """
+    per_page = per_page or __config.page_size
+    if max_items is not None:
+        per_page = min(per_page, max_items)
+
+    def load_page(page_n):
+        params = {"page": page_n, "perPage": per_page, "filter": filter, "fields": fields, "sort": sort, 'skipTotal': 1}
+        response = get_db_session().get(url, params=params)
+        response.raise_for_status()
+        return response.json()['items']
+
+    yielded = 0
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        page_n = 1
+        next_page = executor.submit(load_page, page_n)
+        while True:
+            items = next_page.result()
+            # Without totals, a short page is the only sign of the last one
+            last_page = len(items) < per_page or (max_items is not None and yielded + len(items) >= max_items)
+            if not last_page:
+                page_n += 1
+                next_page = executor.submit(load_page, page_n)
+            for itm in items[:None if max_items is None else max_items - yielded]:
+                yield itm
+            yielded += len(items)
+            if last_page:
+                return
 
 
 def load_media_mappings():
-    url = f"{__config.url}/api/collections/yt_media_mapping/records"
-    recs = load_all_paged_records(url)
-    return [MediaMappingResp(**{k: v for k, v in pl.items() if k in MediaMappingResp_allowed_fields}) for pl in recs]
+    return Query(MediaMappingResp).all()
+
+
+def download_tasks_query(status=None, fields=None) -> 'Query[DownloadTask]':
+    query = Query(DownloadTask).only(*(fields or ()))
+    if status is not None:
+        query = query.where(status=status)
+    return query
 
 
-def load_download_tasks(status=None) -> list[DownloadTask]:
-    return [dt for dt in load_all_db_objects(DownloadTask) if status is None or dt.status == status]
+def load_download_tasks(status=None, fields=None) -> list[DownloadTask]:
+    return download_tasks_query(status, fields).all()
+
+
+def iter_download_tasks(status=None, fields=None) -> Iterator[DownloadTask]:
+    """Lazy variant of load_download_tasks(), for callers that consume the tasks one by one."""
+    return download_tasks_query(status, fields).iter()
 
 
 def delete_mapping(mapping: MediaMappingResp):
-    url = f"{__config.url}/api/collections/yt_media_mapping/records/{mapping.id}"
-    response = get_db_session().delete(url)
-    response.raise_for_status()
+    [(status, body)] = storage().write([WriteOp('delete', mapping.col_name, mapping.id)])
+    if not (status and 200 <= status < 300):
+        raise RuntimeError(f"Cannot delete {mapping}, status: {status}, response: {body}")
 
 
 @dataclasses.dataclass
@@ -328,135 +511,472 @@ class Settings:
     last_local_media_update_ts: int = 0
 
 
-@cache
 def load_settings():
-    url = f"{__config.url}/api/collections/yt_sync_settings/records"
-    response = get_db_session().get(url)
+    return config_cache().get('yt_sync_settings', __load_settings)
+
+
+def __load_settings():
     allowed_fields = {field.name for field in dataclasses.fields(Settings)}
-    if response:
-        data = {entry['key']: entry['val'] for entry in response.json()['items']}
-        return Settings(**{k: v for k, v in data.items() if k in allowed_fields})
-
-
-def load_local_media():
-    url = f"{__config.url}/api/collections/local_media_archive/records"
-    recs = load_all_paged_records(url)
-    items = [LocalMediaArchive(**{k: v for k, v in pl.items() if k in LocalMediaArchive_allowed_fields}) for pl in recs]
-    for itm in items:
-        itm.created = datetime.fromisoformat(itm.created)
-    return items
-
-
-def add_local_media(items: List[dict]):
-    url = f"{__config.url}/api/collections/local_media_archive/records"
-    for itm in items:
-        try:
-            resp = get_db_session().post(url, data={'jf_id': itm['Id'], 'local_path': itm.get('Path'), 'exists': True})
-            http_code = resp.status_code
-            if resp:
-                logger.debug(f"Added LocalMediaArchive '{itm['Id']}/{itm['Name']}'")
-            elif http_code == 400 and get_nested_value(resp.json(), "data", "key", "code") == 'validation_not_unique':
-                logger.debug(f"Setting '{itm['Id']}/{itm['Name']}' already exists")
-            else:
-                resp.raise_for_status()
-        except:
-            logger.exception(f"Cannot save a LocalMediaArchive entry '{itm['Id']}/{itm['Name']}'")
+    data = {entry['key']: entry['val'] for entry in storage().list_records('yt_sync_settings')}
+    return Settings(**{k: v for k, v in data.items() if k in allowed_fields})
 
 
-def load_yt_media_metadata(allowed_fields=calc_allowed_fields(YtMediaMetadata), **filters):
-    def decorate(v):
-        if v is None:
-            return 'null'
-        return f"'{v}'"
+def load_local_media(fields=None) -> list[LocalMediaArchive]:
+    return Query(LocalMediaArchive).only(*(fields or ())).all()
 
-    filter = " && ".join(f"{k} = {decorate(v)}" for k, v in filters.items())
-    if filter:
-        filter = f"({filter})"
-    url = f"{__config.url}/api/collections/yt_media_metadata/records"
-    recs = load_all_paged_records(url, filter=filter)
-    items = [YtMediaMetadata(**{k: v for k, v in pl.items() if k in allowed_fields}) for pl in recs]
-    return items
+
+def add_local_media(items: List[dict]) -> list[CreateOpResult]:
+    entities = [LocalMediaArchive(id=None, created=None, jf_id=itm['Id'], local_path=itm.get('Path'), exists=True)
+                for itm in items]
+    return create_entities(entities)
+
+
+def load_yt_media_metadata(fields=None, **filters) -> list[YtMediaMetadata]:
+    return Query(YtMediaMetadata).where(**filters).only(*(fields or ())).all()
 
 
 def create_yt_media_metadata(media_metadata: YtMediaMetadata) -> CreateOpResult:
-    url = f"{__config.url}/api/collections/yt_media_metadata/records"
-    try:
-        resp = get_db_session().post(url, data=asdict(media_metadata))
-        http_code = resp.status_code
-        if resp:
-            logger.debug(f"Added YtMediaMetadata '{media_metadata.yt_id}/{media_metadata.title}'")
-            return CreateOpResult.CREATED
-        elif http_code == 400 and get_nested_value(resp.json(), "data", "yt_id", "code") == 'validation_not_unique':
-            logger.debug(f"YtMediaMetadata '{media_metadata.yt_id}/{media_metadata.title}' already exists")
-            return CreateOpResult.DUPLICATE
-        else:
-            resp.raise_for_status()
-    except:
-        logger.exception(f"Cannot save a YtMediaMetadata '{media_metadata.yt_id}/{media_metadata.title}'")
-    return CreateOpResult.ERROR
+    return create_entities([media_metadata])[0]
 
 
-def save_yt_media_metadata(mm: YtMediaMetadata):
-    url = f"{__config.url}/api/collections/{mm.col_name}/records/{mm.id}"
-    response = get_db_session().patch(url, json=asdict(mm))
-    response.raise_for_status()
+def save_yt_media_metadata(mm: YtMediaMetadata, fields=None):
+    save_entity(mm, fields)
 
 
-def load_yt_automated_playbooks(allowed_fields=calc_allowed_fields(YtAutomatedPlaylist)):
-    url = f"{__config.url}/api/collections/{YtAutomatedPlaylist.col_name}/records"
-    recs = load_all_paged_records(url)
-    items = [YtAutomatedPlaylist(**filter_fields(pl, allowed_fields)) for pl in recs]
-    return items
+def load_yt_automated_playbooks(**filters) -> list[YtAutomatedPlaylist]:
+    return load_cached(YtAutomatedPlaylist, **filters)
 
 
-def load_gusers(allowed_fields=calc_allowed_fields(GUser)) -> list[GUser]:
-    return load_all_db_objects(GUser)
+def load_gusers() -> list[GUser]:
+    return load_cached(GUser)
 
 
 T = TypeVar('T')
 
 
 def load_all_db_objects(db_clazz: type[T]) -> list[T]:
-    allowed_fields = calc_allowed_fields(db_clazz)
-    url = f"{__config.url}/api/collections/{db_clazz.col_name}/records"
-    recs = load_all_paged_records(url)
-    items = [db_clazz(**filter_fields(pl, allowed_fields)) for pl in recs]
-    return items
-
-
-def load_guser_by_id(guid: str, allowed_fields=calc_allowed_fields(GUser)) -> GUser:
-    url = f"{__config.url}/api/collections/{GUser.col_name}/records"
-    params = {'filter': f"yt_user_id='{guid}'"}
-    resp = get_db_session().get(url, params=params)
-    if resp.status_code == 200:
-        items = resp.json()['items']
-        if len(items) == 1:
-            itm = items[0]
-            return GUser(**filter_fields(itm, allowed_fields))
-
-
-def save_guser(user: GUser):
-    url = f"{__config.url}/api/collections/{user.col_name}/records/{user.id}"
-    response = get_db_session().patch(url, json=asdict(user))
-    response.raise_for_status()
+    return Query(db_clazz).all()
+
+
+def load_guser_by_id(guid: str) -> GUser:
+    return next(iter(load_cached(GUser, yt_user_id=guid)), None)
+
+
+# Configuration collections, small and read over and over, but still editable while the app runs
+CACHED_COLLECTIONS = ('yt_sync_settings', PlaylistConfigResp.col_name, YtAutomatedPlaylist.col_name, GUser.col_name)
+
+
+@cache
+def config_cache() -> RealtimeCache:
+    return RealtimeCache(__config.url, get_db_session, CACHED_COLLECTIONS, ttl=__config.cache_ttl,
+                         realtime=__config.realtime and storage().remote)
+
+
+def invalidate_cache(col_name=None):
+    if col_name is None or col_name in CACHED_COLLECTIONS:
+        config_cache().invalidate(col_name)
+
+
+def load_cached(db_clazz: type[T], **filters) -> list[T]:
+    items = config_cache().get(db_clazz.col_name, lambda: Query(db_clazz).all())
+    return [itm for itm in items if all(getattr(itm, k) == v for k, v in filters.items())]
+
+
+def save_guser(user: GUser, fields=None):
+    save_entity(user, fields)
 
 
 def create_download_task(task: DownloadTask) -> CreateOpResult:
-    url = f"{__config.url}/api/collections/{DownloadTask.col_name}/records"
+    return create_entities([task])[0]
+
+
+def filter_fields(d, fields):
+    return {k: v for k, v in d.items() if k in fields}
+
+
+def quote_filter_value(v):
+    if v is None:
+        return 'null'
+    if isinstance(v, bool):
+        return 'true' if v else 'false'
+    if isinstance(v, (int, float)):
+        return str(v)
+    v = str(v)
+    # PocketBase keeps backslashes as they are, only the one before a quote escapes it, so a trailing one would
+    # escape the closing quote
+    if v.endswith('\\'):
+        raise ValueError(f"PocketBase filters cannot express a value ending with a backslash: {v!r}")
+    v = v.replace("'", "\\'")
+    return f"'{v}'"
+
+
+def pb_filter_expr(conditions):
+    def render(name, op, value):
+        if op == 'in':
+            return "(" + " || ".join(f"{name} = {quote_filter_value(v)}" for v in value) + ")"
+        return f"{name} {Query.OPERATORS[op]} {quote_filter_value(value)}"
+
+    filter = " && ".join(render(*c) for c in conditions)
+    return f"({filter})" if filter else None
+
+
+def get_db_url():
+    if __config.backend == 'sqlite':
+        return f"sqlite:{os.path.abspath(__config.sqlite_path)}"
+    return __config.url
+
+
+def records_url(col_name):
+    return f"{__config.url}/api/collections/{col_name}/records"
+
+
+# Fields every PocketBase record has, on top of the ones declared by the dataclass
+SYSTEM_FIELDS = ('id', 'created', 'updated')
+
+
+def parse_db_datetime(v):
+    if isinstance(v, str):
+        return datetime.fromisoformat(v) if v else None
+    return v
+
+
+@cache
+def compile_decoder(db_clazz: type[T]) -> Callable[[dict], T]:
+    """
+    Generates a function that builds a `db_clazz` straight from a json record, passing the fields positionally.
+    Fields missing from the record (e.g. outside of the requested projection) get their default or None.
+    """
+    namespace = {'cls': db_clazz, 'parse_db_datetime': parse_db_datetime}
+    args = []
+    for i, f in enumerate(dataclasses.fields(db_clazz)):
+        if f.default_factory is not dataclasses.MISSING:
+            namespace[f'factory_{i}'] = f.default_factory
+            value = f"(r[{f.name!r}] if {f.name!r} in r else factory_{i}())"
+        else:
+            namespace[f'default_{i}'] = None if f.default is dataclasses.MISSING else f.default
+            value = f"r.get({f.name!r}, default_{i})"
+        if f.type is datetime:
+            value = f"parse_db_datetime({value})"
+        args.append(value)
+    src = f"def decode_{db_clazz.__name__}(r):\n    return cls({', '.join(args)})\n"
+    exec(src, namespace)
+    return namespace[f'decode_{db_clazz.__name__}']
+
+
+def decode_record(db_clazz: type[T], rec: dict) -> T:
+    return compile_decoder(db_clazz)(rec)
+
+
+@dataclasses.dataclass(frozen=True)
+class Query(Generic[T]):
+    """
+    Builds a PocketBase list request for a dataclass model, so filtering, projection, sorting and limits happen
+    on the server. Conditions are given as `field=value` or `field__op=value`, see `OPERATORS`.
+    Every method returns a new query:
+
+        Query(DownloadTask).where(status='pending').only('id', 'yt_id').order_by('-created').limit(10).all()
+    """
+    OPERATORS = {'eq': '=', 'ne': '!=', 'gt': '>', 'gte': '>=', 'lt': '<', 'lte': '<=', 'like': '~', 'in': None}
+
+    model: type[T]
+    conditions: tuple = ()
+    fields: tuple = ()
+    sort: tuple = ()
+    max_items: int = None
+
+    def __check_field(self, name):
+        if name not in SYSTEM_FIELDS and name not in calc_allowed_fields(self.model):
+            raise ValueError(f"{self.model.__name__} has no field '{name}'")
+
+    def where(self, **conditions) -> 'Query[T]':
+        parsed = []
+        for key, value in conditions.items():
+            name, _, op = key.partition('__')
+            op = op or 'eq'
+            self.__check_field(name)
+            if op not in self.OPERATORS:
+                raise ValueError(f"Unknown filter operator '{op}' in '{key}'")
+            parsed.append((name, op, tuple(value) if op == 'in' else value))
+        return dataclasses.replace(self, conditions=self.conditions + tuple(parsed))
+
+    def only(self, *fields) -> 'Query[T]':
+        for name in fields:
+            self.__check_field(name)
+        return dataclasses.replace(self, fields=self.fields + fields)
+
+    def order_by(self, *fields) -> 'Query[T]':
+        for name in fields:
+            self.__check_field(name.lstrip('+-'))
+        return dataclasses.replace(self, sort=self.sort + fields)
+
+    def limit(self, n) -> 'Query[T]':
+        return dataclasses.replace(self, max_items=n)
+
+    def is_empty(self):
+        return any(op == 'in' and not value for _, op, value in self.conditions)
+
+    def filter_expr(self):
+        return pb_filter_expr(self.conditions)
+
+    def records(self) -> list[dict]:
+        if self.is_empty():
+            return []
+        return storage().list_records(self.model.col_name, self.conditions, self.fields, self.sort, self.max_items)
+
+    def iter_records(self) -> Iterator[dict]:
+        if self.is_empty():
+            return iter(())
+        return storage().iter_records(self.model.col_name, self.conditions, self.fields, self.sort, self.max_items)
+
+    def all(self) -> list[T]:
+        decode = compile_decoder(self.model)
+        return [decode(rec) for rec in self.records()]
+
+    def iter(self) -> Iterator[T]:
+        """Yields the models while the records are still being loaded, without holding the whole result."""
+        decode = compile_decoder(self.model)
+        return (decode(rec) for rec in self.iter_records())
+
+    def first(self) -> T | None:
+        return next(iter(self.limit(1).all()), None)
+
+
+def entity_fields(entity) -> dict:
+    ignored = {f.name for f in dataclasses.fields(entity) if f.metadata.get('ignore')}
+    return {k: v for k, v in asdict(entity).items() if k not in ignored}
+
+
+def entity_payload(entity) -> dict:
+    # Mimics the form-encoded POSTs: fields without a value are left to the db defaults
+    return {k: v for k, v in entity_fields(entity).items() if v is not None}
+
+
+__batch_api_enabled = True
+
+
+def run_batch(requests_list: list[dict]) -> list[tuple[int, dict]]:
+    """
+    Sends `{'method', 'url', 'body'}` requests through /api/batch and returns `(status, body)` for each of them.
+    PocketBase runs a batch as one transaction, so a failed batch is split in half until the culprits are isolated.
+    """
+    results = []
+    for chunk in chunked(requests_list, __config.batch_size):
+        results += __run_batch_chunk(chunk)
+    return results
+
+
+def __run_batch_chunk(chunk: list[dict]) -> list[tuple[int, dict]]:
+    global __batch_api_enabled
+    if len(chunk) == 1 or not __batch_api_enabled:
+        return [__run_single_request(r) for r in chunk]
+    resp = get_db_session().post(f"{__config.url}/api/batch", json={'requests': chunk})
+    if resp:
+        return [(r['status'], r['body']) for r in resp.json()]
+    if resp.status_code == 403:
+        logger.warning("Batch api is disabled in PocketBase, falling back to one request per record")
+        __batch_api_enabled = False
+        return [__run_single_request(r) for r in chunk]
+    if resp.status_code == 400:
+        mid = len(chunk) // 2
+        return __run_batch_chunk(chunk[:mid]) + __run_batch_chunk(chunk[mid:])
+    resp.raise_for_status()
+
+
+def __run_single_request(req: dict) -> tuple[int, dict]:
+    resp = get_db_session().request(req['method'], f"{__config.url}{req['url']}", json=req.get('body'))
     try:
-        resp = get_db_session().post(url, data=asdict(task))
-        http_code = resp.status_code
-        if resp:
-            logger.debug(f"Added DownloadTask '{task.yt_id}'")
-            return CreateOpResult.CREATED
-        elif http_code == 400 and get_nested_value(resp.json(), "data", "yt_id", "code") == 'validation_not_unique':
-            logger.debug(f"DownloadTask for yt_id '{task.yt_id}' already exists")
-            return CreateOpResult.DUPLICATE
+        body = resp.json() if resp.content else None
+    except ValueError:
+        body = None
+    return resp.status_code, body
+
+
+def load_existing_keys(db_clazz, key_field, keys, batch_size=50) -> dict:
+    existing = {}
+    for chunk in chunked(keys, batch_size):
+        for e in Query(db_clazz).where(**{f"{key_field}__in": chunk}).only('id', key_field).all():
+            existing[getattr(e, key_field)] = e.id
+    return existing
+
+
+def create_entities(entities: list, upsert=False) -> list[CreateOpResult]:
+    """
+    Bulk version of create_download_task() and friends. Records whose unique key already exists in the db are
+    reported as DUPLICATE without sending them (or PATCHed and reported as UPDATED with `upsert=True`).
+    Created entities get their `id` assigned.
+    """
+    results: list = [None] * len(entities)
+    if not entities:
+        return results
+    db_clazz = type(entities[0])
+    key_field = next(iter(calc_unique_key_fields(db_clazz)), None)
+    existing = {}
+    if key_field and (upsert or len(entities) > 1):
+        keys = list({getattr(e, key_field) for e in entities})
+        existing = load_existing_keys(db_clazz, key_field, keys)
+
+    ops = []
+    sent = []
+    seen_keys = set()
+    for i, e in enumerate(entities):
+        key = getattr(e, key_field) if key_field else None
+        if key_field and key in seen_keys:
+            results[i] = CreateOpResult.DUPLICATE
+            continue
+        seen_keys.add(key)
+        body = entity_payload(e)
+        if key in existing:
+            if not upsert:
+                results[i] = CreateOpResult.DUPLICATE
+                continue
+            e.id = existing[key]
+            body.pop('id', None)
+            ops.append(WriteOp('update', db_clazz.col_name, e.id, body))
         else:
-            resp.raise_for_status()
+            ops.append(WriteOp('create', db_clazz.col_name, body=body))
+        sent.append(i)
+
+    try:
+        responses = storage().write(ops)
+        invalidate_cache(db_clazz.col_name)
     except:
-        logger.exception(f"Cannot save a DownloadTask for yt_id '{task.yt_id}'")
-    return CreateOpResult.ERROR
+        logger.exception(f"Cannot save {len(ops)} {db_clazz.__name__} records")
+        responses = [(None, None)] * len(ops)
+    for i, op, (status, body) in zip(sent, ops, responses):
+        e = entities[i]
+        if status and 200 <= status < 300:
+            if op.method == 'create':
+                e.id = body['id']
+                results[i] = CreateOpResult.CREATED
+            else:
+                results[i] = CreateOpResult.UPDATED
+        elif status == 400 and key_field and get_nested_value(body, "data", key_field, "code") == 'validation_not_unique':
+            results[i] = CreateOpResult.DUPLICATE
+        else:
+            logger.error(f"Cannot save a {db_clazz.__name__} {e}, status: {status}, response: {body}")
+            results[i] = CreateOpResult.ERROR
+    notify_saved([e for e, r in zip(entities, results) if r in (CreateOpResult.CREATED, CreateOpResult.UPDATED)])
+    logger.debug(f"Saved {len(entities)} {db_clazz.__name__} records: "
+                 f"{ {r.name: n for r, n in Counter(results).items()} }")
+    return results
+
+
+class BulkWriter:
+    """Queues new entities so a whole stage can be written with a handful of batch requests."""
+
+    def __init__(self, upsert=False):
+        self.upsert = upsert
+        self.__queue = []
+
+    def add(self, entity):
+        self.__queue.append(entity)
+
+    def __len__(self):
+        return len(self.__queue)
+
+    def flush(self) -> list[tuple[object, CreateOpResult]]:
+        queue, self.__queue = self.__queue, []
+        results = []
+        for db_clazz, entities in group_by(queue, type).items():
+            results += zip(entities, create_entities(entities, upsert=self.upsert))
+        return results
+
+
+class UnitOfWork:
+    """
+    Snapshots the tracked entities and, on flush(), PATCHes only the fields that changed since, in batches.
+    Used as a context manager it flushes when the block exits without an error.
+    A failed save raises a RuntimeError, after the entities that were saved are recorded as such.
+    """
+
+    def __init__(self):
+        self.__tracked: dict[int, tuple[object, dict]] = {}
+
+    def track(self, *entities):
+        for e in entities:
+            self.__tracked[id(e)] = (e, entity_fields(e))
+        return self
+
+    def changes(self, entity) -> dict:
+        _, snapshot = self.__tracked[id(entity)]
+        return {k: v for k, v in entity_fields(entity).items() if k != 'id' and snapshot.get(k) != v}
+
+    def flush(self) -> int:
+        dirty = [(e, changes) for e, _ in self.__tracked.values() if (changes := self.changes(e))]
+        if not dirty:
+            return 0
+        saved = []
+        failures = []
+        responses = storage().write([WriteOp('update', e.col_name, e.id, changes) for e, changes in dirty])
+        for col_name in {e.col_name for e, _ in dirty}:
+            invalidate_cache(col_name)
+        for (e, changes), (status, body) in zip(dirty, responses):
+            if status and 200 <= status < 300:
+                self.track(e)
+                saved.append(e)
+            else:
+                failures.append(f"{type(e).__name__}({e.id}) changes {changes}, status: {status}, response: {body}")
+        notify_saved(saved)
+        logger.debug(f"Saved changes of {len(saved)} out of {len(dirty)} entities")
+        if failures:
+            raise RuntimeError(f"Cannot save {len(failures)} out of {len(dirty)} entities: " + "; ".join(failures))
+        return len(saved)
 
-def filter_fields(d, fields):
-    return {k: v for k, v in d.items() if k in fields}
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.flush()
+
+
+
+class PocketBaseStorage(Storage):
+    def list_records(self, collection, conditions=(), fields=(), sort=(), max_items=None) -> list[dict]:
+        return load_all_paged_records(records_url(collection),
+                                      filter=pb_filter_expr(conditions),
+                                      fields=','.join(fields) or None,
+                                      sort=','.join(sort) or None,
+                                      max_items=max_items)
+
+    def iter_records(self, collection, conditions=(), fields=(), sort=(), max_items=None) -> Iterator[dict]:
+        return iter_paged_records(records_url(collection),
+                                  filter=pb_filter_expr(conditions),
+                                  fields=','.join(fields) or None,
+                                  sort=','.join(sort) or None,
+                                  max_items=max_items)
+
+    def write(self, ops: list[WriteOp]) -> list[tuple[int, dict]]:
+        methods = {'create': 'POST', 'update': 'PATCH', 'delete': 'DELETE'}
+        return run_batch([{'method': methods[op.method],
+                           'url': f"/api/collections/{op.collection}/records" + (f"/{op.id}" if op.id else ""),
+                           'body': op.body}
+                          for op in ops])
+
+    def create_db_structure(self, default_settings: dict):
+        create_pocketbase_structure(default_settings)
+
+
+def create_storage(backend) -> Storage:
+    if backend == 'pocketbase':
+        return PocketBaseStorage()
+    if backend == 'sqlite':
+        return SqliteStorage(__config.sqlite_path, schema_definitions())
+    raise ValueError(f"Unknown db backend '{backend}'")
+
+
+__storage: Storage = None
+
+
+def storage() -> Storage:
+    global __storage
+    if __storage is None:
+        __storage = create_storage(__config.backend)
+    return __storage
+
+
+def set_storage(s: Storage):
+    """Replaces the storage all the load/save functions go through, e.g. to run the same code against another backend."""
+    global __storage
+    __storage = s
+    invalidate_cache()
@@ -0,0 +1,136 @@
+import dataclasses
+import os
+import re
+import threading
+import time
+from typing import Callable
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3 import Retry
+
+from utils.logs import create_logger
+
+logger = create_logger("http")
+
+
+@dataclasses.dataclass
+class __HttpConfig:
+    pool_connections = int(os.getenv('CONFIG_HTTP_POOL_CONNECTIONS', '4'))
+    pool_maxsize = int(os.getenv('CONFIG_HTTP_POOL_MAXSIZE', '16'))
+    timeout = float(os.getenv('CONFIG_HTTP_TIMEOUT', '60'))
+    retries = int(os.getenv('CONFIG_HTTP_RETRIES', '3'))
+    backoff_factor = float(os.getenv('CONFIG_HTTP_BACKOFF_FACTOR', '0.5'))
+
+
+__config = __HttpConfig()
+
+
+@dataclasses.dataclass
+class EndpointStats:
+    count: int = 0
+    errors: int = 0
+    total_time: float = 0
+    max_time: float = 0
+
+    @property
+    def avg_time(self):
+        return self.total_time / self.count if self.count else 0
+
+
+__stats: dict[tuple[str, str, str], EndpointStats] = {}
+__stats_lock = threading.Lock()
+
+# Jellyfin ids are 32 hex chars (sometimes dashed), PocketBase ids are 15 lowercase alphanumerics
+__id_segment = re.compile(r'^([0-9a-fA-F]{32}|[0-9a-fA-F-]{36}|(?=.*\d)[a-z0-9]{15})$')
+
+
+def endpoint_name(url):
+    path = urlparse(url).path
+    return "/".join('{id}' if __id_segment.match(segment) else segment for segment in path.split('/'))
+
+
+def record_call(client, method, url, elapsed, failed):
+    key = (client, method.upper(), endpoint_name(url))
+    with __stats_lock:
+        stats = __stats.setdefault(key, EndpointStats())
+        stats.count += 1
+        stats.errors += failed
+        stats.total_time += elapsed
+        stats.max_time = max(stats.max_time, elapsed)
+
+
+def get_http_stats() -> dict[tuple[str, str, str], EndpointStats]:
+    """Per (client, method, endpoint) call statistics since the start or the last reset."""
+    with __stats_lock:
+        return {k: dataclasses.replace(v) for k, v in __stats.items()}
+
+
+def reset_http_stats():
+    with __stats_lock:
+        __stats.clear()
+
+
+def format_http_stats(stats=None):
+    stats = stats if stats is not None else get_http_stats()
+    lines = [f"{'calls':>6} {'errors':>6} {'total,s':>8} {'avg,ms':>8} {'max,ms':>8}  endpoint"]
+    for (client, method, endpoint), s in sorted(stats.items(), key=lambda kv: -kv[1].total_time):
+        lines.append(f"{s.count:>6} {s.errors:>6} {s.total_time:>8.2f} {s.avg_time * 1000:>8.0f} "
+                     f"{s.max_time * 1000:>8.0f}  {client} {method} {endpoint}")
+    return "\n".join(lines)
+
+
+def default_timeout():
+    return __config.timeout
+
+
+def default_retries():
+    return __config.retries
+
+
+def create_adapter(pool_connections=None, pool_maxsize=None, retries=None):
+    retry = Retry(total=retries if retries is not None else __config.retries,
+                  backoff_factor=__config.backoff_factor,
+                  status_forcelist=(500, 502, 503, 504),
+                  raise_on_status=False)
+    return HTTPAdapter(pool_connections=pool_connections or __config.pool_connections,
+                       pool_maxsize=pool_maxsize or __config.pool_maxsize,
+                       max_retries=retry)
+
+
+class InstrumentedSession(requests.Session):
+    """
+    requests.Session with a sized keep-alive pool, a default timeout, retries with backoff on connection errors
+    and 5xx responses (only idempotent methods are retried after the request was sent), call statistics,
+    and an optional `reauth` hook which is called to refresh credentials once a request gets 401.
+    """
+
+    def __init__(self, client_name, reauth: Callable[['InstrumentedSession'], None] = None, timeout=None,
+                 pool_connections=None, pool_maxsize=None, retries=None):
+        super().__init__()
+        self.client_name = client_name
+        self.reauth = reauth
+        self.timeout = timeout or default_timeout()
+        adapter = create_adapter(pool_connections, pool_maxsize, retries)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+    def request(self, method, url, *args, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        resp = self.__timed_request(method, url, *args, **kwargs)
+        if resp.status_code == 401 and self.reauth:
+            logger.info(f"{self.client_name} responded 401 to {method} {endpoint_name(url)}, re-authenticating")
+            self.reauth(self)
+            resp = self.__timed_request(method, url, *args, **kwargs)
+        return resp
+
+    def __timed_request(self, method, url, *args, **kwargs):
+        start = time.perf_counter()
+        failed = True
+        try:
+            resp = super().request(method, url, *args, **kwargs)
+            failed = resp.status_code >= 500
+            return resp
+        finally:
+            record_call(self.client_name, method, url, time.perf_counter() - start, failed)
@@ -0,0 +1,101 @@
+import dataclasses
+import threading
+from collections import defaultdict
+from functools import cache
+from typing import Generic, TypeVar
+
+from utils.db import YtMediaMetadata, add_saved_listener
+from utils.logs import create_logger
+from utils.replica import iter_replicated
+
+T = TypeVar('T')
+
+logger = create_logger("db.index")
+
+
+def index_value(v):
+    # PocketBase returns '' for text fields that were saved as None
+    return None if v == '' else v
+
+
+class IndexedStore(Generic[T]):
+    """
+    In-memory copy of a collection with equality indexes on a few fields, loaded once from the replica
+    and kept up to date with the entities created or saved by this process.
+    Entities are copied in and out, so callers can modify what they get.
+    """
+
+    def __init__(self, db_clazz: type[T], key_field, indexed_fields):
+        self.db_clazz = db_clazz
+        self.key_field = key_field
+        self.indexed_fields = tuple(dict.fromkeys((key_field, *indexed_fields)))
+        self.__entities: dict[str, T] = {}
+        self.__indexes: dict[str, dict[object, set[str]]] = {}
+        self.__loaded = False
+        self.__lock = threading.RLock()
+
+    def refresh(self):
+        """Reloads the store, picking up the changes made outside of this process."""
+        with self.__lock:
+            self.__entities = {}
+            self.__indexes = {f: defaultdict(set) for f in self.indexed_fields}
+            for e in iter_replicated(self.db_clazz):
+                self.__add(e)
+            self.__loaded = True
+            logger.debug(f"Indexed {len(self.__entities)} {self.db_clazz.__name__} records")
+        return self
+
+    def __ensure_loaded(self):
+        if not self.__loaded:
+            self.refresh()
+
+    def __add(self, e: T):
+        self.__entities[e.id] = e
+        for f in self.indexed_fields:
+            self.__indexes[f][index_value(getattr(e, f))].add(e.id)
+
+    def __remove(self, rid):
+        if old := self.__entities.pop(rid, None):
+            for f in self.indexed_fields:
+                ids = self.__indexes[f][index_value(getattr(old, f))]
+                ids.discard(rid)
+                if not ids:
+                    del self.__indexes[f][index_value(getattr(old, f))]
+
+    def put(self, *entities: T):
+        with self.__lock:
+            if not self.__loaded:
+                # Nothing to keep in sync yet, the first lookup loads everything anyway
+                return
+            for e in entities:
+                self.__remove(e.id)
+                self.__add(dataclasses.replace(e))
+
+    def get(self, key) -> T | None:
+        return next(iter(self.find(**{self.key_field: key})), None)
+
+    def find(self, **filters) -> list[T]:
+        """Entities equal to all `filters` on the indexed fields, None matches empty values too."""
+        for f in filters:
+            if f not in self.indexed_fields:
+                raise ValueError(f"{self.db_clazz.__name__} store has no index on '{f}'")
+        with self.__lock:
+            self.__ensure_loaded()
+            ids = None
+            for f, v in sorted(filters.items(), key=lambda kv: len(self.__indexes[kv[0]].get(index_value(kv[1]), ()))):
+                matched = self.__indexes[f].get(index_value(v), set())
+                ids = set(matched) if ids is None else ids & matched
+                if not ids:
+                    return []
+            ids = self.__entities.keys() if ids is None else ids
+            return [dataclasses.replace(self.__entities[rid]) for rid in ids]
+
+    def on_saved(self, entities: list):
+        self.put(*(e for e in entities if isinstance(e, self.db_clazz)))
+
+
+@cache
+def yt_media_metadata_store() -> IndexedStore[YtMediaMetadata]:
+    store = IndexedStore(YtMediaMetadata, 'yt_id', ('alt_id', 'category', 'ignore'))
+    add_saved_listener(store.on_saved)
+    return store
@@ -1,81 +1,113 @@
+import contextvars
 import dataclasses
 import os
-
-from jellyfin_apiclient_python import JellyfinClient
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from functools import cache
 
 from utils.common import chunked
+from utils.http import InstrumentedSession
 from utils.logs import create_logger
 
-client = JellyfinClient()
-import requests
-
-__session__ = requests.Session()
-__session__.headers.update({"Authorization": 'MediaBrowser Client="YourServerScript", Device="BackendServer", DeviceId="unique_server_id", Version="1.0.0"'})
-# __session__.headers.update({"X-Emby-Token": os.getenv('JELLYFIN_APIKEY')})
 __jf_external_url__ = os.getenv('JELLYFIN_PUBLIC_URL')
 __jf_url__ = os.getenv('JELLYFIN_LOCAL_URL') or __jf_external_url__
+__jf_page_size__ = int(os.getenv('JELLYFIN_PAGE_SIZE', '2000'))
+__jf_page_workers__ = int(os.getenv('JELLYFIN_PAGE_WORKERS', '4'))
+__jf_write_workers__ = int(os.getenv('JELLYFIN_WRITE_WORKERS', '4'))
+# Jellyfin (Kestrel) rejects request lines over 8KB, reverse proxies often allow even less
+__jf_max_url_length__ = int(os.getenv('JELLYFIN_MAX_URL_LENGTH', '4096'))
+# How refresh_library() makes Jellyfin pick up the downloaded files: paths, folder or full
+__jf_library_refresh__ = os.getenv('JELLYFIN_LIBRARY_REFRESH', 'paths')
+__jf_library_refresh_timeout__ = int(os.getenv('JELLYFIN_LIBRARY_REFRESH_TIMEOUT', '600'))
+__jf_library_refresh_poll__ = int(os.getenv('JELLYFIN_LIBRARY_REFRESH_POLL', '10'))
+# The targeted modes miss the files that were not downloaded by the sync, a full refresh still runs this often, 0 never
+__jf_library_full_refresh_interval__ = int(os.getenv('JELLYFIN_LIBRARY_FULL_REFRESH_INTERVAL', '86400'))
 logger = create_logger("jellyfin_client")
 
-
-def get_user_session(username, password):
-    global __session__
-    auth_resp = __session__.post(f"{__jf_url__}/Users/AuthenticateByName", json={"Username": username, "Pw": password})
-    if auth_resp.status_code == 200:
-        access_token = auth_resp.json()['AccessToken']
-        user_session = requests.Session()
-        user_session.headers.update({'X-Emby-Token': access_token})
-        __session__ = user_session
-        return user_session
-    logger.error(f"Cannot create a user session for '{username}', status: {auth_resp.status_code}")
-    auth_resp.raise_for_status()
-
-def jf_auth():
-    __session__.headers.update({"X-Emby-Token": os.getenv('JELLYFIN_APIKEY')})
-
-def get_jf_base_url():
-    return __jf_external_url__
-
-
-def load_jf_playlist(pl_id, user_id, fields=""):
-    fields_str = fields
-    if not isinstance(fields_str, str):
-        fields_str = ",".join(fields_str)
-    resp = __session__.get(f"{__jf_url__}/Playlists/{pl_id}/Items", params={'UserId': user_id, "Fields": fields_str})
-    if resp:
-        data = resp.json()
-        return data
+# Items are polled by DateLastSaved, which is the Jellyfin server clock
+LIBRARY_SCAN_CLOCK_SKEW = timedelta(minutes=5)
+CLIENT_AUTHORIZATION = 'MediaBrowser Client="YourServerScript", Device="BackendServer", DeviceId="unique_server_id", Version="1.0.0"'
 
 
-def load_all_items(types="", fields=""):
+def items_query_params(types="", fields=""):
     types_str = types
     if not isinstance(types_str, str):
         types_str = ",".join(types)
     fields_str = fields
     if not isinstance(fields_str, str):
         fields_str = ",".join(fields_str)
-    params = {'IncludeItemTypes': types_str,
-              "Fields": fields_str,
-              "Recursive": "true"}
-    resp = __session__.get(f"{__jf_url__}/Items/", params=params)
-    if resp:
-        data = resp.json()['Items']
-        return data
+    return {'IncludeItemTypes': types_str,
+            "Fields": fields_str,
+            "Recursive": "true",
+            # Only the requested fields, images and user data make the response several times bigger
+            "EnableImages": "false",
+            "EnableUserData": "false",
+            # A stable order, so the pages neither overlap nor skip items. New items go to the end.
+            "SortBy": "DateCreated,SortName"}
 
 
-def load_item_by_id(id, user_id=""):
-    params = {"UserId": user_id}
-    resp = __session__.get(f"{__jf_url__}/Items/{id}", params=params)
-    if resp:
-        return resp.json()
+def iter_pages(load_page, page_size):
+    """Yields the items of the pages returned by `load_page(start, limit)`, fetching the next page meanwhile."""
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        start = 0
+        next_page = executor.submit(load_page, start, page_size)
+        while True:
+            items = next_page.result()['Items']
+            if len(items) == page_size:
+                start += page_size
+                next_page = executor.submit(load_page, start, page_size)
+            yield from items
+            if len(items) < page_size:
+                return
 
 
-def save_item(item):
-    id = item['Id']
-    resp = __session__.post(f"{__jf_url__}/Items/{id}", json=item)
-    return resp.status_code == 204
+class LibraryIndex:
+    """
+    Lookups of library items by file basename, full path, YT provider id and, for the items without one yet,
+    by the yt id parsed from the path with `yt_id_regex`. Built in a single pass over the items.
+    """
+
+    def __init__(self, items, yt_id_regex=None):
+        pattern = re.compile(yt_id_regex) if isinstance(yt_id_regex, str) and yt_id_regex else yt_id_regex
+        self.by_basename: dict[str, dict] = {}
+        self.by_path: dict[str, dict] = {}
+        self.by_yt_id: dict[str, dict] = {}
+        self.by_path_yt_id: dict[str, dict] = {}
+        self.size = 0
+        for itm in items:
+            self.size += 1
+            path = itm.get('Path')
+            if path:
+                self.by_path.setdefault(path, itm)
+                self.by_basename.setdefault(os.path.basename(path), itm)
+            if yt_id := (itm.get('ProviderIds') or {}).get('YT'):
+                self.by_yt_id.setdefault(yt_id, itm)
+            elif path and pattern and (m := pattern.search(path)):
+                self.by_path_yt_id[m.group()] = itm
+
+    def __len__(self):
+        return self.size
+
+
+# What POST /Items/{id} writes back, a field missing from the payload would be cleared on the item
+ITEM_EDIT_FIELDS = ('Path', 'ProviderIds', 'Genres', 'Tags', 'Studios', 'People', 'Overview', 'Taglines', 'SortName',
+                    'OriginalTitle', 'DateCreated', 'ProductionLocations', 'CustomRating', 'Settings')
+
+
+def missing_provider_ids(item, provider_ids: dict[str, str]) -> dict[str, str] | None:
+    """The provider ids the item payload does not have yet, None if it already has another value for any of them."""
+    current = item.setdefault('ProviderIds', {})
+    conflicts = {p: v for p, v in provider_ids.items() if current.get(p) not in (None, v)}
+    if conflicts:
+        logger.warning(f"Cannot set provider ids {conflicts} for '{item.get('Name')}' ({item.get('Id')}), "
+                       f"it already has {current}")
+        return None
+    return {p: v for p, v in provider_ids.items() if current.get(p) is None}
 
-def load_all_playlists():
-    return load_all_items(types="Playlist")
 
 @dataclasses.dataclass
 class User:
@@ -84,86 +116,531 @@ class User:
     raw: dict
 
 
+def user_from_json(data) -> User:
+    allowed_fields = {field.name for field in User.__dataclass_fields__.values()}
+    fields = {k.lower(): v for k, v in data.items() if k.lower() in allowed_fields}
+    fields['raw'] = data
+    return User(**fields)
+
+
+def chunk_ids_by_url_length(base_url_length, ids, max_url_length=None):
+    """Packs the ids into as few comma separated chunks as fit into the url length limit."""
+    max_url_length = max_url_length or __jf_max_url_length__
+    chunks = []
+    chunk, length = [], base_url_length
+    for media_id in ids:
+        # An url encoded comma takes 3 chars
+        id_length = len(media_id) + 3
+        if chunk and length + id_length > max_url_length:
+            chunks.append(chunk)
+            chunk, length = [], base_url_length
+        chunk.append(media_id)
+        length += id_length
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+FOLDER_REFRESH_PARAMS = {"Recursive": "true",
+                         "ImageRefreshMode": "Default",
+                         "MetadataRefreshMode": "Default",
+                         "ReplaceAllImages": "false",
+                         "RegenerateTrickplay": "false",
+                         "ReplaceAllMetadata": "false",
+                         }
+
+
+class JellyfinClient:
+    """
+    One Jellyfin server with its own pooled session and credentials. Clients share no state, so several servers
+    (or users) can be worked with side by side, each client can be used from several threads.
+    The module level functions below call the client set with use_client(), the one from the env by default.
+    """
+
+    def __init__(self, url, external_url=None, api_key=None, name='jellyfin'):
+        self.url = url
+        self.external_url = external_url or url
+        self.name = name
+        self.session = self.__create_session()
+        if api_key:
+            self.session.headers.update({"X-Emby-Token": api_key})
+        self.__credentials = None
+        self.__auth_lock = threading.Lock()
+        self.__full_refreshed_at = None
+
+    def __create_session(self, reauth=None):
+        session = InstrumentedSession(self.name, reauth=reauth)
+        session.headers.update({"Authorization": CLIENT_AUTHORIZATION})
+        return session
+
+    def __repr__(self):
+        return f"JellyfinClient({self.name}, {self.url})"
+
+    def cache_file_name(self, *parts):
+        """Name of a file caching the data of this server, one per server as the same process can sync several."""
+        server = re.sub(r'\W+', '_', re.sub(r'^\w+://', '', self.url)).strip('_')
+        return '_'.join((server, *parts)) + '.json'
+
+    def set_api_key(self, api_key):
+        self.session.headers.update({"X-Emby-Token": api_key})
+
+    def __authenticate(self, username, password):
+        # A session of its own, a 401 of a wrong password must not trigger another login
+        auth_resp = self.__create_session().post(f"{self.url}/Users/AuthenticateByName",
+                                                 json={"Username": username, "Pw": password})
+        if auth_resp.status_code != 200:
+            logger.error(f"Cannot create a user session for '{username}' on {self.url}, status: {auth_resp.status_code}")
+            auth_resp.raise_for_status()
+        # In place, the threads sharing the session pick the token up with their next request
+        self.session.headers.update({'X-Emby-Token': auth_resp.json()['AccessToken']})
+
+    def login(self, username, password):
+        """Switches this client to the user's credentials, returns the session. A 401 logs the user in again."""
+        with self.__auth_lock:
+            self.__authenticate(username, password)
+            self.__credentials = (username, password)
+            self.session.reauth = lambda session: self.reauthenticate(session.headers.get('X-Emby-Token'))
+        return self.session
+
+    def reauthenticate(self, stale_token) -> bool:
+        """
+        Logs the user in again after `stale_token` got 401. Whoever comes second after a concurrent 401 finds the
+        token already replaced and does not log in again. Returns False when there are no credentials to log in with.
+        """
+        with self.__auth_lock:
+            if self.__credentials is None:
+                return False
+            if self.session.headers.get('X-Emby-Token') == stale_token:
+                self.__authenticate(*self.__credentials)
+            return True
+
+    def auth_headers(self) -> dict[str, str]:
+        """Credentials of the session, for the clients which do not share it."""
+        return {k: v for k, v in self.session.headers.items() if k in ('Authorization', 'X-Emby-Token') and v is not None}
+
+    def load_jf_playlist(self, pl_id, user_id, fields=""):
+        fields_str = fields
+        if not isinstance(fields_str, str):
+            fields_str = ",".join(fields_str)
+        resp = self.session.get(f"{self.url}/Playlists/{pl_id}/Items", params={'UserId': user_id, "Fields": fields_str})
+        if resp:
+            data = resp.json()
+            return data
+
+    def load_items_page(self, params, start, limit, total=False):
+        params = params | {"StartIndex": start, "Limit": limit, "EnableTotalRecordCount": str(total).lower()}
+        resp = self.session.get(f"{self.url}/Items/", params=params)
+        resp.raise_for_status()
+        return resp.json()
+
+    def load_all_items(self, types="", fields="", page_size=None, max_workers=None, **filters):
+        """
+        Loads the items page by page, the first page tells how many there are and the rest is fetched concurrently.
+        `filters` are extra /Items query params, e.g. MinDateLastSaved.
+        """
+        page_size = page_size or __jf_page_size__
+        max_workers = max_workers or __jf_page_workers__
+        params = items_query_params(types, fields) | filters
+        first_page = self.load_items_page(params, 0, page_size, total=True)
+        items = first_page['Items']
+        starts = range(page_size, first_page['TotalRecordCount'], page_size)
+        if starts:
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(starts))) as executor:
+                for page in executor.map(lambda start: self.load_items_page(params, start, page_size), starts):
+                    items += page['Items']
+        return items
+
+    def iter_all_items(self, types="", fields="", page_size=None, **filters):
+        """Streaming variant of load_all_items(), yields the items of a page while the next one is being fetched."""
+        params = items_query_params(types, fields) | filters
+        return iter_pages(lambda start, limit: self.load_items_page(params, start, limit), page_size or __jf_page_size__)
+
+    def load_playlist_page(self, pl_id, user_id, start, limit, fields=""):
+        fields_str = fields
+        if not isinstance(fields_str, str):
+            fields_str = ",".join(fields_str)
+        params = {'UserId': user_id, "Fields": fields_str, "EnableImages": "false", "EnableUserData": "false",
+                  "StartIndex": start, "Limit": limit}
+        resp = self.session.get(f"{self.url}/Playlists/{pl_id}/Items", params=params)
+        resp.raise_for_status()
+        return resp.json()
+
+    def iter_playlist_items(self, pl_id, user_id, fields="", page_size=None):
+        """Paged variant of load_jf_playlist(), yields the playlist entries."""
+        return iter_pages(lambda start, limit: self.load_playlist_page(pl_id, user_id, start, limit, fields),
+                          page_size or __jf_page_size__)
+
+    def load_item_by_id(self, id, user_id=""):
+        params = {"UserId": user_id}
+        resp = self.session.get(f"{self.url}/Items/{id}", params=params)
+        if resp:
+            return resp.json()
+
+    def save_item(self, item):
+        id = item['Id']
+        resp = self.session.post(f"{self.url}/Items/{id}", json=item)
+        return resp.status_code == 204
+
+    def load_items_by_ids(self, ids, fields="", batch_size=200) -> dict[str, dict]:
+        items = {}
+        for chunk in chunked(list(ids), batch_size):
+            for itm in self.load_all_items(fields=fields, Ids=','.join(chunk)):
+                items[itm['Id']] = itm
+        return items
+
+    def load_items_for_edit(self, ids, batch_size=200) -> dict[str, dict]:
+        """Editable payloads of the items, fetched in bulk rather than with a full GET per item."""
+        return self.load_items_by_ids(ids, ITEM_EDIT_FIELDS, batch_size)
+
+    def stamp_provider_ids(self, stamps: dict[str, dict[str, str]], max_workers=None) -> dict[str, bool]:
+        """
+        Sets provider ids, e.g. `{item_id: {'YT': yt_id}}`, on the items which do not have them yet.
+        The payloads are loaded in bulk and saved from a bounded pool of concurrent writers.
+        An item that already has another value for a provider is left as it is and reported as failed.
+        """
+        if not stamps:
+            return {}
+        items = self.load_items_for_edit(stamps.keys())
+
+        def stamp(item_id):
+            item = items.get(item_id)
+            if item is None:
+                logger.warning(f"Cannot find item {item_id} to set its provider ids {stamps[item_id]}")
+                return False
+            missing = missing_provider_ids(item, stamps[item_id])
+            if missing is None:
+                return False
+            if not missing:
+                return True
+            item['ProviderIds'].update(missing)
+            try:
+                if self.save_item(item):
+                    return True
+                logger.error(f"Jellyfin did not save provider ids {stamps[item_id]} for '{item.get('Name')}' ({item_id})")
+            except:
+                logger.exception(f"Cannot save provider ids {stamps[item_id]} for '{item.get('Name')}' ({item_id})")
+            return False
+
+        ids = list(stamps)
+        with ThreadPoolExecutor(max_workers=min(max_workers or __jf_write_workers__, len(ids))) as executor:
+            return dict(zip(ids, executor.map(stamp, ids)))
+
+    def load_all_playlists(self):
+        return self.load_all_items(types="Playlist")
+
+    def get_current_user(self):
+        resp = self.session.get(f"{self.url}/Users/Me")
+        if resp:
+            return user_from_json(resp.json())
+        else:
+            logger.warning("Cannot find current user")
+
+    def find_user_by_name(self, name):
+        resp = self.session.get(f"{self.url}/Users")
+        if resp:
+            data = resp.json()
+            found = next((u for u in data if u['Name'] == name), None)
+            if found:
+                return user_from_json(found)
+            else:
+                logger.warning(f"Cannot find user '{name}'")
+
+    def add_media_ids_to_playlist(self, pl_id, media_ids, user_id, max_workers=1) -> dict[str, bool]:
+        """
+        Adds the items in chunks as big as the url length limit allows, a failed chunk is split in half and retried
+        until the failing ids are isolated. Returns whether each id was added.
+        Chunks are sent one after another unless `max_workers` > 1, parallel chunks may land in the playlist in any order.
+        """
+        url = f"{self.url}/playlists/{pl_id}/Items"
+
+        def add(ids) -> dict[str, bool]:
+            try:
+                response = self.session.post(url, params={'userId': user_id, 'ids': ','.join(ids)})
+                response.raise_for_status()
+                return dict.fromkeys(ids, True)
+            except Exception as e:
+                error = e
+            if len(ids) == 1:
+                logger.error(f"Could not add media_id {ids[0]} into playlist ({pl_id}): {error}")
+                return {ids[0]: False}
+            logger.warning(f"Could not add {len(ids)} media_ids into playlist ({pl_id}), retrying them in halves: {error}")
+            mid = len(ids) // 2
+            return add(ids[:mid]) | add(ids[mid:])
+
+        media_ids = list(dict.fromkeys(media_ids))
+        base_url_length = len(f"{url}?userId={user_id}&ids=")
+        results = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for outcome in executor.map(add, chunk_ids_by_url_length(base_url_length, media_ids)):
+                results |= outcome
+        return results
+
+    def remove_playlist_entries(self, pl_id, entry_ids) -> dict[str, bool]:
+        """Removes the entries (PlaylistItemId, not the item id) in chunks as big as the url length limit allows."""
+        url = f"{self.url}/Playlists/{pl_id}/Items"
+        entry_ids = list(dict.fromkeys(entry_ids))
+        results = {}
+        for chunk in chunk_ids_by_url_length(len(f"{url}?entryIds="), entry_ids):
+            resp = self.session.delete(url, params={'entryIds': ','.join(chunk)})
+            if not resp:
+                logger.error(f"Could not remove {len(chunk)} entries from playlist ({pl_id}), status: {resp.status_code}")
+            results |= dict.fromkeys(chunk, bool(resp))
+        return results
+
+    def move_playlist_entry(self, pl_id, entry_id, index):
+        """Moves the entry to `index` of the playlist without the entry."""
+        resp = self.session.post(f"{self.url}/Playlists/{pl_id}/Items/{entry_id}/Move/{index}")
+        if not resp:
+            logger.error(f"Could not move entry {entry_id} of playlist ({pl_id}) to {index}, status: {resp.status_code}")
+        return bool(resp)
+
+    def create_playlist(self, ytm_pl_name, user_id, type=None):
+        # http: // {{jf_hostport}} / playlists /?name = test & userId = 85e1d3cd5c8b49de9c225d5f8d39e79e & mediaType = Audio
+        params = {
+            'name': ytm_pl_name,
+            'userId': user_id,
+            'mediaType': type
+        }
+        resp = self.session.post(f"{self.url}/Playlists/", params=params)
+        resp.raise_for_status()
+        return resp.json()['Id']
+
+    def remove_item(self, itm_id):
+        resp = self.session.delete(f"{self.url}/Items/{itm_id}")
+        return resp.status_code == 204
+
+    def load_all_virtual_folders(self):
+        resp = self.session.get(f"{self.url}/Library/VirtualFolders")
+        if resp:
+            return resp.json()
+        else:
+            logger.warning("Cannot load virtual folders")
+
+    def refresh_virtual_folder(self, vf_id):
+        resp = self.session.post(f"{self.url}/Items/{vf_id}/Refresh", params=FOLDER_REFRESH_PARAMS)
+        return resp.status_code == 204
+
+    def reload_library(self):
+        self.session.post(f"{self.url}/Library/Refresh")
+        for vf in self.load_all_virtual_folders():
+            try:
+                if self.refresh_virtual_folder(vf['ItemId']):
+                    logger.info(f"Virtual folder {vf['Name']} ({vf['ItemId']}) refreshed successfully")
+                else:
+                    logger.warning(f"Failed to refresh virtual folder '{vf['Name']}' ({vf['ItemId']})")
+            except:
+                logger.warning(f"Cannot refresh virtual folder '{vf['Name']}' ({vf['ItemId']})")
+
+    def report_media_updated(self, paths, update_type="Created"):
+        """Tells Jellyfin about changed files, it scans just them instead of the whole library."""
+        resp = self.session.post(f"{self.url}/Library/Media/Updated",
+                                 json={"Updates": [{"Path": p, "UpdateType": update_type} for p in paths]})
+        return resp.status_code == 204
+
+    def find_folder_by_path(self, path):
+        """The deepest library folder containing `path`."""
+        path = path.rstrip('/')
+        folders = [f for f in self.load_all_items("Folder,CollectionFolder", "Path")
+                   if f.get('Path') and (path + '/').startswith(f['Path'].rstrip('/') + '/')]
+        return max(folders, key=lambda f: len(f['Path']), default=None)
+
+    def wait_for_library_items(self, paths, since: datetime, timeout=None, poll_interval=None, types="Audio") -> set[str]:
+        """
+        Polls for the items saved since `since` until there is one for each of the `paths` or the timeout expires.
+        Paths are matched by their basename, the same as the download tasks are. Returns the paths that did not show up.
+        """
+        timeout = __jf_library_refresh_timeout__ if timeout is None else timeout
+        poll_interval = __jf_library_refresh_poll__ if poll_interval is None else poll_interval
+        missing = {os.path.basename(p): p for p in paths}
+        deadline = time.monotonic() + timeout
+        min_date = (since - LIBRARY_SCAN_CLOCK_SKEW).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+        while missing:
+            for itm in self.load_all_items(types, "Path", MinDateLastSaved=min_date):
+                missing.pop(os.path.basename(itm.get('Path') or ''), None)
+            if not missing or time.monotonic() >= deadline:
+                break
+            time.sleep(poll_interval)
+        return set(missing.values())
+
+    def refresh_library(self, paths, folder=None, mode=None, timeout=None) -> set[str]:
+        """
+        Makes Jellyfin pick up the new files at `paths` and waits until they are in the library, paths are as Jellyfin
+        sees them. Modes: 'paths' reports just the files, 'folder' rescans only `folder`, 'full' runs reload_library().
+        A targeted mode falls back to a broader one when Jellyfin does not accept it, and gives way to 'full' once per
+        JELLYFIN_LIBRARY_FULL_REFRESH_INTERVAL. Returns the paths that are still not in the library.
+        """
+        mode = mode or __jf_library_refresh__
+        if mode != 'full' and self.__full_refresh_due():
+            logger.info("Running the periodic full refresh of the library")
+            mode = 'full'
+        paths = list(paths)
+        since = datetime.now(timezone.utc)
+        if mode == 'paths':
+            if not paths:
+                return set()
+            if self.report_media_updated(paths):
+                logger.info(f"Reported {len(paths)} new files to Jellyfin")
+            else:
+                logger.warning("Jellyfin did not accept the new file paths, refreshing the folder instead")
+                mode = 'folder'
+        if mode == 'folder':
+            if not paths:
+                return set()
+            jf_folder = self.find_folder_by_path(folder) if folder else None
+            if jf_folder and self.refresh_virtual_folder(jf_folder['Id']):
+                logger.info(f"Refreshing folder '{jf_folder['Path']}' ({jf_folder['Id']})")
+            else:
+                logger.warning(f"Cannot refresh the library folder of '{folder}', refreshing the whole library instead")
+                mode = 'full'
+        if mode == 'full':
+            self.reload_library()
+            self.__full_refreshed_at = time.monotonic()
+        return self.wait_for_library_items(paths, since, timeout) if paths else set()
+
+    def __full_refresh_due(self):
+        if not __jf_library_full_refresh_interval__:
+            return False
+        return self.__full_refreshed_at is None or \
+            time.monotonic() - self.__full_refreshed_at >= __jf_library_full_refresh_interval__
+
+
+@cache
+def default_client() -> JellyfinClient:
+    """The server configured with JELLYFIN_LOCAL_URL/JELLYFIN_PUBLIC_URL."""
+    return JellyfinClient(__jf_url__, __jf_external_url__)
+
+
+__current_client = contextvars.ContextVar('jellyfin_client', default=None)
+
+
+def current_client() -> JellyfinClient:
+    return __current_client.get() or default_client()
+
+
+@contextmanager
+def use_client(client: JellyfinClient):
+    """
+    Makes the module level functions talk to `client` within the block, e.g. in a thread syncing another server.
+    Context variables are not inherited by new threads, the block has to be entered in the thread that uses it.
+    """
+    token = __current_client.set(client)
+    try:
+        yield client
+    finally:
+        __current_client.reset(token)
+
+
+def get_user_session(username, password):
+    return current_client().login(username, password)
+
+def jf_auth():
+    current_client().set_api_key(os.getenv('JELLYFIN_APIKEY'))
+
+def auth_headers() -> dict[str, str]:
+    return current_client().auth_headers()
+
+
+def get_jf_base_url():
+    return current_client().external_url
+
+
+def get_jf_url():
+    return current_client().url
+
+
+def load_jf_playlist(pl_id, user_id, fields=""):
+    return current_client().load_jf_playlist(pl_id, user_id, fields)
+
+
+def load_items_page(params, start, limit, total=False):
+    return current_client().load_items_page(params, start, limit, total)
+
+
+def load_all_items(types="", fields="", page_size=None, max_workers=None, **filters):
+    return current_client().load_all_items(types, fields, page_size, max_workers, **filters)
+
+
+def iter_all_items(types="", fields="", page_size=None, **filters):
+    return current_client().iter_all_items(types, fields, page_size, **filters)
+
+
+def load_playlist_page(pl_id, user_id, start, limit, fields=""):
+    return current_client().load_playlist_page(pl_id, user_id, start, limit, fields)
+
+
+def iter_playlist_items(pl_id, user_id, fields="", page_size=None):
+    return current_client().iter_playlist_items(pl_id, user_id, fields, page_size)
+
+
+def load_item_by_id(id, user_id=""):
+    return current_client().load_item_by_id(id, user_id)
+
+
+def save_item(item):
+    return current_client().save_item(item)
+
+
+def load_items_by_ids(ids, fields="", batch_size=200) -> dict[str, dict]:
+    return current_client().load_items_by_ids(ids, fields, batch_size)
+
+
+def load_items_for_edit(ids, batch_size=200) -> dict[str, dict]:
+    return current_client().load_items_for_edit(ids, batch_size)
+
+
+def stamp_provider_ids(stamps: dict[str, dict[str, str]], max_workers=None) -> dict[str, bool]:
+    return current_client().stamp_provider_ids(stamps, max_workers)
+
+
+def load_all_playlists():
+    return current_client().load_all_playlists()
+
+
 def get_current_user():
-    resp = __session__.get(f"{__jf_url__}/Users/Me")
-    if resp:
-        data = resp.json()
-        allowed_fields = {field.name for field in User.__dataclass_fields__.values()}
-        data = {k.lower(): v for k, v in data.items() if k.lower() in allowed_fields}
-        data['raw'] = resp.json()
-        return User(**data)
-    else:
-        logger.warning(f"Cannot find current user")
+    return current_client().get_current_user()
 
 def find_user_by_name(name):
-    resp = __session__.get(f"{__jf_url__}/Users")
-    if resp:
-        data = resp.json()
-        found = next((u for u in data if u['Name'] == name), None)
-        if found:
-            allowed_fields = {field.name for field in User.__dataclass_fields__.values()}
-            data = {k.lower(): v for k, v in found.items() if k.lower() in allowed_fields}
-            data['raw'] = found
-            return User(**data)
-        else:
-            logger.warning(f"Cannot find user '{name}'")
+    return current_client().find_user_by_name(name)
+
 
+def add_media_ids_to_playlist(pl_id, media_ids, user_id, max_workers=1) -> dict[str, bool]:
+    return current_client().add_media_ids_to_playlist(pl_id, media_ids, user_id, max_workers)
 
-def add_media_ids_to_playlist(pl_id, media_ids, user_id):
-    n = 0
-    for ids in chunked(media_ids, 10):
-        try:
-            params = {
-                'userId': user_id,
-                'ids': ','.join(ids)
-            }
-            response = __session__.post(f"{__jf_url__}/playlists/{pl_id}/Items", params=params)
-            response.raise_for_status()
-            n += len(ids)
-        except:
-            logger.exception(f"Could not add media_ids ({','.join(ids)}) into playlist ({pl_id})")
-    return n
+
+def remove_playlist_entries(pl_id, entry_ids) -> dict[str, bool]:
+    return current_client().remove_playlist_entries(pl_id, entry_ids)
+
+
+def move_playlist_entry(pl_id, entry_id, index):
+    return current_client().move_playlist_entry(pl_id, entry_id, index)
 
 
 def create_playlist(ytm_pl_name, user_id, type=None):
-    # http: // {{jf_hostport}} / playlists /?name = test & userId = 85e1d3cd5c8b49de9c225d5f8d39e79e & mediaType = Audio
-    params = {
-        'name': ytm_pl_name,
-        'userId': user_id,
-        'mediaType': type
-    }
-    resp = __session__.post(f"{__jf_url__}/Playlists/", params=params)
-    resp.raise_for_status()
-    return resp.json()['Id']
+    return current_client().create_playlist(ytm_pl_name, user_id, type)
 
 def remove_item(itm_id):
-    resp = __session__.delete(f"{__jf_url__}/Items/{itm_id}")
-    return resp.status_code == 204
+    return current_client().remove_item(itm_id)
 
 def load_all_virtual_folders():
-    resp = __session__.get(f"{__jf_url__}/Library/VirtualFolders")
-    if resp:
-        return resp.json()
-    else:
-        logger.warning(f"Cannot load virtual folders")
+    return current_client().load_all_virtual_folders()
 
 def refresh_virtual_folder(vf_id):
-    resp = __session__.post(f"{__jf_url__}/Items/{vf_id}/Refresh", params={"Recursive": "true",
-                                                                           "ImageRefreshMode":"Default",
-                                                                           "MetadataRefreshMode":"Default",
-                                                                           "ReplaceAllImages":"false",
-                                                                           "RegenerateTrickplay":"false",
-                                                                           "ReplaceAllMetadata":"false",
-                                                                           })
-    return resp.status_code == 204
+    return current_client().refresh_virtual_folder(vf_id)
 
 def reload_library():
-    __session__.post(f"{__jf_url__}/Library/Refresh")
-    for vf in load_all_virtual_folders():
-        try:
-            if refresh_virtual_folder(vf['ItemId']):
-                logger.info(f"Virtual folder {vf['Name']} ({vf['ItemId']}) refreshed successfully")
-            else:
-                logger.warning(f"Failed to refresh virtual folder '{vf['Name']}' ({vf['ItemId']})")
-        except:
-            logger.warning(f"Cannot refresh virtual folder '{vf['Name']}' ({vf['ItemId']})")
\ No newline at end of file
+    current_client().reload_library()
+
+def report_media_updated(paths, update_type="Created"):
+    return current_client().report_media_updated(paths, update_type)
+
+
+def find_folder_by_path(path):
+    return current_client().find_folder_by_path(path)
+
+
+def wait_for_library_items(paths, since: datetime, timeout=None, poll_interval=None, types="Audio") -> set[str]:
+    return current_client().wait_for_library_items(paths, since, timeout, poll_interval, types)
+
+
+def refresh_library(paths, folder=None, mode=None, timeout=None) -> set[str]:
+    return current_client().refresh_library(paths, folder, mode, timeout)
@@ -0,0 +1,208 @@
+import asyncio
+import logging
+import os
+import time
+
+import httpx
+
+from utils import jf
+from utils.common import chunked
+from utils.http import record_call, default_timeout, default_retries
+from utils.jf import JellyfinClient, current_client, items_query_params, chunk_ids_by_url_length, missing_provider_ids, \
+    user_from_json, User, ITEM_EDIT_FIELDS, FOLDER_REFRESH_PARAMS
+from utils.logs import create_logger
+
+__jf_async_max_concurrency__ = int(os.getenv('JELLYFIN_ASYNC_MAX_CONCURRENCY', '64'))
+__jf_async_http2__ = os.getenv('JELLYFIN_ASYNC_HTTP2', '1') == '1'
+logger = create_logger("jellyfin_async")
+# httpx logs every request at INFO, the call statistics cover that
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+
+class AsyncJellyfinClient:
+    """
+    asyncio counterpart of utils.jf.JellyfinClient, it talks to the server of `client` with its credentials
+    (current_client() by default) unless `url`/`headers` are given.
+    All requests go through one (HTTP/2 unless disabled) connection pool and at most `max_concurrency` of them are in
+    flight, so large fan-outs, e.g. stamping thousands of items, are plain asyncio.gather() calls on one thread.
+    Use it as `async with AsyncJellyfinClient() as client:`.
+    """
+
+    def __init__(self, client: JellyfinClient = None, url=None, headers=None, max_concurrency=None, http2=None,
+                 timeout=None, transport: httpx.AsyncBaseTransport = None):
+        client = client or current_client()
+        self.url = (url or client.url).rstrip('/')
+        self.max_concurrency = max_concurrency or __jf_async_max_concurrency__
+        http2 = __jf_async_http2__ if http2 is None else http2
+        limits = httpx.Limits(max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency)
+        transport = transport or httpx.AsyncHTTPTransport(http2=http2, limits=limits, retries=default_retries())
+        self.__client = httpx.AsyncClient(base_url=self.url, transport=transport,
+                                          headers=client.auth_headers() if headers is None else headers,
+                                          timeout=timeout or default_timeout())
+        # Logs in again on 401, only with the credentials of `client`
+        self.__jf = client if headers is None else None
+        self.__semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+    async def aclose(self):
+        await self.__client.aclose()
+
+    async def request(self, method, path, **kwargs) -> httpx.Response:
+        resp = await self.__request(method, path, **kwargs)
+        if resp.status_code == 401 and self.__jf is not None:
+            logger.info(f"Jellyfin responded 401 to {method} {path}, re-authenticating")
+            stale_token = self.__client.headers.get('X-Emby-Token')
+            if await asyncio.to_thread(self.__jf.reauthenticate, stale_token):
+                self.__client.headers.update(self.__jf.auth_headers())
+                resp = await self.__request(method, path, **kwargs)
+        return resp
+
+    async def __request(self, method, path, **kwargs) -> httpx.Response:
+        async with self.__semaphore:
+            start = time.perf_counter()
+            failed = True
+            try:
+                resp = await self.__client.request(method, path, **kwargs)
+                failed = resp.status_code >= 500
+                return resp
+            finally:
+                record_call('jellyfin_async', method, self.url + path, time.perf_counter() - start, failed)
+
+    async def get_json(self, path, **kwargs):
+        resp = await self.request('GET', path, **kwargs)
+        resp.raise_for_status()
+        return resp.json()
+
+    async def load_items_page(self, params, start, limit, total=False):
+        params = params | {"StartIndex": start, "Limit": limit, "EnableTotalRecordCount": str(total).lower()}
+        return await self.get_json("/Items/", params=params)
+
+    async def load_all_items(self, types="", fields="", page_size=None, **filters) -> list[dict]:
+        """The first page tells how many items there are, the rest of the pages are fetched concurrently."""
+        page_size = page_size or jf.__jf_page_size__
+        params = items_query_params(types, fields) | filters
+        first_page = await self.load_items_page(params, 0, page_size, total=True)
+        pages = await asyncio.gather(*(self.load_items_page(params, start, page_size)
+                                       for start in range(page_size, first_page['TotalRecordCount'], page_size)))
+        return first_page['Items'] + [itm for page in pages for itm in page['Items']]
+
+    async def load_item_by_id(self, id, user_id=""):
+        resp = await self.request('GET', f"/Items/{id}", params={"userId": user_id} if user_id else None)
+        if resp.is_success:
+            return resp.json()
+
+    async def save_item(self, item):
+        resp = await self.request('POST', f"/Items/{item['Id']}", json=item)
+        return resp.status_code == 204
+
+    async def load_items_for_edit(self, ids, batch_size=200) -> dict[str, dict]:
+        batches = await asyncio.gather(*(self.load_all_items(fields=ITEM_EDIT_FIELDS, Ids=','.join(chunk))
+                                         for chunk in chunked(list(ids), batch_size)))
+        return {itm['Id']: itm for batch in batches for itm in batch}
+
+    async def stamp_provider_ids(self, stamps: dict[str, dict[str, str]]) -> dict[str, bool]:
+        """Same as utils.jf.stamp_provider_ids(), all the items are saved concurrently."""
+        if not stamps:
+            return {}
+        items = await self.load_items_for_edit(stamps.keys())
+
+        async def stamp(item_id):
+            item = items.get(item_id)
+            if item is None:
+                logger.warning(f"Cannot find item {item_id} to set its provider ids {stamps[item_id]}")
+                return False
+            missing = missing_provider_ids(item, stamps[item_id])
+            if missing is None:
+                return False
+            if not missing:
+                return True
+            item['ProviderIds'].update(missing)
+            try:
+                if await self.save_item(item):
+                    return True
+                logger.error(f"Jellyfin did not save provider ids {stamps[item_id]} for '{item.get('Name')}' ({item_id})")
+            except:
+                logger.exception(f"Cannot save provider ids {stamps[item_id]} for '{item.get('Name')}' ({item_id})")
+            return False
+
+        ids = list(stamps)
+        return dict(zip(ids, await asyncio.gather(*map(stamp, ids))))
+
+    async def load_playlist_items(self, pl_id, user_id, fields="", page_size=None) -> list[dict]:
+        page_size = page_size or jf.__jf_page_size__
+        fields_str = fields if isinstance(fields, str) else ",".join(fields)
+        params = {'UserId': user_id, "Fields": fields_str, "EnableImages": "false", "EnableUserData": "false"}
+
+        async def load_page(start):
+            return await self.get_json(f"/Playlists/{pl_id}/Items",
+                                       params=params | {"StartIndex": start, "Limit": page_size})
+
+        first_page = await load_page(0)
+        pages = await asyncio.gather(*map(load_page, range(page_size, first_page.get('TotalRecordCount', 0), page_size)))
+        return first_page['Items'] + [itm for page in pages for itm in page['Items']]
+
+    async def add_media_ids_to_playlist(self, pl_id, media_ids, user_id) -> dict[str, bool]:
+        """Same as utils.jf.add_media_ids_to_playlist(), the chunks are sent one after another to keep the order."""
+        path = f"/playlists/{pl_id}/Items"
+
+        async def add(ids) -> dict[str, bool]:
+            try:
+                resp = await self.request('POST', path, params={'userId': user_id, 'ids': ','.join(ids)})
+                resp.raise_for_status()
+                return dict.fromkeys(ids, True)
+            except Exception as e:
+                error = e
+            if len(ids) == 1:
+                logger.error(f"Could not add media_id {ids[0]} into playlist ({pl_id}): {error}")
+                return {ids[0]: False}
+            logger.warning(f"Could not add {len(ids)} media_ids into playlist ({pl_id}), retrying them in halves: {error}")
+            mid = len(ids) // 2
+            return await add(ids[:mid]) | await add(ids[mid:])
+
+        media_ids = list(dict.fromkeys(media_ids))
+        results = {}
+        for chunk in chunk_ids_by_url_length(len(f"{self.url}{path}?userId={user_id}&ids="), media_ids):
+            results |= await add(chunk)
+        return results
+
+    async def load_all_playlists(self):
+        return await self.load_all_items(types="Playlist")
+
+    async def create_playlist(self, name, user_id, type=None):
+        resp = await self.request('POST', "/Playlists/", params={'name': name, 'userId': user_id, 'mediaType': type})
+        resp.raise_for_status()
+        return resp.json()['Id']
+
+    async def get_current_user(self) -> User | None:
+        resp = await self.request('GET', "/Users/Me")
+        if resp.is_success:
+            return user_from_json(resp.json())
+        logger.warning("Cannot find current user")
+
+    async def find_user_by_name(self, name) -> User | None:
+        found = next((u for u in await self.get_json("/Users") if u['Name'] == name), None)
+        if found:
+            return user_from_json(found)
+        logger.warning(f"Cannot find user '{name}'")
+
+    async def report_media_updated(self, paths, update_type="Created"):
+        resp = await self.request('POST', "/Library/Media/Updated",
+                                  json={"Updates": [{"Path": p, "UpdateType": update_type} for p in paths]})
+        return resp.status_code == 204
+
+    async def refresh_folder(self, folder_id):
+        resp = await self.request('POST', f"/Items/{folder_id}/Refresh", params=FOLDER_REFRESH_PARAMS)
+        return resp.status_code == 204
+
+    async def reload_library(self):
+        await self.request('POST', "/Library/Refresh")
+        folders = await self.get_json("/Library/VirtualFolders")
+        refreshed = await asyncio.gather(*(self.refresh_folder(vf['ItemId']) for vf in folders), return_exceptions=True)
+        for vf, ok in zip(folders, refreshed):
+            if ok is not True:
+                logger.warning(f"Failed to refresh virtual folder '{vf['Name']}' ({vf['ItemId']}): {ok}")
@@ -0,0 +1,150 @@
+import dataclasses
+import json
+import os
+import queue
+import threading
+import time
+from typing import Callable
+from urllib.parse import urlencode
+
+import websocket
+
+from utils.jf import JellyfinClient, current_client
+from utils.logs import create_logger
+
+logger = create_logger("jellyfin_events")
+
+
+@dataclasses.dataclass
+class __EventsConfig:
+    enabled = os.getenv('JELLYFIN_EVENTS', '1') == '1'
+    # Jellyfin reports a scan in several LibraryChanged messages, they are handled together
+    debounce = float(os.getenv('JELLYFIN_EVENTS_DEBOUNCE', '5'))
+
+
+__config = __EventsConfig()
+
+# Until the server asks for another interval with ForceKeepAlive
+DEFAULT_KEEPALIVE_INTERVAL = 30
+
+
+@dataclasses.dataclass
+class LibraryChange:
+    added: set[str] = dataclasses.field(default_factory=set)
+    updated: set[str] = dataclasses.field(default_factory=set)
+    removed: set[str] = dataclasses.field(default_factory=set)
+
+    @staticmethod
+    def from_json(data: dict) -> 'LibraryChange':
+        return LibraryChange(set(data.get('ItemsAdded') or ()),
+                             set(data.get('ItemsUpdated') or ()),
+                             set(data.get('ItemsRemoved') or ()))
+
+    def merge(self, later: 'LibraryChange') -> 'LibraryChange':
+        return LibraryChange(added=(self.added | later.added) - later.removed,
+                             updated=(self.updated | later.updated) - later.removed,
+                             removed=(self.removed - later.added) | later.removed)
+
+    def __bool__(self):
+        return bool(self.added or self.updated or self.removed)
+
+
+def events_enabled():
+    return __config.enabled
+
+
+def default_debounce():
+    return __config.debounce
+
+
+def socket_url(client: JellyfinClient):
+    url = client.url.replace('https://', 'wss://', 1).replace('http://', 'ws://', 1).rstrip('/')
+    params = {'deviceId': 'yt2jf_playsync'}
+    if token := client.auth_headers().get('X-Emby-Token'):
+        params['api_key'] = token
+    return f"{url}/socket?{urlencode(params)}"
+
+
+class LibraryEventListener:
+    """
+    Subscribes to the LibraryChanged messages of the Jellyfin websocket (/socket) and calls `handler` with the changed
+    item ids. Messages arriving within `debounce` seconds of each other are merged into one call, the handler runs
+    in its own thread, so a slow handler neither blocks the keep-alives nor loses messages.
+    Changes made while the socket is down are not replayed, the regular sync cycle picks them up.
+    """
+
+    def __init__(self, handler: Callable[[LibraryChange], None], client: JellyfinClient = None, debounce=None):
+        self.handler = handler
+        self.client = client or current_client()
+        self.debounce = default_debounce() if debounce is None else debounce
+        self.__changes: queue.Queue[LibraryChange] = queue.Queue()
+        self.__stopped = threading.Event()
+        self.__ws = None
+
+    def start(self):
+        threading.Thread(target=self.__listen, name="jf-events", daemon=True).start()
+        threading.Thread(target=self.__dispatch, name="jf-events-handler", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.__stopped.set()
+        if self.__ws:
+            self.__ws.close()
+
+    def __listen(self):
+        retry_delay = 1
+        while not self.__stopped.is_set():
+            try:
+                self.__ws = websocket.create_connection(socket_url(self.client), timeout=10,
+                                                        header=[f"{k}: {v}" for k, v in self.client.auth_headers().items()])
+                logger.info(f"Listening to the library changes of {self.client.url}")
+                retry_delay = 1
+                self.__receive(self.__ws)
+            except:
+                if self.__stopped.is_set():
+                    return
+                logger.warning(f"Jellyfin websocket failed, reconnecting in {retry_delay}s", exc_info=True)
+                self.__stopped.wait(retry_delay)
+                retry_delay = min(retry_delay * 2, 300)
+            finally:
+                if self.__ws:
+                    self.__ws.close()
+
+    def __receive(self, ws: websocket.WebSocket):
+        keepalive_interval = DEFAULT_KEEPALIVE_INTERVAL
+        last_sent = time.monotonic()
+        while not self.__stopped.is_set():
+            ws.settimeout(max(1.0, keepalive_interval - (time.monotonic() - last_sent)))
+            try:
+                raw = ws.recv()
+            except websocket.WebSocketTimeoutException:
+                raw = None
+            if time.monotonic() - last_sent >= keepalive_interval:
+                ws.send(json.dumps({"MessageType": "KeepAlive"}))
+                last_sent = time.monotonic()
+            if not raw:
+                continue
+            message = json.loads(raw)
+            message_type = message.get('MessageType')
+            if message_type == 'ForceKeepAlive':
+                # Data is the server timeout in seconds, keep-alives go twice as often
+                keepalive_interval = max(1.0, float(message['Data']) / 2)
+            elif message_type == 'LibraryChanged':
+                if change := LibraryChange.from_json(message.get('Data') or {}):
+                    logger.debug(f"Library changed: {len(change.added)} added, {len(change.updated)} updated, "
+                                 f"{len(change.removed)} removed")
+                    self.__changes.put(change)
+
+    def __dispatch(self):
+        while not self.__stopped.is_set():
+            change = self.__changes.get()
+            deadline = time.monotonic() + self.debounce
+            while (left := deadline - time.monotonic()) > 0:
+                try:
+                    change = change.merge(self.__changes.get(timeout=left))
+                except queue.Empty:
+                    break
+            try:
+                self.handler(change)
+            except:
+                logger.exception("Failed to process the library changes")
@@ -0,0 +1,241 @@
+import dataclasses
+import json
+import os
+import tempfile
+import threading
+from functools import cache
+from typing import Callable
+
+from utils.common import chunked
+from utils.jf import JellyfinClient, current_client
+from utils.logs import create_logger
+from utils.playlist_diff import PlaylistEntry
+
+logger = create_logger("jellyfin_playlists")
+
+
+@dataclasses.dataclass
+class __PlaylistCacheConfig:
+    enabled = os.getenv('JELLYFIN_PLAYLIST_CACHE', '1') == '1'
+    dir = os.getenv('JELLYFIN_PLAYLIST_CACHE_DIR') or os.path.join(tempfile.gettempdir(), 'yt2jf_playsync', 'jf_playlists')
+
+
+__config = __PlaylistCacheConfig()
+
+# Cheap to read for all the playlists in one request, any change of the playlist contents changes at least one of them
+VALIDATOR_FIELDS = ('ChildCount', 'DateLastSaved')
+
+
+@dataclasses.dataclass
+class PlaylistMembership:
+    # In the playlist order
+    entries: list[PlaylistEntry]
+    child_count: int
+    # None right after this process changed the playlist, the next validation adopts whatever the server has
+    date_last_saved: str | None
+    # The user the entries were read as
+    user_id: str = None
+    validated: bool = True
+
+    def yt_ids(self) -> set[str]:
+        return {e.yt_id for e in self.entries if e.yt_id}
+
+    def matches(self, child_count, date_last_saved):
+        if child_count != self.child_count:
+            return False
+        return self.date_last_saved is None or self.date_last_saved == date_last_saved
+
+    def to_json(self):
+        return {'user_id': self.user_id,
+                'child_count': self.child_count,
+                'date_last_saved': self.date_last_saved,
+                'entries': [[e.entry_id, e.item_id, e.yt_id] for e in self.entries]}
+
+    @staticmethod
+    def from_json(data) -> 'PlaylistMembership':
+        # Whatever happened to the playlist since it was saved, it has to be validated before it is used
+        return PlaylistMembership([PlaylistEntry(*e) for e in data['entries']], data['child_count'],
+                                  data['date_last_saved'], data['user_id'], validated=False)
+
+
+def cache_enabled():
+    return __config.enabled
+
+
+def load_playlist_validators(client: JellyfinClient, pl_ids, batch_size=200) -> dict[str, tuple[int, str]]:
+    validators = {}
+    for chunk in chunked(list(pl_ids), batch_size):
+        for itm in client.load_all_items('Playlist', VALIDATOR_FIELDS, Ids=','.join(chunk)):
+            validators[itm['Id']] = (itm.get('ChildCount'), itm.get('DateLastSaved'))
+    return validators
+
+
+class PlaylistMembershipCache:
+    """
+    Contents of the playlists of one Jellyfin server, persisted in `path` between runs (when given), so a sync cycle
+    does not download every playlist again.
+    Before a cached playlist is read it is revalidated by its ChildCount/DateLastSaved, revalidate() does it for many
+    playlists in a single request. Only the invalidated playlists are fetched again, page by page.
+    The changes made by this process are recorded right away, they do not invalidate the playlist. The entry ids of
+    the added items are read on demand, from the end of the playlist only.
+    """
+
+    def __init__(self, client: JellyfinClient, path=None):
+        self.client = client
+        self.path = path
+        self.__playlists: dict[str, PlaylistMembership] = {}
+        # Validators of the playlists that revalidate() could not confirm, load() starts from them
+        self.__fresh_validators: dict[str, tuple[int, str]] = {}
+        self.__loaded = path is None
+        self.__lock = threading.RLock()
+
+    def __load_state(self):
+        if self.__loaded:
+            return
+        self.__loaded = True
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+            if state.get('jf_url') == self.client.url:
+                self.__playlists = {pl_id: PlaylistMembership.from_json(data)
+                                    for pl_id, data in state['playlists'].items()}
+                logger.debug(f"Restored the items of {len(self.__playlists)} playlists")
+        except FileNotFoundError:
+            pass
+        except:
+            logger.exception("Cannot read the cached playlists, they will be reloaded")
+
+    def save(self):
+        """
+        Writes the playlists into `path`. The ones this process has changed get their DateLastSaved first, so a change
+        made by someone else until the next run invalidates them.
+        """
+        if self.path is None or not cache_enabled():
+            return
+        with self.__lock:
+            self.__load_state()
+            unsettled = [pl_id for pl_id, m in self.__playlists.items() if m.date_last_saved is None]
+            if unsettled:
+                self.__apply_validators(unsettled, load_playlist_validators(self.client, unsettled), validate=False)
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump({'jf_url': self.client.url,
+                           'playlists': {pl_id: m.to_json() for pl_id, m in self.__playlists.items()}}, f)
+            os.replace(tmp_path, self.path)
+
+    def __apply_validators(self, pl_ids, validators, validate=True):
+        for pl_id in pl_ids:
+            membership = self.__playlists.get(pl_id)
+            if membership and pl_id in validators and membership.matches(*validators[pl_id]):
+                membership.date_last_saved = validators[pl_id][1]
+                membership.validated = membership.validated or validate
+                continue
+            if membership:
+                logger.debug(f"Playlist {pl_id} has changed, its items will be reloaded")
+                del self.__playlists[pl_id]
+            if pl_id in validators:
+                self.__fresh_validators[pl_id] = validators[pl_id]
+
+    def revalidate(self, pl_ids):
+        pl_ids = list(pl_ids)
+        if not pl_ids:
+            return
+        validators = load_playlist_validators(self.client, pl_ids)
+        with self.__lock:
+            self.__load_state()
+            self.__apply_validators(pl_ids, validators)
+
+    def load(self, pl_id, user_id) -> PlaylistMembership:
+        # Validators first, a change made while the pages are being read invalidates the playlist next time
+        with self.__lock:
+            validators = self.__fresh_validators.pop(pl_id, None)
+        if validators is None:
+            validators = load_playlist_validators(self.client, [pl_id]).get(pl_id, (None, None))
+        entries = [PlaylistEntry.from_json(itm) for itm in self.client.iter_playlist_items(pl_id, user_id, "ProviderIds")]
+        logger.debug(f"Loaded {len(entries)} items of playlist {pl_id}")
+        return PlaylistMembership(entries, *validators, user_id)
+
+    def __membership(self, pl_id, user_id) -> PlaylistMembership:
+        if not cache_enabled():
+            return self.load(pl_id, user_id)
+        with self.__lock:
+            self.__load_state()
+            membership = self.__playlists.get(pl_id)
+            if membership and membership.user_id != user_id:
+                membership = None
+            if membership and not membership.validated:
+                self.revalidate([pl_id])
+                membership = self.__playlists.get(pl_id)
+            if membership is None:
+                membership = self.__playlists[pl_id] = self.load(pl_id, user_id)
+            # The next read has to validate it again, unless revalidate() is called for a bunch of playlists before
+            membership.validated = False
+            return membership
+
+    def yt_ids(self, pl_id, user_id) -> set[str]:
+        """YT ids of the items in the playlist."""
+        return self.__membership(pl_id, user_id).yt_ids()
+
+    def entries(self, pl_id, user_id) -> list[PlaylistEntry]:
+        """Entries of the playlist in its order, with their entry ids."""
+        with self.__lock:
+            membership = self.__membership(pl_id, user_id)
+            unknown = next((i for i, e in enumerate(membership.entries) if e.entry_id is None), None)
+            if unknown is not None:
+                expected = membership.entries[unknown:]
+                page = self.client.load_playlist_page(pl_id, user_id, unknown, len(expected), "ProviderIds")
+                loaded = [PlaylistEntry.from_json(itm) for itm in page['Items']]
+                if [e.item_id for e in loaded] == [e.item_id for e in expected]:
+                    membership.entries[unknown:] = loaded
+                else:
+                    logger.debug(f"Playlist {pl_id} does not end with the added items, its items will be reloaded")
+                    membership = self.__playlists[pl_id] = self.load(pl_id, user_id)
+                    membership.validated = False
+            return list(membership.entries)
+
+    def __record(self, pl_id, change: Callable[[list[PlaylistEntry]], list[PlaylistEntry]]):
+        with self.__lock:
+            self.__load_state()
+            if membership := self.__playlists.get(pl_id):
+                entries = change(list(membership.entries))
+                membership.child_count = (membership.child_count or 0) + len(entries) - len(membership.entries)
+                membership.entries = entries
+                membership.date_last_saved = None
+
+    def record_added(self, pl_id, added: dict[str, str | None]):
+        """Records the items this process has appended to the playlist, `added` maps jf item ids to YT ids."""
+        self.__record(pl_id, lambda entries: entries + [PlaylistEntry(None, jf_id, yt_id)
+                                                        for jf_id, yt_id in added.items()])
+
+    def record_removed(self, pl_id, entry_ids):
+        entry_ids = set(entry_ids)
+        self.__record(pl_id, lambda entries: [e for e in entries if e.entry_id not in entry_ids])
+
+    def record_moved(self, pl_id, moves: list[tuple[str, int]]):
+        """Records the (entry id, new index) moves this process has made, in the order they were made."""
+        def move(entries):
+            for entry_id, index in moves:
+                entry = next(e for e in entries if e.entry_id == entry_id)
+                entries.remove(entry)
+                entries.insert(index, entry)
+            return entries
+
+        self.__record(pl_id, move)
+
+    def invalidate(self, pl_id=None):
+        with self.__lock:
+            self.__load_state()
+            if pl_id is None:
+                self.__playlists.clear()
+            else:
+                self.__playlists.pop(pl_id, None)
+
+
+@cache
+def __playlist_membership(client: JellyfinClient) -> PlaylistMembershipCache:
+    return PlaylistMembershipCache(client, os.path.join(__config.dir, client.cache_file_name()))
+
+
+def playlist_membership(client: JellyfinClient = None) -> PlaylistMembershipCache:
+    return __playlist_membership(client or current_client())
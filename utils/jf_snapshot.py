@@ -0,0 +1,164 @@
+import copy
+import dataclasses
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from functools import cache
+
+import pytimeparse
+
+from utils.jf import JellyfinClient, current_client, LIBRARY_SCAN_CLOCK_SKEW
+from utils.logs import create_logger
+
+logger = create_logger("jellyfin_snapshot")
+
+
+@dataclasses.dataclass
+class __SnapshotConfig:
+    enabled = os.getenv('JELLYFIN_SNAPSHOT', '1') == '1'
+    dir = os.getenv('JELLYFIN_SNAPSHOT_DIR') or os.path.join(tempfile.gettempdir(), 'yt2jf_playsync', 'jf_snapshot')
+    reconcile_interval = pytimeparse.parse(os.getenv('JELLYFIN_SNAPSHOT_RECONCILE_INTERVAL', '1d'))
+
+
+__config = __SnapshotConfig()
+
+# Fields the sync stages read from the library items
+LIBRARY_FIELDS = ('Path', 'ProviderIds')
+# Re-read a bit before the watermark, items saved while the previous refresh was running must not be missed
+WATERMARK_OVERLAP = timedelta(minutes=1)
+
+
+def parse_jf_datetime(v):
+    return datetime.fromisoformat(v) if v else None
+
+
+class LibrarySnapshot:
+    """
+    Local copy of the Jellyfin library items of `types` on the `client` server, persisted on disk between runs.
+    refresh() asks only for the items saved since the newest DateLastSaved it has seen (MinDateLastSaved),
+    deleted items are dropped by comparing the ids once per `reconcile_interval`.
+    """
+
+    def __init__(self, client: JellyfinClient, types, path, reconcile_interval):
+        self.client = client
+        self.types = types
+        self.fields = LIBRARY_FIELDS + ('DateLastSaved',)
+        self.path = path
+        self.reconcile_interval = reconcile_interval
+        self.items: dict[str, dict] = {}
+        self.watermark = None
+        self.reconciled_at = 0
+        self.__loaded = False
+        self.__lock = threading.RLock()
+
+    def __load_state(self):
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+            if state.get('jf_url') == self.client.url and state.get('fields') == list(self.fields):
+                self.items = state['items']
+                self.watermark = state['watermark']
+                self.reconciled_at = state['reconciled_at']
+        except FileNotFoundError:
+            pass
+        except:
+            logger.exception(f"Cannot read the library snapshot of {self.types}, it will be rebuilt")
+
+    def __save_state(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'jf_url': self.client.url,
+                       'fields': self.fields,
+                       'watermark': self.watermark,
+                       'reconciled_at': self.reconciled_at,
+                       'items': self.items}, f)
+        os.replace(tmp_path, self.path)
+
+    def __advance_watermark(self, items):
+        saved = [d for itm in items if (d := parse_jf_datetime(itm.get('DateLastSaved')))]
+        if self.watermark:
+            saved.append(datetime.fromisoformat(self.watermark))
+        if saved:
+            self.watermark = max(saved).isoformat()
+
+    def refresh(self):
+        with self.__lock:
+            if not self.__loaded:
+                self.__load_state()
+                self.__loaded = True
+            if self.watermark is None:
+                # An empty library gets a watermark too, or every refresh would load it all again
+                started = datetime.now(timezone.utc) - LIBRARY_SCAN_CLOCK_SKEW
+                self.items = {itm['Id']: itm for itm in self.client.iter_all_items(self.types, self.fields)}
+                self.reconciled_at = time.time()
+                self.__advance_watermark(self.items.values())
+                self.watermark = self.watermark or started.isoformat()
+                logger.info(f"Loaded {len(self.items)} {self.types} items into the library snapshot")
+                changed = True
+            else:
+                since = datetime.fromisoformat(self.watermark) - WATERMARK_OVERLAP
+                items = self.client.load_all_items(self.types, self.fields,
+                                                   MinDateLastSaved=since.strftime('%Y-%m-%dT%H:%M:%S.%fZ'))
+                # The overlap brings back the items seen last time, they are not a change
+                items = [itm for itm in items if self.items.get(itm['Id']) != itm]
+                self.items.update((itm['Id'], itm) for itm in items)
+                self.__advance_watermark(items)
+                logger.debug(f"Fetched {len(items)} changed {self.types} items")
+                changed = bool(items)
+                if time.time() - self.reconciled_at >= self.reconcile_interval:
+                    # Saved even when nothing was deleted, the next run must not reconcile again
+                    self.reconcile()
+                    changed = True
+            if changed:
+                self.__save_state()
+        return self
+
+    def reconcile(self) -> int:
+        """Drops the items deleted from the library, returns how many of them there were."""
+        with self.__lock:
+            ids = {itm['Id'] for itm in self.client.iter_all_items(self.types)}
+            deleted = self.items.keys() - ids
+            for item_id in deleted:
+                del self.items[item_id]
+            self.reconciled_at = time.time()
+            logger.info(f"Reconciled the library snapshot of {self.types}, {len(deleted)} items were deleted")
+            return len(deleted)
+
+    def discard(self, ids):
+        with self.__lock:
+            for item_id in ids:
+                self.items.pop(item_id, None)
+
+    def all(self) -> list[dict]:
+        """Refreshes the snapshot and returns copies of the items, so callers can modify them."""
+        self.refresh()
+        with self.__lock:
+            return copy.deepcopy(list(self.items.values()))
+
+
+@cache
+def __library_snapshot(client: JellyfinClient, types) -> LibrarySnapshot:
+    path = os.path.join(__config.dir, client.cache_file_name(types.replace(',', '_')))
+    return LibrarySnapshot(client, types, path, __config.reconcile_interval)
+
+
+def library_snapshot(types, client: JellyfinClient = None) -> LibrarySnapshot:
+    return __library_snapshot(client or current_client(), types)
+
+
+def load_library_items(types="Audio", client: JellyfinClient = None) -> list[dict]:
+    """Library items with the LIBRARY_FIELDS, from the snapshot when it is enabled."""
+    client = client or current_client()
+    if __config.enabled:
+        return library_snapshot(types, client).all()
+    return client.load_all_items(types, LIBRARY_FIELDS)
+
+
+def forget_library_items(ids, types="Audio", client: JellyfinClient = None):
+    """Drops deleted items from the snapshot ahead of its next reconciliation."""
+    if __config.enabled:
+        library_snapshot(types, client).discard(ids)
@@ -0,0 +1,90 @@
+import bisect
+import dataclasses
+
+
+# Compared by identity, entries of a playlist are distinct even when their fields are not
+@dataclasses.dataclass(slots=True, eq=False)
+class PlaylistEntry:
+    # PlaylistItemId, None until the server is asked for it. The same item can be in a playlist several times.
+    entry_id: str | None
+    item_id: str
+    yt_id: str | None
+
+    @staticmethod
+    def from_json(item) -> 'PlaylistEntry':
+        return PlaylistEntry(item.get('PlaylistItemId'), item['Id'], (item.get('ProviderIds') or {}).get('YT'))
+
+
+def longest_increasing_subsequence(seq) -> list[int]:
+    """Indices of one of the longest strictly increasing subsequences of `seq`, O(n log n)."""
+    tails = []  # tails[k]: index of the smallest tail of an increasing subsequence of length k + 1
+    tail_values = []
+    prev = [-1] * len(seq)
+    for i, v in enumerate(seq):
+        k = bisect.bisect_left(tail_values, v)
+        if k:
+            prev[i] = tails[k - 1]
+        if k == len(tails):
+            tails.append(i)
+            tail_values.append(v)
+        else:
+            tails[k] = i
+            tail_values[k] = v
+    result = []
+    i = tails[-1] if tails else -1
+    while i != -1:
+        result.append(i)
+        i = prev[i]
+    return result[::-1]
+
+
+def plan_removals(entries: list[PlaylistEntry], yt_ids) -> list[str]:
+    """
+    Entry ids of the entries whose YT id is not in `yt_ids` anymore, and of the repeated entries of a YT id.
+    Entries without a YT id were not added by the sync, they are kept.
+    """
+    wanted = set(yt_ids)
+    seen = set()
+    removals = []
+    for entry in entries:
+        if entry.yt_id is None:
+            continue
+        if entry.yt_id not in wanted or entry.yt_id in seen:
+            removals.append(entry.entry_id)
+        seen.add(entry.yt_id)
+    return removals
+
+
+def target_order(entries: list[PlaylistEntry], yt_ids) -> list[PlaylistEntry]:
+    """
+    `entries` with the ones of `yt_ids` sorted into the YT order. The other entries stay in their positions, the YT
+    ones take the positions that YT entries occupy now.
+    """
+    rank = {}
+    for yt_id in yt_ids:
+        rank.setdefault(yt_id, len(rank))
+    synced = sorted((e for e in entries if e.yt_id in rank), key=lambda e: rank[e.yt_id])
+    synced_iter = iter(synced)
+    return [next(synced_iter) if e.yt_id in rank else e for e in entries]
+
+
+def plan_moves(entries: list[PlaylistEntry], yt_ids) -> list[tuple[str, int]]:
+    """
+    The fewest moves that put `entries` into target_order(): everything outside of the longest run of entries that
+    are already in the right relative order is moved. Returns (entry id, new index) pairs to be applied one after
+    another, each index as the server sees it: in the list without the moved entry.
+    """
+    target = target_order(entries, yt_ids)
+    final_index = {id(e): i for i, e in enumerate(target)}
+    kept = {id(entries[i]) for i in longest_increasing_subsequence([final_index[id(e)] for e in entries])}
+    working = list(entries)
+    moves = []
+    # In the target order, each moved entry goes right after its final predecessor, which is already in place
+    for i, entry in enumerate(target):
+        if id(entry) in kept:
+            continue
+        working.remove(entry)
+        index = working.index(target[i - 1]) + 1 if i else 0
+        working.insert(index, entry)
+        moves.append((entry.entry_id, index))
+    return moves
@@ -0,0 +1,102 @@
+import copy
+import json
+import threading
+import time
+from typing import Callable, Iterable
+
+import requests
+
+from utils.logs import create_logger
+
+logger = create_logger("db.realtime")
+
+
+def iter_sse_events(resp: requests.Response):
+    event, data = None, []
+    # Small chunks, otherwise events sit in the read buffer until more data arrives
+    for line in resp.iter_lines(chunk_size=1, decode_unicode=True):
+        if not line:
+            if data:
+                yield event, "\n".join(data)
+            event, data = None, []
+        elif line.startswith('event:'):
+            event = line[len('event:'):].strip()
+        elif line.startswith('data:'):
+            data.append(line[len('data:'):].strip())
+
+
+class RealtimeCache:
+    """
+    Keeps loaded values of whole PocketBase collections in memory.
+    An entry is dropped when PocketBase reports a change of its collection through the realtime (SSE) api,
+    or once it is older than `ttl` seconds, which covers the time the subscription is down.
+    """
+
+    def __init__(self, db_url: str, session_factory: Callable[[], requests.Session], collections: Iterable[str],
+                 ttl: float, realtime=True):
+        self.db_url = db_url
+        self.session_factory = session_factory
+        self.collections = tuple(collections)
+        self.ttl = ttl
+        self.realtime = realtime
+        self.__entries: dict[str, tuple[float, object]] = {}
+        # Bumped on each invalidation, so a value loaded while an event arrived is not cached
+        self.__generation = 0
+        self.__lock = threading.Lock()
+        self.__listener = None
+
+    def get(self, collection, loader: Callable[[], object]):
+        self.__ensure_listener()
+        with self.__lock:
+            entry = self.__entries.get(collection)
+            generation = self.__generation
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            loaded_at = time.monotonic()
+            value = loader()
+            with self.__lock:
+                if generation == self.__generation:
+                    self.__entries[collection] = (loaded_at, value)
+        else:
+            value = entry[1]
+        # Callers modify what they load, the cached value must stay intact
+        return copy.deepcopy(value)
+
+    def invalidate(self, collection=None):
+        with self.__lock:
+            self.__generation += 1
+            if collection is None:
+                self.__entries.clear()
+            else:
+                self.__entries.pop(collection, None)
+
+    def __ensure_listener(self):
+        if self.realtime and self.__listener is None:
+            self.__listener = threading.Thread(target=self.__listen, name="pb-realtime", daemon=True)
+            self.__listener.start()
+
+    def __listen(self):
+        retry_delay = 1
+        while True:
+            try:
+                with requests.get(f"{self.db_url}/api/realtime", stream=True, timeout=(10, None)) as resp:
+                    resp.raise_for_status()
+                    for event, data in iter_sse_events(resp):
+                        if event == 'PB_CONNECT':
+                            self.__subscribe(json.loads(data)['clientId'])
+                            retry_delay = 1
+                        elif event:
+                            self.invalidate(event.split('/')[0])
+                logger.debug("Realtime connection closed by the server, reconnecting")
+            except:
+                logger.warning(f"Realtime subscription failed, retrying in {retry_delay}s", exc_info=True)
+                time.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, 300)
+            # Changes made while disconnected were missed
+            self.invalidate()
+
+    def __subscribe(self, client_id):
+        subscriptions = [f"{c}/*" for c in self.collections]
+        resp = self.session_factory().post(f"{self.db_url}/api/realtime",
+                                           json={'clientId': client_id, 'subscriptions': subscriptions})
+        resp.raise_for_status()
+        logger.info(f"Subscribed to realtime changes of {', '.join(self.collections)}")
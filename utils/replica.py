@@ -0,0 +1,155 @@
+import dataclasses
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from functools import cache
+from typing import Generic, TypeVar, Iterator
+
+import pytimeparse
+
+from utils.db import Query, compile_decoder, get_db_url, storage
+from utils.logs import create_logger
+from utils.storage import format_db_datetime
+
+T = TypeVar('T')
+
+logger = create_logger("db.replica")
+
+
+@dataclasses.dataclass
+class __ReplicaConfig:
+    enabled = os.getenv('CONFIG_DB_REPLICA', '1') == '1'
+    dir = os.getenv('CONFIG_DB_REPLICA_DIR') or os.path.join(tempfile.gettempdir(), 'yt2jf_playsync', 'replica')
+    reconcile_interval = pytimeparse.parse(os.getenv('CONFIG_DB_REPLICA_RECONCILE_INTERVAL', '1d'))
+
+
+__config = __ReplicaConfig()
+
+# Re-read a bit before the cursor, so records committed out of `updated` order are not skipped
+CURSOR_OVERLAP = timedelta(seconds=5)
+
+
+class Replica(Generic[T]):
+    """
+    Local copy of a PocketBase collection, persisted on disk between runs.
+    refresh() fetches only the records with `updated` newer than the last seen one,
+    deleted records are dropped by comparing the ids once per `reconcile_interval`.
+    """
+
+    def __init__(self, db_clazz: type[T], path, reconcile_interval):
+        self.db_clazz = db_clazz
+        self.path = path
+        self.reconcile_interval = reconcile_interval
+        self.records: dict[str, dict] = {}
+        self.cursor = None
+        self.reconciled_at = 0
+        self.__loaded = False
+        self.__lock = threading.RLock()
+
+    def __load_state(self):
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+            if state.get('db_url') == get_db_url():
+                self.records = state['records']
+                self.cursor = state['cursor']
+                self.reconciled_at = state['reconciled_at']
+        except FileNotFoundError:
+            pass
+        except:
+            logger.exception(f"Cannot read the replica of '{self.db_clazz.col_name}', it will be rebuilt")
+
+    def __save_state(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'db_url': get_db_url(),
+                       'cursor': self.cursor,
+                       'reconciled_at': self.reconciled_at,
+                       'records': self.records}, f)
+        os.replace(tmp_path, self.path)
+
+    def __advance_cursor(self, recs, default=None):
+        self.cursor = max((r['updated'] for r in recs), default=self.cursor or default)
+
+    def refresh(self):
+        with self.__lock:
+            if not self.__loaded:
+                self.__load_state()
+                self.__loaded = True
+            query = Query(self.db_clazz)
+            if self.cursor is None:
+                # An empty collection gets a cursor too, or every refresh would load it all again
+                started = format_db_datetime(datetime.now(timezone.utc))
+                self.records = {r['id']: r for r in query.iter_records()}
+                self.reconciled_at = time.time()
+                self.__advance_cursor(self.records.values(), started)
+                logger.info(f"Loaded {len(self.records)} records of '{self.db_clazz.col_name}' into the replica")
+                changed = True
+            else:
+                since = datetime.fromisoformat(self.cursor) - CURSOR_OVERLAP
+                recs = query.where(updated__gte=format_db_datetime(since)).order_by('updated').records()
+                # The overlap brings back the records seen last time, they are not a change
+                recs = [r for r in recs if self.records.get(r['id']) != r]
+                self.records.update((r['id'], r) for r in recs)
+                self.__advance_cursor(recs)
+                logger.debug(f"Fetched {len(recs)} changed records of '{self.db_clazz.col_name}'")
+                changed = bool(recs)
+                if time.time() - self.reconciled_at >= self.reconcile_interval:
+                    # Saved even when nothing was deleted, the next run must not reconcile again
+                    self.reconcile()
+                    changed = True
+            if changed:
+                self.__save_state()
+        return self
+
+    def reconcile(self) -> int:
+        """Drops the records deleted from the db, returns how many of them there were."""
+        with self.__lock:
+            ids = {r['id'] for r in Query(self.db_clazz).only('id').records()}
+            deleted = self.records.keys() - ids
+            for rid in deleted:
+                del self.records[rid]
+            self.reconciled_at = time.time()
+            logger.info(f"Reconciled the replica of '{self.db_clazz.col_name}', {len(deleted)} records were deleted")
+            return len(deleted)
+
+    def all(self, **filters) -> list[T]:
+        """Refreshes the replica and returns the records equal to `filters`, where None matches empty values too."""
+        return list(self.iter(**filters))
+
+    def iter(self, **filters) -> Iterator[T]:
+
+        def matches(rec):
+            for k, v in filters.items():
+                if v is None and not rec.get(k):
+                    continue
+                if rec.get(k) != v:
+                    return False
+            return True
+
+        self.refresh()
+        decode = compile_decoder(self.db_clazz)
+        with self.__lock:
+            records = list(self.records.values())
+        return (decode(r) for r in records if matches(r))
+
+
+@cache
+def replica(db_clazz: type[T]) -> Replica[T]:
+    path = os.path.join(__config.dir, f"{db_clazz.col_name}.json")
+    return Replica(db_clazz, path, __config.reconcile_interval)
+
+
+def load_replicated(db_clazz: type[T], **filters) -> list[T]:
+    return list(iter_replicated(db_clazz, **filters))
+
+
+def iter_replicated(db_clazz: type[T], **filters) -> Iterator[T]:
+    # A local storage is as fast as the replica itself
+    if __config.enabled and storage().remote:
+        return replica(db_clazz).iter(**filters)
+    return Query(db_clazz).where(**filters).iter()
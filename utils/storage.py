@@ -0,0 +1,245 @@
+import dataclasses
+import os
+import re
+import secrets
+import sqlite3
+import string
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone
+from typing import Iterator
+
+from utils.logs import create_logger
+
+logger = create_logger("db.storage")
+
+
+@dataclasses.dataclass(slots=True)
+class WriteOp:
+    method: str  # 'create', 'update' or 'delete'
+    collection: str
+    id: str = None
+    body: dict = None
+
+
+class Storage(ABC):
+    """
+    Where the records of the db models live. Records are plain dicts keyed by the collection field names,
+    conditions are `(field, op, value)` tuples as built by `utils.db.Query`.
+    Write results are `(status, body)` pairs with http semantics, e.g. a unique key violation is
+    `(400, {'data': {field: {'code': 'validation_not_unique'}}})`, the way PocketBase reports it.
+    """
+    # Whether every call is a network round trip, i.e. worth replicating and subscribing to
+    remote = True
+
+    @abstractmethod
+    def list_records(self, collection, conditions=(), fields=(), sort=(), max_items=None) -> list[dict]:
+        ...
+
+    def iter_records(self, collection, conditions=(), fields=(), sort=(), max_items=None) -> Iterator[dict]:
+        return iter(self.list_records(collection, conditions, fields, sort, max_items))
+
+    @abstractmethod
+    def write(self, ops: list[WriteOp]) -> list[tuple[int, dict]]:
+        ...
+
+    @abstractmethod
+    def create_db_structure(self, default_settings: dict):
+        ...
+
+
+def format_db_datetime(dt: datetime):
+    return dt.strftime('%Y-%m-%d %H:%M:%S.') + f"{dt.microsecond // 1000:03}Z"
+
+
+def generate_record_id():
+    # Same shape as the PocketBase ids, so records can be moved between the backends as they are
+    return ''.join(secrets.choice(string.ascii_lowercase + string.digits) for _ in range(15))
+
+
+SQL_TYPES = {'text': 'TEXT', 'bool': 'INTEGER', 'number': 'NUMERIC', 'autodate': 'TEXT'}
+# PocketBase fields are never null, missing values are stored as the zero value of the type
+EMPTY_VALUES = {'text': '', 'bool': False, 'number': 0, 'autodate': ''}
+SQL_OPERATORS = {'eq': '=', 'ne': '!=', 'gt': '>', 'gte': '>=', 'lt': '<', 'lte': '<=', 'like': 'LIKE'}
+
+
+def quote_ident(name):
+    return f'"{name}"'
+
+
+def sql_where(conditions, field_types: dict[str, str]) -> tuple[str, list]:
+    """Renders `(field, op, value)` conditions into an SQL expression with its parameters."""
+
+    def param(name, value):
+        return EMPTY_VALUES[field_types[name]] if value is None else value
+
+    clauses = []
+    params = []
+    for name, op, value in conditions:
+        if op == 'in':
+            clauses.append(f'{quote_ident(name)} IN ({", ".join("?" * len(value))})' if value else '0')
+            params += [param(name, v) for v in value]
+        elif op == 'like':
+            # PocketBase `~` wraps the value with % unless it has its own
+            clauses.append(f'{quote_ident(name)} LIKE ?')
+            params.append(value if '%' in str(value) else f"%{value}%")
+        else:
+            clauses.append(f'{quote_ident(name)} {SQL_OPERATORS[op]} ?')
+            params.append(param(name, value))
+    return " AND ".join(clauses) or "1", params
+
+
+def sql_order_by(sort) -> str:
+    return ", ".join(f'{quote_ident(s.lstrip("+-"))} {"DESC" if s.startswith("-") else "ASC"}' for s in sort)
+
+
+class SqliteStorage(Storage):
+    """
+    Embedded single-file storage for single node deployments, no server and no http/json round trips.
+    Tables and unique indexes come from the same collection definitions PocketBase is set up with.
+    """
+    remote = False
+
+    def __init__(self, path, definitions: list[dict]):
+        self.path = path
+        self.definitions = {d['name']: d for d in definitions}
+        self.field_types = {d['name']: {'id': 'text'} | {f['name']: f['type'] for f in d['fields']}
+                            for d in definitions}
+        self.__local = threading.local()
+        self.__write_lock = threading.Lock()
+
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self.__local, 'conn', None)
+        if conn is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            # Transactions are started explicitly, see write()
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.__local.conn = conn
+        return conn
+
+    def __types(self, collection):
+        try:
+            return self.field_types[collection]
+        except KeyError:
+            raise ValueError(f"Unknown collection '{collection}'")
+
+    def __decode(self, collection, row: sqlite3.Row) -> dict:
+        types = self.__types(collection)
+        return {k: bool(row[k]) if types[k] == 'bool' else row[k] for k in row.keys()}
+
+    def __encode(self, collection, body: dict) -> dict:
+        types = self.__types(collection)
+        # Unknown fields are ignored, the same as PocketBase does
+        return {k: EMPTY_VALUES[types[k]] if v is None else v for k, v in body.items() if k in types}
+
+    def list_records(self, collection, conditions=(), fields=(), sort=(), max_items=None) -> list[dict]:
+        return list(self.iter_records(collection, conditions, fields, sort, max_items))
+
+    def iter_records(self, collection, conditions=(), fields=(), sort=(), max_items=None) -> Iterator[dict]:
+        where, params = sql_where(conditions, self.__types(collection))
+        columns = ", ".join(map(quote_ident, fields)) or "*"
+        sql = f'SELECT {columns} FROM "{collection}" WHERE {where}'
+        if sort:
+            sql += f" ORDER BY {sql_order_by(sort)}"
+        if max_items is not None:
+            sql += " LIMIT ?"
+            params.append(max_items)
+        for row in self.connection().execute(sql, params):
+            yield self.__decode(collection, row)
+
+    def write(self, ops: list[WriteOp]) -> list[tuple[int, dict]]:
+        """Runs all `ops` in one transaction, a failed operation is rolled back alone and reported in its result."""
+        conn = self.connection()
+        results = []
+        with self.__write_lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for op in ops:
+                    conn.execute("SAVEPOINT op")
+                    try:
+                        results.append(self.__write_one(conn, op))
+                        conn.execute("RELEASE op")
+                    except sqlite3.IntegrityError as e:
+                        conn.execute("ROLLBACK TO op")
+                        conn.execute("RELEASE op")
+                        results.append((400, self.__integrity_error_body(e)))
+                conn.execute("COMMIT")
+            except:
+                conn.execute("ROLLBACK")
+                raise
+        return results
+
+    def __write_one(self, conn, op: WriteOp) -> tuple[int, dict]:
+        now = format_db_datetime(datetime.now(timezone.utc))
+        types = self.__types(op.collection)
+        if op.method == 'create':
+            rec = {name: EMPTY_VALUES[t] for name, t in types.items()}
+            rec |= self.__encode(op.collection, op.body or {})
+            rec['id'] = rec['id'] or generate_record_id()
+            for name in ('created', 'updated'):
+                if name in types and not rec[name]:
+                    rec[name] = now
+            conn.execute(f'INSERT INTO "{op.collection}" ({", ".join(map(quote_ident, rec))}) '
+                         f'VALUES ({", ".join("?" * len(rec))})', list(rec.values()))
+            return 200, self.__load_one(conn, op.collection, rec['id'])
+        elif op.method == 'update':
+            data = self.__encode(op.collection, op.body or {})
+            data.pop('id', None)
+            if 'updated' in types:
+                data['updated'] = now
+            assignments = ", ".join(f"{quote_ident(k)} = ?" for k in data)
+            cursor = conn.execute(f'UPDATE "{op.collection}" SET {assignments} WHERE id = ?', [*data.values(), op.id])
+            if cursor.rowcount == 0:
+                return 404, {'message': f"Record {op.id} is not found"}
+            return 200, self.__load_one(conn, op.collection, op.id)
+        elif op.method == 'delete':
+            cursor = conn.execute(f'DELETE FROM "{op.collection}" WHERE id = ?', [op.id])
+            if cursor.rowcount == 0:
+                return 404, {'message': f"Record {op.id} is not found"}
+            return 204, None
+        raise ValueError(f"Unknown write method '{op.method}'")
+
+    def __load_one(self, conn, collection, rid) -> dict:
+        row = conn.execute(f'SELECT * FROM "{collection}" WHERE id = ?', [rid]).fetchone()
+        return self.__decode(collection, row)
+
+    @staticmethod
+    def __integrity_error_body(e: sqlite3.IntegrityError) -> dict:
+        # e.g. "UNIQUE constraint failed: download_task.yt_id"
+        if m := re.match(r'UNIQUE constraint failed: (.+)', str(e)):
+            columns = [c.strip().split('.')[-1] for c in m.group(1).split(',')]
+            return {'message': str(e), 'data': {c: {'code': 'validation_not_unique', 'message': str(e)}
+                                                for c in columns}}
+        return {'message': str(e), 'data': {}}
+
+    def create_db_structure(self, default_settings: dict):
+        conn = self.connection()
+        with self.__write_lock:
+            for name, dscr in self.definitions.items():
+                columns = {f['name']: f"{SQL_TYPES[f['type']]} NOT NULL DEFAULT {sql_literal(EMPTY_VALUES[f['type']])}"
+                           for f in dscr['fields']}
+                column_defs = ", ".join(f"{quote_ident(c)} {t}" for c, t in columns.items())
+                conn.execute(f'CREATE TABLE IF NOT EXISTS "{name}" (id TEXT PRIMARY KEY NOT NULL, {column_defs})')
+                existing = {row['name'] for row in conn.execute(f'PRAGMA table_info("{name}")')}
+                for c, t in columns.items():
+                    if c not in existing:
+                        conn.execute(f'ALTER TABLE "{name}" ADD COLUMN "{c}" {t}')
+                        logger.info(f"Added column `{c}` to `{name}`")
+                for idx in dscr['indexes']:
+                    conn.execute(re.sub(r'^CREATE UNIQUE INDEX ', 'CREATE UNIQUE INDEX IF NOT EXISTS ', idx))
+            for key, val in default_settings.items():
+                conn.execute('INSERT OR IGNORE INTO "yt_sync_settings" (id, "key", "val") VALUES (?, ?, ?)',
+                             [generate_record_id(), key, '' if val is None else str(val)])
+        logger.debug(f"Sqlite db {self.path} is up to date")
+
+
+def sql_literal(v):
+    if isinstance(v, bool):
+        return str(int(v))
+    if isinstance(v, (int, float)):
+        return str(v)
+    return "'" + str(v).replace("'", "''") + "'"
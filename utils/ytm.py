@@ -1,24 +1,124 @@
+import atexit
+import dataclasses
 import os
+import queue
+import tempfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from enum import auto, StrEnum
+from functools import cache
 
 import yt_dlp
 from pyyoutube import Client
 from ytmusicapi import YTMusic, OAuthCredentials
 from ytmusicapi.auth.oauth.models import BaseTokenDict
 
-from utils.db import GUser, save_guser
+from utils.db import GUser, UnitOfWork
+from utils.logs import create_logger
+
+logger = create_logger("ytm")
+
+
+@dataclasses.dataclass
+class __YtdlConfig:
+    # Player code, signature and nsig functions yt-dlp has worked out, shared by all the yt-dlp instances
+    cache_dir = os.getenv('YTDLP_CACHE_DIR') or os.path.join(tempfile.gettempdir(), 'yt2jf_playsync', 'yt-dlp')
+    playlist_workers = int(os.getenv('YTDLP_PLAYLIST_WORKERS', '4'))
+
+
+__config = __YtdlConfig()
+
+
+def ytdl_cache_dir():
+    return __config.cache_dir
+
+
+def default_playlist_workers():
+    return __config.playlist_workers
+
+
+class ExtractorPool:
+    """
+    yt_dlp.YoutubeDL instances reused across calls, one thread uses an instance at a time. The instances are created
+    on demand, at most `size` of them, and kept with their extractors initialized until close().
+    """
+
+    def __init__(self, opts: dict, size):
+        self.opts = opts
+        self.__idle: queue.LifoQueue[yt_dlp.YoutubeDL] = queue.LifoQueue()
+        self.__slots = threading.BoundedSemaphore(size)
+        self.__closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @contextmanager
+    def extractor(self):
+        with self.__slots:
+            try:
+                ydl = self.__idle.get_nowait()
+            except queue.Empty:
+                ydl = yt_dlp.YoutubeDL(self.opts)
+            try:
+                yield ydl
+            finally:
+                # An instance in use while the pool was closed is closed once it is returned
+                if self.__closed:
+                    ydl.close()
+                else:
+                    self.__idle.put(ydl)
+
+    def close(self):
+        """Closes the idle instances, saving their cookies and releasing their connections."""
+        self.__closed = True
+        while True:
+            try:
+                ydl = self.__idle.get_nowait()
+            except queue.Empty:
+                return
+            ydl.close()
+
+
+@cache
+def flat_playlist_extractors() -> ExtractorPool:
+    pool = ExtractorPool({'extract_flat': True, 'cachedir': ytdl_cache_dir()}, default_playlist_workers())
+    atexit.register(pool.close)
+    return pool
 
 
 def load_flat_playlist(playlist_id, load_entries=True):
     URL = f'https://music.youtube.com/playlist?list={playlist_id}'
-    ydl_opts = {'extract_flat': True}
-
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+    with flat_playlist_extractors().extractor() as ydl:
         info = ydl.extract_info(URL, download=False, process=load_entries)
         # ℹ️ ydl.sanitize_info makes the info json-serializable
         return ydl.sanitize_info(info)
-    pass
+
+
+def load_flat_playlists(playlist_ids, load_entries=True, max_workers=None) -> dict[str, dict]:
+    """
+    load_flat_playlist() for many playlists, at most `max_workers` of them at a time (YTDLP_PLAYLIST_WORKERS by
+    default, more workers than the pool size just wait for an extractor). Failed playlists are logged and left out.
+    """
+    playlist_ids = list(dict.fromkeys(playlist_ids))
+    if not playlist_ids:
+        return {}
+
+    def load(playlist_id):
+        try:
+            return load_flat_playlist(playlist_id, load_entries)
+        except:
+            logger.exception(f"Cannot load YT playlist {playlist_id}")
+
+    with ThreadPoolExecutor(max_workers=max_workers or default_playlist_workers()) as executor:
+        playlists = dict(zip(playlist_ids, executor.map(load, playlist_ids)))
+    if failed := [pl_id for pl_id, pl in playlists.items() if pl is None]:
+        logger.warning(f"{len(failed)} of {len(playlist_ids)} YT playlists could not be loaded: {failed}")
+    return {pl_id: pl for pl_id, pl in playlists.items() if pl is not None}
 
 class Category(StrEnum):
     VIDEO = auto()
@@ -56,7 +156,7 @@ def refresh_access_token(usr: GUser):
     client_secret = os.getenv('GOOGLE_APP_CLIENT_SECRET')
     client = Client(client_id=client_id, client_secret=client_secret, refresh_token=usr.refresh_token)
     tkn = client.refresh_access_token(usr.refresh_token)
-    usr.access_token = tkn.access_token
-    usr.access_token_expires = int(time.time()) + tkn.expires_in
-    save_guser(usr)
+    with UnitOfWork().track(usr):
+        usr.access_token = tkn.access_token
+        usr.access_token_expires = int(time.time()) + tkn.expires_in
     return tkn